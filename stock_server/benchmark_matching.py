@@ -0,0 +1,293 @@
+"""
+Matching Engine Micro-Benchmark (Offline).
+
+Drives `matching_engine.MatchingEngine` with a reproducible synthetic order stream
+and reports throughput, per-operation latency percentiles and peak memory as JSON.
+No Redis / Firestore / network needed.
+
+Usage:
+    python benchmark_matching.py
+    python benchmark_matching.py --orders 200000 --depth 500 --cancel-ratio 0.4 --symbols 5
+    python benchmark_matching.py --output before.json
+    python benchmark_matching.py --compare before.json   # print deltas vs a previous run
+
+Before/after an engine change: point --engine-dir at a directory holding an older
+matching_engine.py (e.g. `git show <rev>:stock_server/matching_engine.py > old/matching_engine.py`).
+Engines without reset()/O(1) cancel_order (the original sorted-list book) are driven
+through the same calls via `clear_engine()` / `cancel()`.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+OPS = ("add", "match", "cancel", "get_depth")
+
+me = None # matching_engine module under test (load_engine)
+
+
+def load_engine(engine_dir=None):
+    """Imports matching_engine, from `engine_dir` first when given (an older revision)."""
+    global me
+    if engine_dir:
+        sys.path.insert(0, os.path.abspath(engine_dir))
+    import matching_engine
+    me = matching_engine
+    return me
+
+
+# --- Compatibility with engines older than the current API ---
+def clear_engine():
+    if hasattr(me.engine, "reset"):
+        me.engine.reset()
+    else:
+        me.engine.books.clear() # Original engine: no reset(), books only
+
+
+def cancel(symbol, order_id):
+    if hasattr(me.engine, "cancel_order"):
+        return me.engine.cancel_order(order_id)
+    return me.engine.get_book(symbol).remove_order(order_id) # Original engine: O(n) per book
+
+
+def generate_stream(cfg):
+    """
+    Builds the op list up-front (not timed) so every run with the same seed replays
+    the exact same flow. Ops:
+        ("new", symbol, order_id, side, price, qty)
+        ("cancel", symbol, order_id)
+        ("depth", symbol)
+    """
+    rng = random.Random(cfg.seed)
+    symbols = [f"SYM{i:03d}" for i in range(cfg.symbols)]
+    mid = {s: 10_000 + 1_000 * i for i, s in enumerate(symbols)}
+    tick = cfg.tick
+    ops = []
+    live = {s: [] for s in symbols}  # ids that may still be resting (cancel candidates)
+    seq = 0
+
+    def new_order(symbol, side, price):
+        nonlocal seq
+        seq += 1
+        oid = f"B{seq}"
+        live[symbol].append(oid)
+        ops.append(("new", symbol, oid, side, price, rng.randint(1, 10) * 10))
+
+    # 1. Pre-fill each book with `depth` passive levels per side (non-crossing)
+    prefill = 0
+    for s in symbols:
+        for lvl in range(1, cfg.depth + 1):
+            new_order(s, me.OrderSide.BUY, mid[s] - lvl * tick)
+            new_order(s, me.OrderSide.SELL, mid[s] + lvl * tick)
+            prefill += 2
+
+    # 2. Steady-state flow
+    for _ in range(cfg.orders):
+        s = symbols[rng.randrange(len(symbols))]
+        roll = rng.random()
+        if roll < cfg.cancel_ratio and live[s]:
+            # Swap-pop a random candidate; it may already be filled (cancel is then a no-op)
+            pool = live[s]
+            i = rng.randrange(len(pool))
+            pool[i], pool[-1] = pool[-1], pool[i]
+            ops.append(("cancel", s, pool.pop()))
+        else:
+            side = me.OrderSide.BUY if rng.random() < 0.5 else me.OrderSide.SELL
+            if rng.random() < cfg.marketable_ratio:
+                # Cross the spread by a few ticks
+                offset = rng.randint(1, 5) * tick
+                price = mid[s] + offset if side == me.OrderSide.BUY else mid[s] - offset
+            else:
+                offset = rng.randint(1, cfg.depth) * tick
+                price = mid[s] - offset if side == me.OrderSide.BUY else mid[s] + offset
+            new_order(s, side, price)
+
+        if cfg.depth_every and len(ops) % cfg.depth_every == 0:
+            ops.append(("depth", s))
+
+    return ops, prefill
+
+
+def run_stream(ops, record=True):
+    """Replays the op list against a fresh engine. Returns (latencies_ns, trades, wall_s)."""
+    clear_engine()
+    lat = {op: [] for op in OPS}
+    trades = 0
+    clock = time.perf_counter_ns
+
+    start = time.perf_counter()
+    for op in ops:
+        kind = op[0]
+        if kind == "new":
+            _, symbol, oid, side, price, qty = op
+            book = me.engine.get_book(symbol)
+            order = me.Order(id=oid, user_id="BENCH", symbol=symbol, side=side,
+                             type=me.OrderType.LIMIT, price=price, quantity=qty)
+            t0 = clock()
+            book.add_order(order)
+            t1 = clock()
+            fills = book.match()
+            t2 = clock()
+            trades += len(fills)
+            if record:
+                lat["add"].append(t1 - t0)
+                lat["match"].append(t2 - t1)
+        elif kind == "cancel":
+            t0 = clock()
+            cancel(op[1], op[2])
+            t1 = clock()
+            if record:
+                lat["cancel"].append(t1 - t0)
+        else:
+            t0 = clock()
+            me.engine.get_orderbook(op[1])
+            t1 = clock()
+            if record:
+                lat["get_depth"].append(t1 - t0)
+    wall = time.perf_counter() - start
+    return lat, trades, wall
+
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def summarize(samples_ns):
+    vals = sorted(samples_ns)
+    n = len(vals)
+    return {
+        "count": n,
+        "mean_us": round(sum(vals) / n / 1000, 3) if n else 0.0,
+        "p50_us": round(percentile(vals, 0.50) / 1000, 3),
+        "p99_us": round(percentile(vals, 0.99) / 1000, 3),
+        "max_us": round(vals[-1] / 1000, 3) if n else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmark(cfg):
+    ops, prefill = generate_stream(cfg)
+    new_orders = sum(1 for op in ops if op[0] == "new")
+
+    # Engine prints on every match; keep the benchmark output machine-readable.
+    sink = io.StringIO() if cfg.quiet else sys.stderr
+    with contextlib.redirect_stdout(sink):
+        # Timing pass (no tracemalloc overhead)
+        lat, trades, wall = run_stream(ops)
+
+        # Memory pass (same stream, tracemalloc on)
+        peak = None
+        if not cfg.no_memory:
+            tracemalloc.start()
+            run_stream(ops, record=False)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        clear_engine()
+
+    return {
+        "benchmark": "matching_engine",
+        "revision": None if cfg.engine_dir else git_revision(), # Tree revision says nothing about --engine-dir
+        "engine": os.path.abspath(me.__file__),
+        "python": platform.python_version(),
+        "config": {
+            "seed": cfg.seed,
+            "orders": cfg.orders,
+            "depth": cfg.depth,
+            "symbols": cfg.symbols,
+            "cancel_ratio": cfg.cancel_ratio,
+            "marketable_ratio": cfg.marketable_ratio,
+            "depth_every": cfg.depth_every,
+            "tick": cfg.tick,
+        },
+        "results": {
+            "total_ops": len(ops),
+            "prefill_orders": prefill,
+            "new_orders": new_orders,
+            "trades": trades,
+            "wall_seconds": round(wall, 4),
+            "orders_per_sec": round(new_orders / wall, 1) if wall else 0.0,
+            "ops_per_sec": round(len(ops) / wall, 1) if wall else 0.0,
+            "latency": {op: summarize(lat[op]) for op in OPS},
+            "peak_memory_bytes": peak,
+        },
+    }
+
+
+def compare(current, baseline):
+    """Prints ratios current/baseline for the headline numbers (>1.0 = slower/bigger)."""
+    cur, base = current["results"], baseline["results"]
+    def label(run):
+        return f"rev {run['revision']}" if run.get("revision") else run.get("engine", "?")
+    lines = [f"Baseline {label(baseline)} -> current {label(current)}"]
+    if base.get("orders_per_sec"):
+        lines.append(f"  orders/sec: {base['orders_per_sec']:,.0f} -> {cur['orders_per_sec']:,.0f} "
+                     f"(x{cur['orders_per_sec'] / base['orders_per_sec']:.2f})")
+    for op in OPS:
+        for key in ("p50_us", "p99_us"):
+            b = base["latency"].get(op, {}).get(key)
+            c = cur["latency"].get(op, {}).get(key)
+            if b and c is not None:
+                lines.append(f"  {op:<9} {key}: {b:.3f} -> {c:.3f} (x{c / b:.2f})")
+    if base.get("peak_memory_bytes") and cur.get("peak_memory_bytes"):
+        lines.append(f"  peak memory: {base['peak_memory_bytes']:,} -> {cur['peak_memory_bytes']:,} B "
+                     f"(x{cur['peak_memory_bytes'] / base['peak_memory_bytes']:.2f})")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline micro-benchmark for matching_engine.MatchingEngine")
+    p.add_argument("--orders", type=int, default=50_000, help="Steady-state ops after pre-fill (new + cancel)")
+    p.add_argument("--depth", type=int, default=200, help="Pre-filled price levels per side per symbol")
+    p.add_argument("--symbols", type=int, default=3, help="Number of symbols (books)")
+    p.add_argument("--cancel-ratio", type=float, default=0.3, help="Share of ops that are cancels")
+    p.add_argument("--marketable-ratio", type=float, default=0.2, help="Share of new orders that cross the spread")
+    p.add_argument("--depth-every", type=int, default=100, help="Insert a get_depth call every N ops (0 = never)")
+    p.add_argument("--tick", type=float, default=10, help="Price step between levels")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--engine-dir", help="Benchmark the matching_engine.py in this directory (e.g. an older revision)")
+    p.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc peak-memory pass")
+    p.add_argument("--verbose", dest="quiet", action="store_false", help="Let engine prints through (stderr)")
+    p.add_argument("--output", help="Write JSON result to this file (default: stdout)")
+    p.add_argument("--compare", help="Previous JSON result to diff against (summary on stderr)")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    cfg = parse_args(argv)
+    load_engine(cfg.engine_dir)
+    result = run_benchmark(cfg)
+    payload = json.dumps(result, indent=2)
+
+    if cfg.output:
+        with open(cfg.output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+        print(f"✅ Benchmark result written to {cfg.output}", file=sys.stderr)
+    else:
+        print(payload)
+
+    if cfg.compare:
+        with open(cfg.compare, encoding="utf-8") as f:
+            print(compare(result, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+"""
+Sharded Matching Engine Service.
+
+Runs the matching engine outside the API process: symbols are hash-sharded across
+N worker processes, each owning its own `MatchingEngine` + `EngineJournal`. The API
+process talks to the shards through `EngineClient` over a local socket, so every
+symbol has exactly one authoritative book and matching uses N cores.
+
+Any number of API workers can share the shards: order intake (stream consumer group),
+queued-order state (order_state), the account ledger (risk_cache) and the book-stream
+state (market_feed.PublishedBooks) all live in Redis, and only the first worker of a
+launch runs the FLUSH_REDIS_ON_STARTUP flush + shard reset.
+
+Usage:
+    python engine_service.py --shards 4
+    ENGINE_SHARDS=4 uvicorn main:app --workers 4     # API side routes to the shards
+
+ENGINE_SHARDS=0 (default) keeps the in-process engine.
+
+Transport: unix socket <socket_dir>/engine-<i>.sock (TCP 127.0.0.1:<base_port + i>
+where unix sockets are unavailable). Frames are <len:u32><JSON>, one request ->
+one response per connection, in order:
+    request  [op, arg1, ...]
+    response ["ok", result] | ["err", message]
+Orders travel as order_journal rows. The shard assigns the time-priority sequence
+number on arrival, so priority is arrival order at the shard, not at the API.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from matching_engine import engine as local_engine, MatchingEngine, BookSnapshot, Order, next_order_seq, set_trade_id_prefix
+from order_journal import EngineJournal, order_to_row, order_from_row
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+ENGINE_SHARDS = int(os.getenv("ENGINE_SHARDS", "0")) # 0 = in-process engine
+ENGINE_SOCKET_DIR = os.getenv("ENGINE_SOCKET_DIR", os.path.join(DATA_DIR, "engine"))
+ENGINE_JOURNAL_DIR = os.getenv("ENGINE_JOURNAL_DIR", os.path.join(DATA_DIR, "journal"))
+ENGINE_BASE_PORT = int(os.getenv("ENGINE_BASE_PORT", "7600")) # TCP fallback only
+USE_UNIX_SOCKETS = hasattr(socket, "AF_UNIX") and sys.platform != "win32"
+
+SNAPSHOT_CHECK_INTERVAL = 5 # seconds
+
+_FRAME = struct.Struct("<I")
+
+
+class EngineServiceError(RuntimeError):
+    """Raised by EngineClient when a shard is unreachable or rejects a request."""
+
+
+def shard_for(symbol: str, num_shards: int) -> int:
+    # Stable across processes/restarts (unlike hash())
+    return zlib.crc32(symbol.encode("utf-8")) % num_shards
+
+
+def shard_address(shard_id: int, socket_dir: str = ENGINE_SOCKET_DIR):
+    if USE_UNIX_SOCKETS:
+        return os.path.join(socket_dir, f"engine-{shard_id}.sock")
+    return ("127.0.0.1", ENGINE_BASE_PORT + shard_id)
+
+
+def _encode(msg) -> bytes:
+    payload = json.dumps(msg, separators=(",", ":")).encode("utf-8")
+    return _FRAME.pack(len(payload)) + payload
+
+
+def _snapshot_row(snap: BookSnapshot):
+    return [snap.symbol, snap.seq, snap.timestamp, snap.bids, snap.asks]
+
+
+def _snapshot_from_row(row) -> BookSnapshot:
+    symbol, seq, ts, bids, asks = row
+    return BookSnapshot(symbol, seq, ts, tuple(map(tuple, bids)), tuple(map(tuple, asks)))
+
+
+# --- Shard (server side) ---
+class EngineShard:
+    """One shard process: owns the books of every symbol with shard_for(symbol) == shard_id."""
+
+    def __init__(self, shard_id: int, num_shards: int, journal_dir: str):
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        set_trade_id_prefix(f"s{shard_id}") # Shards booted in the same millisecond: distinct trade ids
+        self.engine = MatchingEngine() # Process-local singleton
+        # Journal per (shard, shard count): changing N starts empty shards, which the
+        # API layer then re-seeds from Redis pending_orders (see main.hydrate_engine).
+        self.journal = EngineJournal(os.path.join(journal_dir, f"shard-{shard_id}of{num_shards}"))
+        self.recovery = {}
+        self.handlers = {
+            "hello": self.hello,
+            "place": self.place,
+            "place_batch": self.place_batch,
+            "cancel": self.cancel,
+            "restore": self.restore,
+            "snapshot": self.snapshot,
+            "depth": self.depth,
+            "reset": self.reset,
+        }
+
+    def recover(self):
+        self.recovery = self.journal.recover(self.engine)
+        self.engine.attach_journal(self.journal)
+        print(f"♻️ [SHARD {self.shard_id}] Snapshot @{self.recovery['snapshot_seq']} "
+              f"+ {self.recovery['replayed_events']} events in {self.recovery['seconds']}s")
+
+    def _order(self, row) -> Order:
+        order = order_from_row(row)
+        if shard_for(order.symbol, self.num_shards) != self.shard_id:
+            raise ValueError(f"{order.symbol} does not belong to shard {self.shard_id}")
+        order.seq = next_order_seq() # Priority = arrival order at this shard
+        return order
+
+    # --- Ops ---
+    def hello(self, num_shards: int):
+        if num_shards != self.num_shards:
+            raise ValueError(f"Client expects {num_shards} shards, service runs {self.num_shards}")
+        return {"shard": self.shard_id, "shards": self.num_shards,
+                "last_seq": self.journal.last_seq, "recovery": self.recovery}
+
+    def place(self, row):
+        return self.engine.place_order(self._order(row))
+
+    def place_batch(self, rows):
+        return self.engine.place_orders([self._order(row) for row in rows])
+
+    def cancel(self, order_id: str):
+        order = self.engine.cancel_order(order_id)
+        return order_to_row(order) if order is not None else None
+
+    def restore(self, row) -> bool:
+        # Seeding path: rest (journaled) without matching. Idempotent per order id,
+        # so a seed interrupted by an API restart can simply run again.
+        order = self._order(row)
+        if order.id in self.engine.order_index:
+            return False
+        self.engine.get_book(order.symbol).add_order(order)
+        return True
+
+    def snapshot(self, symbol: str):
+        return _snapshot_row(self.engine.get_snapshot(symbol))
+
+    def depth(self, symbol: str, limit: int = 10):
+        return self.engine.get_book(symbol).get_depth(limit)
+
+    def reset(self):
+        self.engine.reset()
+        self.journal.reset()
+
+    # --- Transport ---
+    def handle(self, request):
+        op, *args = request
+        try:
+            return ["ok", self.handlers[op](*args)]
+        except Exception as e:
+            return ["err", f"{type(e).__name__}: {e}"]
+
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(_FRAME.size)
+                (length,) = _FRAME.unpack(header)
+                request = json.loads(await reader.readexactly(length))
+                # Handled synchronously: each request is atomic w.r.t. the others
+                writer.write(_encode(self.handle(request)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def snapshot_monitor(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_CHECK_INTERVAL)
+            try:
+                if self.journal.needs_snapshot():
+                    seq = self.journal.write_snapshot(self.engine)
+                    print(f"📸 [SHARD {self.shard_id}] Snapshot @{seq}")
+            except Exception as e:
+                print(f"⚠️ [SHARD {self.shard_id}] Snapshot Error: {e}")
+
+    async def serve(self, socket_dir: str):
+        address = shard_address(self.shard_id, socket_dir)
+        if USE_UNIX_SOCKETS:
+            if os.path.exists(address):
+                os.remove(address) # Stale socket from a previous run
+            server = await asyncio.start_unix_server(self.serve_client, path=address)
+        else:
+            server = await asyncio.start_server(self.serve_client, *address)
+        print(f"🚀 [SHARD {self.shard_id}/{self.num_shards}] Listening on {address}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set) # Terminate = clean stop (final snapshot)
+            except (NotImplementedError, RuntimeError):
+                pass # Windows: Ctrl+C still raises KeyboardInterrupt
+
+        monitor = asyncio.create_task(self.snapshot_monitor())
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            monitor.cancel()
+
+    def close(self):
+        try:
+            self.journal.write_snapshot(self.engine)
+        finally:
+            self.journal.close()
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_shard(shard_id: int, num_shards: int, socket_dir: str, journal_dir: str):
+    """Process entry point for one shard."""
+    shard = EngineShard(shard_id, num_shards, journal_dir)
+    shard.recover()
+    try:
+        asyncio.run(shard.serve(socket_dir))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shard.close()
+        print(f"🛑 [SHARD {shard_id}] Stopped")
+
+
+# --- Client (API side) ---
+class _ShardConnection:
+    """Blocking request/response connection to one shard, shared by threads."""
+
+    def __init__(self, address, timeout: float):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def _recv_exact(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("Shard closed the connection")
+            buf += chunk
+        return bytes(buf)
+
+    def request(self, msg):
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.sock.sendall(_encode(msg))
+                (length,) = _FRAME.unpack(self._recv_exact(_FRAME.size))
+                status, result = json.loads(self._recv_exact(length))
+            except (OSError, ValueError) as e:
+                # Never retried: a resent order could be placed twice
+                self.close()
+                raise EngineServiceError(f"Engine shard {self.address} unavailable: {e}") from e
+        if status != "ok":
+            raise EngineServiceError(result)
+        return result
+
+    def close(self):
+        if self.sock is not None:
+            try: self.sock.close()
+            except OSError: pass
+            self.sock = None
+
+
+class EngineClient:
+    """
+    Drop-in for the API-facing MatchingEngine methods, routed to the shard that
+    owns each symbol. Safe to share across threads.
+    """
+
+    def __init__(self, num_shards: int, socket_dir: str = ENGINE_SOCKET_DIR, timeout: float = 5.0):
+        self.num_shards = num_shards
+        self.shards = [_ShardConnection(shard_address(i, socket_dir), timeout) for i in range(num_shards)]
+
+    def _call(self, symbol: str, op: str, *args):
+        return self.shards[shard_for(symbol, self.num_shards)].request([op, *args])
+
+    def hello(self) -> List[Dict]:
+        """Handshake with every shard (verifies the shard count). Returns per-shard status."""
+        return [conn.request(["hello", self.num_shards]) for conn in self.shards]
+
+    def needs_seed(self) -> bool:
+        # A shard with an empty journal has never seen any order
+        return any(status["last_seq"] == 0 for status in self.hello())
+
+    def place_order(self, order: Order) -> List[Dict]:
+        return self._call(order.symbol, "place", order_to_row(order))
+
+    def place_orders(self, batch: List[Order]) -> List[List[Dict]]:
+        """One round trip per shard; trades grouped per order like MatchingEngine.place_orders."""
+        by_shard: Dict[int, List[int]] = {}
+        for i, order in enumerate(batch):
+            by_shard.setdefault(shard_for(order.symbol, self.num_shards), []).append(i)
+
+        results: List[List[Dict]] = [[] for _ in batch]
+        for shard_id, idxs in by_shard.items():
+            grouped = self.shards[shard_id].request(["place_batch", [order_to_row(batch[i]) for i in idxs]])
+            for i, trades in zip(idxs, grouped):
+                results[i] = trades
+        return results
+
+    def cancel_order(self, order_id: str, symbol: Optional[str] = None) -> Optional[Order]:
+        if symbol:
+            row = self._call(symbol, "cancel", order_id)
+            return order_from_row(row) if row else None
+        # No routing hint: ask every shard (ids are unique, at most one holds it)
+        for conn in self.shards:
+            row = conn.request(["cancel", order_id])
+            if row:
+                return order_from_row(row)
+        return None
+
+    def restore_order(self, order: Order) -> bool:
+        return self._call(order.symbol, "restore", order_to_row(order))
+
+    def reset(self):
+        for conn in self.shards:
+            conn.request(["reset"])
+
+    def get_orderbook(self, symbol: str, limit: int = 10):
+        return self._call(symbol, "depth", symbol, limit)
+
+    def get_snapshot(self, symbol: str) -> BookSnapshot:
+        return _snapshot_from_row(self._call(symbol, "snapshot", symbol))
+
+    def get_best_ask(self, symbol: str) -> float:
+        return self.get_snapshot(symbol).best_ask
+
+    def get_best_bid(self, symbol: str) -> float:
+        return self.get_snapshot(symbol).best_bid
+
+    def close(self):
+        for conn in self.shards:
+            conn.close()
+
+
+_client: Optional[EngineClient] = None
+
+
+def get_engine():
+    """The engine the API layer should use: in-process singleton, or the shard client."""
+    global _client
+    if ENGINE_SHARDS <= 0:
+        return local_engine
+    if _client is None:
+        _client = EngineClient(ENGINE_SHARDS)
+    return _client
+
+
+# --- Launcher ---
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Run the matching engine as N symbol-sharded processes")
+    p.add_argument("--shards", type=int, default=max(ENGINE_SHARDS, 1), help="Number of shard processes")
+    p.add_argument("--socket-dir", default=ENGINE_SOCKET_DIR, help="Directory for the shard unix sockets")
+    p.add_argument("--journal-dir", default=ENGINE_JOURNAL_DIR, help="Root directory of the shard journals")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    cfg = parse_args(argv)
+    signal.signal(signal.SIGTERM, _raise_interrupt) # Stop the shards with the launcher
+    os.makedirs(cfg.socket_dir, exist_ok=True)
+    ctx = multiprocessing.get_context("spawn") # Fresh interpreter = fresh engine singleton per shard
+    procs = [
+        ctx.Process(target=run_shard, args=(i, cfg.shards, cfg.socket_dir, cfg.journal_dir),
+                    name=f"engine-shard-{i}")
+        for i in range(cfg.shards)
+    ]
+    for p in procs:
+        p.start()
+    print(f"✅ Matching engine service: {cfg.shards} shard(s) started")
+    try:
+        while all(p.is_alive() for p in procs):
+            time.sleep(1)
+        print("❌ A shard process exited, stopping the service")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
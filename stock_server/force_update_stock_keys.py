@@ -4,6 +4,8 @@ import json
 from datetime import datetime
 import sys
 
+from market_feed import feed_channels
+
 sys.stdout.reconfigure(encoding='utf-8')
 
 # Config
@@ -41,7 +43,8 @@ def force_update_stock_keys():
                     
                     # 4. Update Key & Publish
                     r.set(f"stock:{symbol}", json_str)
-                    r.publish("stock_updates", json_str) # For WS
+                    for channel in feed_channels(symbol): # For WS (per-symbol + legacy channel)
+                        r.publish(channel, json_str)
                     
                     # Also update simple price key for redundancy
                     r.set(f"price:{symbol}", p_vnd)
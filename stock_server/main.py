@@ -5,7 +5,6 @@ sys.stdout.reconfigure(encoding='utf-8')
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from vnstock import Vnstock
 import pandas as pd
 import yfinance as yf
 import requests
@@ -17,11 +16,23 @@ import uuid
 from firebase_config import init_firebase, get_db
 from firebase_admin import firestore, messaging, auth
 import time
+import os
+import threading
+import socket
 from datetime import datetime, timedelta
 
 # --- Virtual Exchange Modules ---
-from matching_engine import engine, Order, OrderSide, OrderType, OrderStatus
+from matching_engine import Order, OrderSide, OrderType, OrderStatus, next_order_seq, SNAPSHOT_LEVELS
+from engine_service import get_engine, shard_for, ENGINE_SHARDS
 from market_maker import start_market_maker
+from order_journal import EngineJournal
+from order_pipeline import Pipeline, Stage, Job, PipelineBusy
+from risk_cache import AccountLedger, RiskCheckError
+from market_feed import FeedHub, FeedMessage, SlowConsumer, PublishedBooks, feed_channel, feed_channels
+from quote_refresher import QuoteRefresher, QuoteSource, RefreshScheduler
+from market_data import Quote, YFinanceProvider, build_market_data, MARKET_DATA_MODE
+from ohlcv_store import OHLCVStore, SYMBOL_PATTERN
+import order_state
 
 class OrderRequest(BaseModel):
     user_id: str
@@ -35,6 +46,52 @@ class OrderRequest(BaseModel):
 TRADING_FEE_RATE = 0.0015 # 0.15%
 USD_VND_RATE = 25450.0 # Fixed Rate for MVP
 IS_MAINTENANCE = False # Global Maintenance Flag
+# Dev "Clean All" on restart: flushes Redis AND resets the engine journal, so nothing is
+# recovered. Off by default; FLUSH_REDIS_ON_STARTUP=1 to start from an empty exchange.
+FLUSH_REDIS_ON_STARTUP = os.getenv("FLUSH_REDIS_ON_STARTUP", "0") == "1"
+# With several workers only the first one of a launch flushes (workers share the parent pid)
+STARTUP_FLUSH_KEY = f"startup_flush:{socket.gethostname()}:{os.getppid()}"
+STARTUP_FLUSH_TTL = 15 # Seconds; a restart after that flushes again
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "journal")
+OHLCV_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ohlcv") # Local history store
+
+# Staged order pipelines (POST /api/orders): intake (validate -> persist) | stream | match -> settle -> notify
+ORDER_QUEUE_SIZE = 1000 # Bounded queue per stage
+ORDER_ACCEPT_TIMEOUT = 2.0 # Seconds to wait for room in the first stage before answering 503
+
+# Order intake stream (Redis Streams + consumer group, at-least-once)
+ORDER_STREAM = "order_intake" # One stream per engine shard when ENGINE_SHARDS > 0: order_intake:<shard>
+ORDER_GROUP = "matching"
+ORDER_CONSUMER = f"{socket.gethostname()}-{os.getpid()}" # One consumer per API worker
+ORDER_STREAM_MAXLEN = 100_000 # Approximate trim; acked history kept for replay
+ORDER_READ_COUNT = 100 # Entries per XREADGROUP = one engine batch
+ORDER_CLAIM_IDLE_MS = 30_000 # Entries unacked this long (dead consumer) get re-claimed
+ORDER_CANCEL_WAIT = 2.0 # Seconds a cancel waits for an order some consumer is placing right now
+
+# Pre-trade risk cache (risk_cache.AccountLedger)
+LEDGER_FLUSH_INTERVAL = 0.5 # Seconds between write-behind flushes of held/refunded cash to Firestore
+
+# Order book broadcasts (coalesced per symbol)
+ORDERBOOK_BROADCAST_INTERVAL = float(os.getenv("ORDERBOOK_BROADCAST_INTERVAL", "0.1")) # Max 1 publish per symbol per interval
+ORDERBOOK_BROADCAST_LEVELS = 5 # Legacy full ORDER_BOOK messages
+ORDERBOOK_DIFF_LEVELS = SNAPSHOT_LEVELS # Depth of the snapshot + diff book stream
+
+# Quote refresh scheduling (quote_refresher.RefreshScheduler): priority = staleness x interest
+QUOTE_REFRESH_INTERVAL = 30 # Seconds between refresh rounds while anything is watched
+QUOTE_IDLE_INTERVAL = 60 # Seconds between interest checks while nothing is
+INTEREST_WEIGHTS = {
+    "ws": 4.0, # Per WebSocket subscription (quotes or book stream)
+    "order": 3.0, # Open orders (resting book levels)
+    "alert": 2.0, # Per active price alert
+    "holding": 1.0, # Per loaded account holding the symbol
+    "baseline": 0.5, # Default watchlist, while any client is connected
+}
+BASELINE_SYMBOLS = ["HPG", "VCB", "FPT", "AAPL", "BTC-USD", "GOOG"]
+
+# In-process engine, or the client of the symbol-sharded engine service when
+# ENGINE_SHARDS > 0 (see engine_service.py). Several uvicorn workers need the shards
+# (one book per symbol); the rest of the shared state lives in Redis.
+engine = get_engine()
 
 shutdown_event = asyncio.Event()
 active_connections = 0
@@ -63,94 +120,168 @@ def start_config_listener():
         print(f"⚠️ Failed to start config listener: {e}")
 
 # --- HELPER: TRADE SETTLEMENT ---
-def process_executed_trades(trades: list):
+FIRESTORE_BATCH_LIMIT = 500 # Max writes per Firestore batch commit
+BOT_USER_ID = "MARKET_MAKER_BOT"
+
+class ChunkedWriteBatch:
+    """Firestore write batch that rolls over to a new batch at the 500-write limit."""
+    def __init__(self, db):
+        self.db = db
+        self.batches = []
+        self.count = 0
+
+    def _batch(self):
+        if self.count % FIRESTORE_BATCH_LIMIT == 0:
+            self.batches.append(self.db.batch())
+        self.count += 1
+        return self.batches[-1]
+
+    def set(self, ref, data, merge=False):
+        self._batch().set(ref, data, merge=merge)
+
+    def update(self, ref, data):
+        self._batch().update(ref, data)
+
+    def commit(self):
+        for batch in self.batches:
+            batch.commit()
+        return len(self.batches)
+
+# --- HELPER: PRE-TRADE RISK CACHE ---
+def load_account(user_id: str):
+    """Ledger hydration: 1 user doc read + 1 holdings query."""
+    user_ref = get_db().collection("users").document(user_id)
+    user_snap = user_ref.get()
+    if not user_snap.exists:
+        return None, {}
+    shares = {h.id: h.to_dict().get("quantity", 0) for h in user_ref.collection("holdings").stream()}
+    return user_snap.to_dict().get("balance", 0), shares
+
+def flush_ledger():
+    """
+    Writes queued ledger cash deltas to Firestore (one Increment per user).
+    Each chunk is its own commit, so a failure only re-queues the chunks not yet written.
+    """
+    deltas = list(ledger.drain_pending().items())
+    db = get_db()
+    if not deltas or not db:
+        ledger.restore_pending(dict(deltas))
+        return 0
+    users = db.collection("users")
+    for start in range(0, len(deltas), FIRESTORE_BATCH_LIMIT):
+        chunk = deltas[start:start + FIRESTORE_BATCH_LIMIT]
+        try:
+            batch = db.batch()
+            for uid, delta in chunk:
+                batch.update(users.document(uid), {"balance": firestore.Increment(delta)})
+            batch.commit()
+        except Exception as e:
+            print(f"⚠️ [LEDGER] Flush Error (re-queued): {e}")
+            ledger.restore_pending(dict(deltas[start:]))
+            return start
+    return len(deltas)
+
+async def ledger_reconciler():
+    """Background Task: write-behind of ledger cash holds/refunds + eviction of idle accounts."""
+    while not shutdown_event.is_set():
+        try:
+            await asyncio.to_thread(flush_ledger)
+            ledger.evict_idle()
+            await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"⚠️ Ledger Reconciler Error: {e}")
+            await asyncio.sleep(5)
+
+def process_executed_trades(trades: list, notify: bool = True):
     """
-    Handles financial settlement (Firestore) and Status Updates (Redis) for executed trades.
+    Handles financial settlement (Firestore) and Status Updates (Redis) for one match cycle.
+    Trades are netted first: one cash delta per seller, one holding delta per (user, symbol),
+    one fill total per order. Then everything is written with a chunked Firestore batch
+    and ONE Redis pipeline (atomic Lua fill per order), whatever the number of trades.
+    notify=False leaves FCM/broadcasts to the caller (order pipeline 'notify' stage).
     """
+    trades = [t for t in trades or [] if isinstance(t, dict)]
     if not trades or not r:
-        print(f"[DEBUG] process_executed_trades: Aborting! Trades={len(trades) if trades else 0}, Redis={r is not None}")
+        print(f"[DEBUG] process_executed_trades: Aborting! Trades={len(trades)}, Redis={r is not None}")
         return
     
-    print(f"[DEBUG] process_executed_trades STARTED with {len(trades)} trades.")
     db = get_db()
-    
     print(f"⚡ Processing {len(trades)} trades...")
-    
+
+    # 1. Net the cycle
+    cash = {} # user_id -> net proceeds (sellers; buyers' money was held at order time)
+    holdings = {} # (user_id, symbol) -> quantity delta
+    fills = {} # order_id -> [symbol, filled qty]
     for trade in trades:
-        # trade check
-        if not isinstance(trade, dict): continue
-        print(f"[DEBUG] Trade Data: {trade}")
-        
         qty = trade.get("quantity")
         symbol = trade.get("symbol")
         price = trade.get("price")
         buyer_id = trade.get("buyer_id")
         seller_id = trade.get("seller_id")
-        
-        # 1. Log Transaction (Optional for MVP, but good for history)
-        # db.collection('transactions').add(trade)
-        
-        # 2. Settlement
-        if db:
-            try:
-                batch = db.batch()
-                
-                # BUYER: Add Stocks (Money already held)
-                if buyer_id != "MARKET_MAKER_BOT":
-                    b_ref = db.collection("users").document(buyer_id).collection("holdings").document(symbol)
-                    batch.set(b_ref, {"quantity": firestore.Increment(qty), "symbol": symbol}, merge=True)
-                
-                # SELLER: Deduct Stocks, Add Money
-                if seller_id != "MARKET_MAKER_BOT":
-                    s_ref = db.collection("users").document(seller_id)
-                    s_holding = s_ref.collection("holdings").document(symbol)
-                    
-                    revenue = price * qty
-                    fee = revenue * TRADING_FEE_RATE
-                    net = revenue - fee
-                    
-                    print(f"💰 [SETTLEMENT] Seller {seller_id} sold {qty} {symbol} @ {price}. Net: {net:,.2f}")
-                    
-                    batch.update(s_holding, {"quantity": firestore.Increment(-qty)})
-                    batch.update(s_ref, {"balance": firestore.Increment(net)})
-                else:
-                    print(f"msg: Seller is BOT, skipping balance update.")
-                
-                batch.commit()
-                print("✅ [SETTLEMENT] Batch Commit Success.")
-                
-                # 3. Publish to Social Feed
-                publish_social_feed(db, trade, r)
-            except Exception as e:
-                print(f"⚠️ Settlement Error: {e}")
-        
-                # 3. Redis Status Update
-        try:
-            for oid in [trade["buy_order_id"], trade["sell_order_id"]]:
-                # if "BOT" in oid: continue  <-- REMOVED: Bot orders are now in Redis so must be cleaned up!
-                # Actually Bot orders ARE in Redis now (market_maker.py puts them there).
-                # But they might not have a distinct 'quantity' field easily accessible if we don't query.
-                # However, for user orders:
-                
-                # Increment filled
-                new_filled = r.hincrbyfloat(f"order:{oid}", "filled", float(qty))
-                
-                # Check Total Quantity
-                # We need to fetch the original quantity to know if it's full.
-                # Since we don't have it handy in the `trade` dict for *both* sides (only trade qty),
-                # we must fetch from Redis.
-                order_info = r.hmget(f"order:{oid}", ["quantity", "status"])
-                if order_info and order_info[0]:
-                    total_qty = float(order_info[0])
-                    if new_filled >= total_qty - 0.0001: # Float tolerance
-                        r.hset(f"order:{oid}", "status", "matched") # or filled
-                        r.srem("pending_orders", oid)
-                        print(f"✅ Order {oid} Fully Matched & Removed from Pending.")
-                    else:
-                         r.hset(f"order:{oid}", "status", "partial")
 
+        # BUYER: Add Stocks (Money already held)
+        if buyer_id != BOT_USER_ID:
+            holdings[(buyer_id, symbol)] = holdings.get((buyer_id, symbol), 0) + qty
+
+        # SELLER: Deduct Stocks, Add Money
+        if seller_id != BOT_USER_ID:
+            revenue = price * qty
+            net = revenue - revenue * TRADING_FEE_RATE
+            holdings[(seller_id, symbol)] = holdings.get((seller_id, symbol), 0) - qty
+            cash[seller_id] = cash.get(seller_id, 0.0) + net
+
+        for oid in (trade["buy_order_id"], trade["sell_order_id"]):
+            fills.setdefault(oid, [symbol, 0])[1] += qty
+
+    # Mirror the cycle in the risk cache (releases used holds/locks, credits positions)
+    ledger.apply_trades(trades, TRADING_FEE_RATE, skip_user=BOT_USER_ID)
+
+    # 2. Settlement (Firestore)
+    feed_items = []
+    if db:
+        try:
+            feed_items = build_social_feed(db, trades)
+            batch = ChunkedWriteBatch(db)
+            users = db.collection("users")
+            for (uid, symbol), delta in holdings.items():
+                if delta:
+                    h_ref = users.document(uid).collection("holdings").document(symbol)
+                    batch.set(h_ref, {"quantity": firestore.Increment(delta), "symbol": symbol}, merge=True)
+            for uid, net in cash.items():
+                print(f"💰 [SETTLEMENT] Seller {uid}: Net {net:,.2f}")
+                batch.update(users.document(uid), {"balance": firestore.Increment(net)})
+            # Social feed history rides along in the same commit
+            feed = db.collection("feed")
+            for item in feed_items:
+                batch.set(feed.document(), item)
+            commits = batch.commit()
+            print(f"✅ [SETTLEMENT] {batch.count} writes committed in {commits} batch(es).")
         except Exception as e:
-            print(f"Redis Update Error: {e}")
+            print(f"⚠️ Settlement Error: {e}")
+
+    # 3. Redis Status Update + Global Feed (one pipeline)
+    try:
+        pipe = r.pipeline()
+        for oid, (symbol, filled) in fills.items():
+            # filled/status/pending indexes updated atomically (no race with cancel)
+            order_state.fill_order(pipe, oid, symbol, filled)
+        for item in feed_items:
+            pipe.lpush("recent_trades", json.dumps(item))
+        if feed_items:
+            pipe.ltrim("recent_trades", 0, 49) # Keep last 50
+        pipe.execute()
+    except Exception as e:
+        print(f"Redis Update Error: {e}")
+
+    if notify:
+        notify_executed_trades(trades)
+
+def notify_executed_trades(trades: list):
+    """Post-settlement notifications: whale alerts (FCM) + orderbook broadcasts."""
+    # Whale alerts (rare, external FCM call)
+    send_whale_alerts(trades)
 
     # 4. Broadcast Realtime Updates
     if r:
@@ -162,25 +293,79 @@ def process_executed_trades(trades: list):
             print(f"⚠️ Broadcast Error: {e}")
 
 # --- Hydration Helper ---
+# Append-only engine journal (mmap segments + periodic snapshots) on local disk
+engine_journal = EngineJournal(JOURNAL_DIR)
+
 def hydrate_engine():
     """
-    Restores the In-Memory Matching Engine state from Redis on startup.
-    This ensures that pending orders persist across server restarts.
+    Restores the In-Memory Matching Engine state on startup:
+    latest journal snapshot + replay of the journal tail only.
+    Replay applies recorded events (new/cancel/fill) and never re-runs matching,
+    so it cannot generate new trades. Restart time is bounded by the tail length.
+    """
+    if ENGINE_SHARDS:
+        # Shards recover their own journals; only a fresh shard needs seeding from Redis.
+        # Seeding is idempotent per order id, so a re-run after an API restart (or by
+        # several workers booting together) is safe.
+        try:
+            if engine.needs_seed():
+                seed_engine_from_redis()
+        except Exception as e:
+            print(f"❌ Engine Service Error: {e}")
+        return
+
+    if engine.journal is not None:
+        return # Already recovered & journaling
+
+    print("♻️ Recovering Matching Engine from journal...")
+    try:
+        stats = engine_journal.recover(engine)
+        print(f"   -> Snapshot @{stats['snapshot_seq']} ({stats['snapshot_orders']} orders) "
+              f"+ {stats['replayed_events']} journal events in {stats['seconds']}s")
+
+        if stats["last_seq"] == 0:
+            # No journal yet (first run after upgrade): seed from Redis once
+            seed_engine_from_redis()
+            engine_journal.write_snapshot(engine)
+    except Exception as e:
+        print(f"❌ Hydration Error: {e}")
+    finally:
+        engine.attach_journal(engine_journal)
+
+def order_from_record(data: dict) -> Order:
+    """Engine Order from an 'order:{id}' hash (or the same fields read from the intake stream)."""
+    side_str = data.get("side", "").upper()
+    type_str = data.get("type", "").upper()
+
+    # Safe float conversion
+    filled = int(float(data.get("filled", 0)))
+    return Order(
+        id=data.get("order_id"),
+        user_id=data.get("user_id"),
+        symbol=data.get("symbol"),
+        side=OrderSide[side_str] if side_str in OrderSide.__members__ else OrderSide.BUY,
+        type=OrderType[type_str] if type_str in OrderType.__members__ else OrderType.LIMIT,
+        price=float(data.get("price", 0)),
+        quantity=int(float(data.get("quantity", 0))),
+        filled_quantity=filled,
+        timestamp=float(data.get("timestamp", time.time())),
+        status=OrderStatus.PARTIAL if filled else OrderStatus.PENDING
+    )
+
+def seed_engine_from_redis():
+    """
+    Seeds the engine from Redis pending_orders when no journal exists.
+    Orders are rested as-is (restore_order), never matched, so no trades are produced.
     """
     if not r: 
         print("⚠️ Redis not connected, skipping hydration.")
         return
 
-    print("♻️ Hydrating Matching Engine from Redis...")
+    print("♻️ Seeding Matching Engine from Redis...")
     try:
         print("   -> Fetching pending_orders from Redis...")
         pending_ids = r.smembers("pending_orders")
         print(f"   -> Found {len(pending_ids)} pending orders.")
-        count = 0
-        
-        # We need to load ALL orders first, then sort them by timestamp to re-play them continuously?
-        # Or just adding them is enough? 
-        # Ideally, we should add them in timestamp order to maintain priority.
         
         loaded_orders = []
         
@@ -195,131 +380,134 @@ def hydrate_engine():
             
             for data in results:
                 if not data: continue
+                if data.get("engine") == "queued": continue # Still in the intake stream: the consumer places it
                 
                 # Reconstruct Order Object
                 try:
-                    side_str = data.get("side", "").upper()
-                    type_str = data.get("type", "").upper()
-                    
-                    # Safe float conversion
-                    price = float(data.get("price", 0))
-                    qty = int(float(data.get("quantity", 0)))
-                    filled = int(float(data.get("filled", 0)))
-                    ts = float(data.get("timestamp", time.time()))
-
-                    order = Order(
-                        id=data.get("order_id"),
-                        user_id=data.get("user_id"),
-                        symbol=data.get("symbol"),
-                        side=OrderSide[side_str] if side_str in OrderSide.__members__ else OrderSide.BUY,
-                        type=OrderType[type_str] if type_str in OrderType.__members__ else OrderType.LIMIT,
-                        price=price,
-                        quantity=qty,
-                        filled_quantity=filled,
-                        timestamp=ts,
-                        status=OrderStatus.PENDING
-                    )
+                    order = order_from_record(data)
+                    if order.remaining_quantity <= 0: continue
                     loaded_orders.append(order)
                 except Exception as e:
                     # print(f"⚠️ Failed to parse order data: {e}") 
                     continue
         
-        # Sort by timestamp to preserve FIFO/Time priority
+        # Sort by timestamp to preserve FIFO/Time priority (sequence numbers follow that order)
         loaded_orders.sort(key=lambda x: x.timestamp)
         
         for o in loaded_orders:
-            trades = engine.place_order(o)
-            if trades:
-                print(f"⚡ Matched {len(trades)} trades during hydration!")
-                process_executed_trades(trades)
-            count += 1
+            o.seq = next_order_seq()
+            engine.restore_order(o)
             
-        print(f"✅ Hydrated {count} orders into Matching Engine.")
+        print(f"✅ Seeded {len(loaded_orders)} orders into Matching Engine.")
         
     except Exception as e:
-        print(f"❌ Hydration Error: {e}")
+        print(f"❌ Seeding Error: {e}")
+
+def reset_engine():
+    """Clears every book and the engine journal (in-process, or on every shard)."""
+    engine.reset()
+    if not ENGINE_SHARDS:
+        engine_journal.reset()
+    flush_ledger() # Holds of the dropped orders stay spent, as before the cache
+    ledger.reset()
+    # Keep the published state: the next flush sees the seq go backwards and sends a BOOK_SNAPSHOT
+    if r:
+        published_books.mark_all_dirty()
+
+def flush_on_startup():
+    """
+    FLUSH_REDIS_ON_STARTUP: the first worker of the launch flushes Redis and resets the
+    engine; the other workers wait for it instead of wiping its fresh state again.
+    """
+    if r.set(STARTUP_FLUSH_KEY, "flushing", nx=True, ex=STARTUP_FLUSH_TTL):
+        print("⚠️ [CLEANUP] Flushing Redis (User Request: Clean All)...")
+        pipe = r.pipeline(transaction=True)
+        pipe.flushdb()
+        pipe.set(STARTUP_FLUSH_KEY, "flushing", ex=STARTUP_FLUSH_TTL) # The election survives its own flush
+        pipe.execute()
+        try:
+            reset_engine() # Keep engine journal consistent with the flushed order store
+        finally:
+            r.set(STARTUP_FLUSH_KEY, "done", ex=STARTUP_FLUSH_TTL)
+        print("✅ Redis Flushed.")
+        return
+    deadline = time.time() + STARTUP_FLUSH_TTL
+    while r.get(STARTUP_FLUSH_KEY) == "flushing" and time.time() < deadline:
+        time.sleep(0.2)
+
+async def journal_snapshot_monitor():
+    """
+    Background Task: Snapshot the engine once enough journal events accumulated,
+    so the replay tail (and restart time) stays bounded.
+    """
+    while not shutdown_event.is_set():
+        try:
+            if engine_journal.needs_snapshot():
+                seq = await asyncio.to_thread(engine_journal.write_snapshot, engine)
+                print(f"📸 [JOURNAL] Engine snapshot written @seq {seq}")
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"⚠️ Journal Snapshot Error: {e}")
+            await asyncio.sleep(30)
 
 # --- Social Trading Helpers ---
-def publish_social_feed(db, trade: dict, r_client=None):
+def build_social_feed(db, trades: list) -> list:
     """
-    Publishes a trade to the Social Feed (Firestore + Redis) and sends FCM if it's a 'Whale' trade.
+    Feed entries (buyer + non-bot seller) for a match cycle.
+    User names are fetched with ONE batched read for all distinct users.
     """
     try:
-        # Validating input
+        user_ids = set()
+        for t in trades:
+            if t.get("buyer_id"): user_ids.add(t["buyer_id"])
+            if t.get("seller_id") and t["seller_id"] != BOT_USER_ID: user_ids.add(t["seller_id"])
+
+        names = {}
+        if user_ids:
+            refs = [db.collection("users").document(uid) for uid in user_ids]
+            for snap in db.get_all(refs):
+                if snap.exists:
+                    names[snap.id] = snap.to_dict().get("fullName", "Nhà đầu tư")
+
+        items = []
+        for t in trades:
+            base = {
+                "symbol": t.get("symbol"),
+                "price": t.get("price", 0),
+                "quantity": t.get("quantity", 0),
+                "timestamp": t.get("timestamp", time.time()),
+                "type": "trade"
+            }
+            buyer_id, seller_id = t.get("buyer_id"), t.get("seller_id")
+            if buyer_id:
+                items.append({"user_id": buyer_id, "user_name": names.get(buyer_id, "Nhà đầu tư"),
+                              "action": "mua", **base})
+            if seller_id and seller_id != BOT_USER_ID:
+                items.append({"user_id": seller_id, "user_name": names.get(seller_id, "Nhà đầu tư"),
+                              "action": "bán", **base})
+        return items
+    except Exception as e:
+        print(f"Error building social feed: {e}")
+        return []
+
+def send_whale_alerts(trades: list):
+    """Sends an FCM 'market_news' notification for every trade above 100M VND."""
+    for trade in trades:
         symbol = trade.get('symbol')
         price = trade.get('price', 0)
         quantity = trade.get('quantity', 0)
         total_val = price * quantity
-        timestamp = trade.get('timestamp', time.time())
-        buyer_id = trade.get('buyer_id')
-        seller_id = trade.get('seller_id')
-
-        # Cache names ideally, but fetch for now
-        buyer_name = "Nhà đầu tư"
-        seller_name = "Nhà đầu tư"
+        if total_val <= 100_000_000:
+            continue
+        print(f"🐋 WHALE ALERT: {total_val:,.0f} VND on {symbol}")
         
-        # 1. Feed for Buyer
-        if buyer_id:
-            b_snap = db.collection("users").document(buyer_id).get()
-            if b_snap.exists: buyer_name = b_snap.to_dict().get("fullName", "Nhà đầu tư")
-            
-            # Global Feed Entry (Redis)
-            feed_item = {
-                "user_id": buyer_id,
-                "user_name": buyer_name,
-                "symbol": symbol,
-                "action": "mua",
-                "price": price,
-                "quantity": quantity,
-                "timestamp": timestamp,
-                "type": "trade"
-            }
-            
-            # Save to Redis for Global Feed API
-            if r_client:
-                 try:
-                     r_client.lpush("recent_trades", json.dumps(feed_item))
-                     r_client.ltrim("recent_trades", 0, 49) # Keep last 50
-                 except Exception as e:
-                     print(f"⚠️ Redis Feed Error: {e}")
-
-            # Save to Firestore (Personal Feed / History)
-            db.collection("feed").add(feed_item)
-
-        # 2. Feed for Seller
-        if seller_id and seller_id != "MARKET_MAKER_BOT":
-            s_snap = db.collection("users").document(seller_id).get()
-            if s_snap.exists: seller_name = s_snap.to_dict().get("fullName", "Nhà đầu tư")
-            
-            feed_item_sell = {
-                "user_id": seller_id,
-                "user_name": seller_name,
-                "symbol": symbol,
-                "action": "bán",
-                "price": price,
-                "quantity": quantity,
-                "timestamp": timestamp,
-                "type": "trade"
-            }
-            
-            # Save to Redis for Global Feed API
-            if r_client:
-                 try:
-                     r_client.lpush("recent_trades", json.dumps(feed_item_sell))
-                     r_client.ltrim("recent_trades", 0, 49)
-                 except Exception as e:
-                     print(f"⚠️ Redis Feed Error (Sell): {e}")
-            
-            db.collection("feed").add(feed_item_sell)
-
-        # 3. Whale Alert (> 100M VND)
-        if total_val > 100_000_000:
-            print(f"🐋 WHALE ALERT: {total_val:,.0f} VND on {symbol}")
-            
-            notification_title = f"🐋 Cá mập hành động trên {symbol}!"
-            val_str = f"{total_val/1_000_000_000:,.2f} tỷ" if total_val >= 1_000_000_000 else f"{total_val/1_000_000:,.0f} triệu"
-            notification_body = f"Giao dịch khớp lệnh {quantity:,.0f} CP giá {price:,.0f}. Tổng trị giá {val_str} VND."
+        notification_title = f"🐋 Cá mập hành động trên {symbol}!"
+        val_str = f"{total_val/1_000_000_000:,.2f} tỷ" if total_val >= 1_000_000_000 else f"{total_val/1_000_000:,.0f} triệu"
+        notification_body = f"Giao dịch khớp lệnh {quantity:,.0f} CP giá {price:,.0f}. Tổng trị giá {val_str} VND."
 
+        try:
             message = messaging.Message(
                 notification=messaging.Notification(
                     title=notification_title,
@@ -332,14 +520,10 @@ def publish_social_feed(db, trade: dict, r_client=None):
                     "value": str(total_val)
                 }
             )
-            try:
-                response = messaging.send(message)
-                print('✅ FCM Sent:', response)
-            except Exception as fcm_error:
-                print('❌ FCM Error:', fcm_error)
-
-    except Exception as e:
-        print(f"Error publishing social feed: {e}")
+            response = messaging.send(message)
+            print('✅ FCM Sent:', response)
+        except Exception as fcm_error:
+            print('❌ FCM Error:', fcm_error)
 
 from contextlib import asynccontextmanager
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -361,6 +545,15 @@ except Exception as e:
     print(f"❌ Lỗi khởi tạo Redis: {e}")
     r = None
 
+# One async Pub/Sub subscriber per process, fanned out to every /ws/stocks client
+feed_hub = FeedHub(REDIS_URL)
+
+# Account ledger (holds, positions, unflushed cash) lives in Redis, shared by every worker
+ledger = AccountLedger(load_account, r)
+
+# Book-stream state + dirty symbols (coalesced order book broadcasts), in Redis as well
+published_books = PublishedBooks(r)
+
 class ActivityTrackerMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         # 1. Track User Activity
@@ -379,14 +572,14 @@ async def lifespan(app: FastAPI):
     
     # Startup
     try:
-        if r:
-            print("⚠️ [CLEANUP] Flushing Redis (User Request: Clean All)...")
-            r.flushdb()
-            print("✅ Redis Flushed.")
+        if r and FLUSH_REDIS_ON_STARTUP:
+            await asyncio.to_thread(flush_on_startup)
             
-        print("   -> Hydrating Engine (Skipped after flush)...")
-        # await asyncio.to_thread(hydrate_engine)
-        # print("   -> Engine Hydrated.")
+        print("   -> Hydrating Engine (Snapshot + Journal Tail)...")
+        await asyncio.to_thread(hydrate_engine)
+        print("   -> Engine Hydrated.")
+        if r:
+            await asyncio.to_thread(order_state.sync_active_symbols, r) # Once, instead of a scan per refresh round
     except Exception as e:
         print(f"   ❌ Engine Hydration Failed: {e}")
 
@@ -402,6 +595,14 @@ async def lifespan(app: FastAPI):
     print("   -> Starting Background Tasks...")
     asyncio.create_task(market_data_simulator())
     asyncio.create_task(alert_monitor())   # RE-ENABLED: User Request
+    if not ENGINE_SHARDS:
+        asyncio.create_task(journal_snapshot_monitor()) # Shards snapshot their own journals
+    await order_pipeline.start()
+    await match_pipeline.start()
+    intake_consumer = asyncio.create_task(order_intake_consumer()) # Replays unacked entries first
+    asyncio.create_task(ledger_reconciler())
+    asyncio.create_task(orderbook_broadcaster())
+    feed_hub.start()
     # asyncio.create_task(metrics_monitor()) # DISABLED: Save Firestore Read Quota (MVP)
     
     # Enable Maintenance Sync
@@ -417,6 +618,19 @@ async def lifespan(app: FastAPI):
     # Shutdown
     print("🛑 Server Shutting Down...")
     shutdown_event.set()
+    await order_pipeline.stop(drain=True) # Acked orders still queued get persisted + streamed first
+    await intake_consumer # Exits after its current read (<= 1s); unread entries wait in the stream
+    await match_pipeline.stop(drain=True) # Batches already read get matched + settled + acked
+    await feed_hub.stop()
+    await asyncio.to_thread(flush_ledger) # Last write-behind of held/refunded cash
+    try:
+        if ENGINE_SHARDS:
+            engine.close()
+        else:
+            engine_journal.write_snapshot(engine)
+            engine_journal.close()
+    except Exception as e:
+        print(f"⚠️ Journal Close Error: {e}")
 
 # Overwrite 'app' to bind lifespan
 app = FastAPI(lifespan=lifespan)
@@ -429,28 +643,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/api/orders")
-def place_order(order: OrderRequest):
+def normalize_order_request(order: OrderRequest):
     """
-    API Đặt lệnh (Mua/Bán) Limit/Market.
-    - Validate & Trừ tiền/lock cổ phiếu.
-    - Gửi vào Matching Engine.
-    - Xử lý kết quả khớp lệnh ngay lập tức (nếu có).
+    Normalize inputs + Price Protection.
+    Returns (symbol, side, o_type, quantity, price, fee, total_deduction).
     """
-    global IS_MAINTENANCE
-    if IS_MAINTENANCE:
-        raise HTTPException(status_code=503, detail="Hệ thống đang bảo trì. Vui lòng quay lại sau.")
-
-    if not r:
-        raise HTTPException(status_code=503, detail="Redis not connected")
-
-    order_id = str(uuid.uuid4())
-    timestamp = time.time()
-    
-    # 1. Validation & Pre-deduction (Firestore)
-    db = get_db()
-    
-    # Normalize inputs
     symbol = order.symbol.upper()
     side = OrderSide.BUY if order.side.lower() == "buy" else OrderSide.SELL
     o_type = OrderType.MARKET if order.order_type.lower() == "market" else OrderType.LIMIT
@@ -476,44 +673,13 @@ def place_order(order: OrderRequest):
     total_val = check_price * quantity
     fee = total_val * TRADING_FEE_RATE
     total_deduction = total_val + fee
+    return symbol, side, o_type, quantity, price, fee, total_deduction
 
-    if db:
-        try:
-            user_ref = db.collection("users").document(order.user_id)
-            
-            if side == OrderSide.BUY:
-                # BUY: Deduct Balance Immediately (Hold funds)
-                user_snap = user_ref.get()
-                if not user_snap.exists: raise HTTPException(status_code=404, detail="User wallet not found")
-                
-                balance = user_snap.to_dict().get("balance", 0)
-                if balance < total_deduction:
-                    raise HTTPException(status_code=400, detail=f"Insufficient funds (Req: {total_deduction:,.0f})")
-                
-                user_ref.update({"balance": firestore.Increment(-total_deduction)})
-                print(f"💰 [BUY-PRE-DEDUCT] User {order.user_id} | Qty {quantity} @ {price} | Total Deduct: {total_deduction:,.2f}")
-
-            elif side == OrderSide.SELL:
-                # SELL: Check Stocks (Ideally Lock them, here we just check)
-                holdings_ref = user_ref.collection("holdings").document(symbol)
-                h_snap = holdings_ref.get()
-                current_qty = h_snap.to_dict().get("quantity", 0) if h_snap.exists else 0
-                
-                if current_qty < quantity:
-                     raise HTTPException(status_code=400, detail=f"Not enough {symbol} shares to sell")
-                
-                # Ideally: specific field 'locked_quantity' increment
-                pass 
-
-        except HTTPException as he: raise he
-        except Exception as e:
-            print(f"DB Error: {e}")
-            raise HTTPException(status_code=500, detail="Transaction failed")
-            
-    # 2. Persist Initial Order (Pending) to Redis for UI
-    order_data = {
+def build_order_record(order_id, user_id, symbol, side, o_type, price, quantity, timestamp, fee):
+    """Redis hash 'order:{id}' for a new Pending order."""
+    return {
         "order_id": order_id,
-        "user_id": order.user_id,
+        "user_id": user_id,
         "symbol": symbol,
         "side": side.value,
         "type": o_type.value,
@@ -524,53 +690,383 @@ def place_order(order: OrderRequest):
         "timestamp": timestamp,
         "fee": fee
     }
+
+def persist_order_record(pipe, order_data: dict):
+    """Queues the Redis writes for a new Pending order on an existing pipeline."""
+    order_id = order_data["order_id"]
+    pipe.hset(f"order:{order_id}", mapping=order_data)
+    pipe.lpush(f"user_orders:{order_data['user_id']}", order_id)
+    order_state.add_pending(pipe, order_id, order_data["symbol"], order_data["side"], order_data["price"],
+                            order_data["quantity"] - order_data["filled"])
+
+class OrderJob(Job):
+    """One order travelling through the intake pipeline (validate -> persist)."""
+    def __init__(self, request: OrderRequest):
+        super().__init__()
+        self.request = request
+        self.order_id = str(uuid.uuid4())
+        self.timestamp = time.time()
+        self.normalized = None # normalize_order_request(...) tuple
+        self.deducted = 0.0 # Funds held in the ledger (released if persisting fails)
+
+class MatchJob(Job):
+    """One XREADGROUP batch of the intake stream travelling through match -> settle -> notify."""
+    def __init__(self, stream: str, entries: list):
+        super().__init__()
+        self.stream = stream
+        self.entries = entries # [(entry_id, fields)]
+        self.orders = [] # Engine Orders claimed by this batch
+        self.trades = []
+
+# --- Order Intake (Redis Streams) ---
+def order_stream_for(symbol: str) -> str:
+    if ENGINE_SHARDS:
+        return f"{ORDER_STREAM}:{shard_for(symbol, ENGINE_SHARDS)}"
+    return ORDER_STREAM
+
+def order_streams() -> list:
+    if ENGINE_SHARDS:
+        return [f"{ORDER_STREAM}:{i}" for i in range(ENGINE_SHARDS)]
+    return [ORDER_STREAM]
+
+def enqueue_order(pipe, order_data: dict):
+    """Queues XADD of the full order payload, so the consumer needs no HGETALL."""
+    fields = {k: str(v) for k, v in order_data.items() if v is not None}
+    pipe.xadd(order_stream_for(order_data["symbol"]), fields,
+              maxlen=ORDER_STREAM_MAXLEN, approximate=True)
+
+def ensure_order_groups():
+    for stream in order_streams():
+        try:
+            r.xgroup_create(stream, ORDER_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+def claim_stale_order_entries() -> list:
+    """Takes over entries a dead consumer read but never acked. Returns [(stream, entries)]."""
+    batches = []
+    for stream in order_streams():
+        start_id = "0-0"
+        while True:
+            try:
+                claimed = r.xautoclaim(stream, ORDER_GROUP, ORDER_CONSUMER, ORDER_CLAIM_IDLE_MS,
+                                       start_id=start_id, count=ORDER_READ_COUNT)
+            except redis.ResponseError as e:
+                if "NOGROUP" in str(e):
+                    raise
+                break # Server without XAUTOCLAIM
+            entries = claimed[1] if claimed else []
+            if entries:
+                print(f"♻️ [MATCHING] Re-claimed {len(entries)} unacked orders from {stream}")
+                batches.append((stream, entries))
+            start_id = claimed[0] if claimed else "0-0"
+            if start_id in ("0-0", b"0-0"):
+                break
+    return batches
+
+def replay_order_stream(from_id: str = "0"):
+    """
+    Rewinds the consumer group: entries after `from_id` are delivered again. Orders that
+    already reached the engine (or were cancelled) fail the match-stage claim and are skipped,
+    so this only places orders whose entries were lost before matching.
+    """
+    ensure_order_groups()
+    for stream in order_streams():
+        r.xgroup_setid(stream, ORDER_GROUP, id=from_id)
+
+def wait_for_engine_handoff(order_id: str):
+    """Waits (up to ORDER_CANCEL_WAIT s) while a consumer is placing this order right now."""
+    deadline = time.time() + ORDER_CANCEL_WAIT
+    while r.hget(f"order:{order_id}", "engine") == "matching" and time.time() < deadline:
+        time.sleep(0.02)
+
+def stage_validate(job: OrderJob):
+    """Stage 1: Validation & Pre-deduction (Redis ledger, Firestore written behind)."""
+    order = job.request
+    db = get_db()
+    
+    # Normalize inputs + Price Protection
+    job.normalized = symbol, side, o_type, quantity, price, fee, total_deduction = normalize_order_request(order)
+
+    if db:
+        try:
+            if side == OrderSide.BUY:
+                # BUY: Hold funds (balance decrement queued for ledger_reconciler)
+                ledger.reserve_buy(job.order_id, order.user_id, symbol, quantity, total_deduction)
+                job.deducted = total_deduction
+                print(f"💰 [BUY-PRE-DEDUCT] User {order.user_id} | Qty {quantity} @ {price} | Total Deduct: {total_deduction:,.2f}")
+
+            elif side == OrderSide.SELL:
+                # SELL: Lock shares so concurrent sells cannot oversell the holding
+                ledger.reserve_sell(job.order_id, order.user_id, symbol, quantity)
+
+        except RiskCheckError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except Exception as e:
+            print(f"DB Error: {e}")
+            raise HTTPException(status_code=500, detail="Transaction failed")
+
+def stage_persist(job: OrderJob):
+    """
+    Stage 2: Persist Initial Order (Pending) to Redis + XADD it to the intake stream, in
+    ONE pipeline. The HTTP response is sent after this; any worker's consumer matches it.
+    """
+    symbol, side, o_type, quantity, price, fee, _ = job.normalized
+    order_data = build_order_record(job.order_id, job.request.user_id, symbol, side, o_type, price, quantity, job.timestamp, fee)
+    order_data["engine"] = "queued" # See order_state: claimed by the match stage, or cancelled first
     
     try:
         pipe = r.pipeline()
-        pipe.hset(f"order:{order_id}", mapping=order_data)
-        pipe.lpush(f"user_orders:{order.user_id}", order_id)
-        pipe.sadd("pending_orders", order_id)
+        persist_order_record(pipe, order_data)
+        enqueue_order(pipe, order_data)
         pipe.execute()
     except Exception as e:
         print(f"⚠️ Redis Error (Order Persistence): {e}")
-        # We process the order in memory (Engine) anyway, but UI might not see it in 'Pending' if restart.
-        # Ideally we should fail if Redis is critical, but for now we proceed or Raise 503?
-        # If Redis is full, we probably shouldn't accept orders to avoid state drift.
+        # If Redis is full, we shouldn't accept orders to avoid state drift: give held funds/shares back.
+        ledger.release(job.order_id)
         raise HTTPException(status_code=503, detail="System busy (Storage Limit). Please try again later.")
-    
-    # 3. Submit to Matching Engine
-    engine_order = Order(
-        id=order_id,
-        user_id=order.user_id,
-        symbol=symbol,
-        side=side,
-        type=o_type,
-        price=price,
-        quantity=quantity,
-        timestamp=timestamp
-    )
-    
-    trades = engine.place_order(engine_order)
-    
-    # 4. Process Executed Trades (Settlement)
-    if trades:
-        process_executed_trades(trades)
-    
-    # 5. Broadcast OrderBook Update (Realtime)
-    broadcast_orderbook_update(symbol)
-            
+
+def stage_match(job: MatchJob):
+    """
+    Match: claims the batch's queued orders, places them in ONE engine step (stream order =
+    arrival order), then marks them booked and XACKs the batch in one round trip.
+    An order cancelled while queued, or already handed over before a redelivery, fails the
+    claim and is skipped. Left unacked on error: re-claimed after ORDER_CLAIM_IDLE_MS.
+    """
+    orders = []
+    for entry_id, fields in job.entries:
+        if not fields or not fields.get("order_id"):
+            continue # Trimmed/malformed entry: ack and drop
+        try:
+            orders.append(order_from_record(fields))
+        except Exception as e:
+            print(f"⚠️ [MATCHING] Bad order entry {entry_id}: {e}")
+
+    if orders:
+        pipe = r.pipeline()
+        for o in orders:
+            order_state.claim_order(pipe, o.id)
+        stages = pipe.execute()
+        for o, stage in zip(orders, stages):
+            if stage == "matching":
+                print(f"⚠️ [MATCHING] Order {o.id} was claimed by a consumer that died while placing it; skipped")
+        job.orders = [o for o, stage in zip(orders, stages) if stage == "queued"]
+
+    if job.orders:
+        try:
+            job.trades = [t for group in engine.place_orders(job.orders) for t in group]
+        except Exception as e:
+            print(f"❌ [MATCHING] Engine Error, rejecting {len(job.orders)} orders: {e}")
+            reject_unplaced_orders(job.orders)
+            job.orders = []
+
+    pipe = r.pipeline()
+    for o in job.orders:
+        pipe.hset(f"order:{o.id}", "engine", "booked")
+    pipe.xack(job.stream, ORDER_GROUP, *[entry_id for entry_id, _ in job.entries])
+    pipe.execute()
+
+def reject_unplaced_orders(orders: list):
+    """
+    Match-stage failure: closes the orders as 'rejected' and releases their ledger holds.
+    Whatever did reach the book (reply lost) is taken out first, so only its unfilled part
+    is released; the engine journal keeps any fills of that lost reply.
+    """
+    for o in orders:
+        remaining = None # Whole hold
+        try:
+            resting = engine.cancel_order(o.id, symbol=o.symbol)
+            if resting is not None:
+                remaining = resting.remaining_quantity
+        except Exception as e:
+            print(f"⚠️ [MATCHING] Could not check the book for {o.id}: {e}")
+        order_state.reject_order(r, o.id, o.symbol)
+        r.hset(f"order:{o.id}", "engine", "rejected")
+        ledger.release(o.id, remaining)
+
+def stage_settle(job: MatchJob):
+    """Settle: Process Executed Trades of the batch (Settlement)."""
+    if job.trades:
+        process_executed_trades(job.trades, notify=False)
+
+def stage_notify(job: MatchJob):
+    """Notify: FCM + Broadcast OrderBook Update (Realtime) for every symbol the batch touched."""
+    if job.trades:
+        notify_executed_trades(job.trades)
+    traded = {t.get("symbol") for t in job.trades}
+    for symbol in {o.symbol for o in job.orders} - traded:
+        broadcast_orderbook_update(symbol)
+
+async def order_intake_consumer():
+    """
+    Background Task: consumes the order intake stream(s) via the consumer group and feeds
+    each XREADGROUP batch to match_pipeline (acked after matching), so an order read by a
+    worker that dies is re-delivered (at-least-once). Any number of API workers consume
+    the same group. Entries a dead consumer left unacked are replayed on start-up, then
+    re-claimed every ORDER_CLAIM_IDLE_MS.
+    """
+    ready = False
+    last_claim = 0.0
+    while not shutdown_event.is_set():
+        try:
+            if not ready:
+                await asyncio.to_thread(ensure_order_groups)
+                ready = True
+
+            if time.time() - last_claim > ORDER_CLAIM_IDLE_MS / 1000:
+                last_claim = time.time()
+                for stream, entries in await asyncio.to_thread(claim_stale_order_entries):
+                    await match_pipeline.submit(MatchJob(stream, entries)) # Waits while the match queue is full
+
+            # Blocking read (1s, below the client socket timeout, to allow shutdown check)
+            response = await asyncio.to_thread(r.xreadgroup, ORDER_GROUP, ORDER_CONSUMER,
+                                               {s: ">" for s in order_streams()},
+                                               count=ORDER_READ_COUNT, block=1000)
+            for stream, entries in response or []:
+                await match_pipeline.submit(MatchJob(stream, entries))
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            if "NOGROUP" in str(e):
+                ready = False # Stream/group wiped (e.g. Redis flush): recreate
+            print(f"⚠️ [MATCHING] Intake Consumer Error: {e}")
+            await asyncio.sleep(1)
+
+order_pipeline = Pipeline("orders", [
+    Stage("validate", stage_validate, workers=8, maxsize=ORDER_QUEUE_SIZE, ack=False),
+    Stage("persist", stage_persist, workers=4, maxsize=ORDER_QUEUE_SIZE, ack=True),
+])
+
+match_pipeline = Pipeline("matching", [
+    Stage("match", stage_match, workers=1, maxsize=ORDER_QUEUE_SIZE), # Single worker = stream order preserved
+    Stage("settle", stage_settle, workers=2, maxsize=ORDER_QUEUE_SIZE),
+    Stage("notify", stage_notify, workers=2, maxsize=ORDER_QUEUE_SIZE),
+])
+
+@app.post("/api/orders")
+async def place_order(order: OrderRequest):
+    """
+    API Đặt lệnh (Mua/Bán) Limit/Market.
+    Lệnh đi qua pipeline: validate/reserve -> persist (+ XADD vào stream order_intake),
+    rồi consumer của bất kỳ worker nào: match -> settle -> notify.
+    Trả về ngay sau khi lệnh được chấp nhận và lưu (persist); khớp lệnh, thanh toán
+    và thông báo chạy tiếp ở các stage sau. Vì vậy trades_count luôn là 0 (giữ cho client
+    cũ); kết quả khớp / lệnh bị từ chối (status 'rejected') xem tại status_url.
+    """
+    if IS_MAINTENANCE:
+        raise HTTPException(status_code=503, detail="Hệ thống đang bảo trì. Vui lòng quay lại sau.")
+    if not r:
+        raise HTTPException(status_code=503, detail="Redis not connected")
+
+    job = OrderJob(order)
+    try:
+        accepted = await order_pipeline.submit(job, timeout=ORDER_ACCEPT_TIMEOUT)
+    except PipelineBusy:
+        raise HTTPException(status_code=503, detail="System busy. Please try again later.")
+    await accepted # Raises the validate/persist HTTPException, if any
+
+    symbol, _, _, quantity, price, _, _ = job.normalized
     return {
         "status": "success",
         "message": "Order placed successfully",
         "data": {
-            "order_id": order_id, 
-            "trades_count": len(trades),
+            "order_id": job.order_id, 
+            "trades_count": 0, # Always 0: matching runs after the response (see status_url)
+             "status_url": order_status_url(order.user_id, job.order_id),
              "symbol": symbol,
              "side": order.side,
              "price": price,
              "quantity": quantity
         }
     }
+
+def order_status_url(user_id: str, order_id: str) -> str:
+    return f"/api/orders/{user_id}/{order_id}"
+
+@app.get("/api/metrics/order_pipeline")
+def get_order_pipeline_metrics():
+    """Per-stage queue depth, throughput and wait/service latency histograms (+ risk cache size)."""
+    return order_pipeline.stats() | {"matching": match_pipeline.stats(), "ledger": ledger.stats()}
+
+MAX_BATCH_ORDERS = 500
+
+class BatchOrderRequest(BaseModel):
+    orders: list[OrderRequest]
+
+@app.post("/api/orders/batch")
+async def place_orders_batch(req: BatchOrderRequest):
+    """
+    API Đặt lệnh hàng loạt (Bulk) cho bot thanh khoản / test loader.
+    - Từng lệnh đi qua cùng order_pipeline với POST /api/orders (validate/reserve trên
+      ledger Redis -> persist + XADD), theo thứ tự trong lô và cùng backpressure.
+    - Trả về khi cả lô đã được chấp nhận / lưu; khớp lệnh chạy sau ở consumer của stream,
+      nên trades_count luôn là 0 (kết quả từng lệnh xem tại status_url).
+    Lệnh không hợp lệ bị từ chối riêng lẻ (status "rejected"), không làm hỏng cả lô.
+    Khi pipeline đầy, phần còn lại của lô bị từ chối ("System busy").
+    """
+    if IS_MAINTENANCE:
+        raise HTTPException(status_code=503, detail="Hệ thống đang bảo trì. Vui lòng quay lại sau.")
+    if not r:
+        raise HTTPException(status_code=503, detail="Redis not connected")
+    if not req.orders:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(req.orders) > MAX_BATCH_ORDERS:
+        raise HTTPException(status_code=400, detail=f"Batch too large (max {MAX_BATCH_ORDERS} orders)")
+
+    results = [None] * len(req.orders)
+
+    def reject(i, detail):
+        results[i] = {"index": i, "status": "rejected", "detail": detail}
+
+    # 1. Submit in batch order (validate + persist run in the pipeline workers)
+    submitted = []
+    busy = False
+    for i, o in enumerate(req.orders):
+        if o.quantity <= 0:
+            reject(i, "Quantity must be > 0"); continue
+        if o.price < 0:
+            reject(i, "Price must be positive"); continue
+        if busy:
+            reject(i, "System busy. Please try again later."); continue
+        job = OrderJob(o)
+        try:
+            submitted.append((i, o, job, await order_pipeline.submit(job, timeout=ORDER_ACCEPT_TIMEOUT)))
+        except PipelineBusy:
+            busy = True # Don't wait ORDER_ACCEPT_TIMEOUT again for every remaining order
+            reject(i, "System busy. Please try again later.")
+
+    # 2. Wait for each order to be accepted (persisted) or rejected
+    outcomes = await asyncio.gather(*(accepted for *_, accepted in submitted), return_exceptions=True)
+    for (i, o, job, _), outcome in zip(submitted, outcomes):
+        if isinstance(outcome, HTTPException):
+            reject(i, outcome.detail); continue
+        if isinstance(outcome, Exception):
+            reject(i, str(outcome)); continue
+        symbol, _, _, quantity, price, _, _ = job.normalized
+        results[i] = {
+            "index": i,
+            "status": "accepted",
+            "order_id": job.order_id,
+            "symbol": symbol,
+            "side": o.side,
+            "price": price,
+            "quantity": quantity,
+            "status_url": order_status_url(o.user_id, job.order_id)
+        }
+
+    accepted_count = sum(1 for res in results if res["status"] == "accepted")
+    return {
+        "status": "success",
+        "message": f"{accepted_count}/{len(req.orders)} orders placed",
+        "data": {
+            "accepted": accepted_count,
+            "rejected": len(req.orders) - accepted_count,
+            "trades_count": 0, # Always 0: matching runs after the response (see status_url)
+            "orders": results
+        }
+    }
+
 # [CLEANUP] Removed duplicate imports and app definition
 
 # --- CONFIGURATION ---
@@ -589,103 +1085,75 @@ def get_requests_session():
 
 # --- REAL DATA FETCHING ONLY ---
 
-async def fetch_real_price(symbol: str):
-    """Hàm lấy giá thực tế từ nguồn (Vnstock/Yfinance). Tuyệt đối không Mock."""
-    global RATE_LIMIT_UNTIL # Declare global scope first!
-    
-    # Guard: Cooldown Active?
-    if time.time() < RATE_LIMIT_UNTIL:
-        return None
-
-    try:
-        price = 0.0
-        volume = 0
-        change_percent = 0.0
-        
-        # 1. VN Stock
-        # 1. VN Stock
-        if len(symbol) == 3 and symbol.isalpha():
-            def get_vn_price():
-                try:
-                    # Hybrid Strategy: Intraday (Price) + History (Reference)
-                    try:
-                        stock = Vnstock().stock(symbol=symbol, source='VCI')
-                        
-                        # 1. Get Realtime Price (Intraday)
-                        df_now = stock.quote.intraday(page_size=1)
-                        local_price = 0.0
-                        local_volume = 0
-                        if df_now is not None and not df_now.empty:
-                            row = df_now.iloc[0]
-                            local_price = float(row.get('price', 0))
-                            local_volume = int(row.get('volume', 0))
-                        
-                        if local_price == 0: return None
-                        
-                        # Fix Scaling (Crucial for HPG: 26.4 -> 26400)
-                        if local_price < 500: local_price *= 1000
-                        
-                        return (local_price, local_volume, 0.0) # change_percent calc later
-                    except BaseException as e: # Catch SystemExit and Rate Limits
-                        print(f"⚠️ Vnstock Error/RateLimit: {e}")
-                        RATE_LIMIT_UNTIL = time.time() + 300 # 5 minutes cooling
-                        return None
-
-                except Exception as e:
-                    print(f"⚠️ get_vn_price logic error: {e}")
-                    return None
-            try:
-                result = await asyncio.wait_for(asyncio.to_thread(get_vn_price), timeout=5.0) # Increased timeout
-                if result:
-                    price, volume, change_percent = result
-                else: 
-                     return None
-            except: 
-                # Trigger Backoff if Timeout or Error happens
-                RATE_LIMIT_UNTIL = time.time() + 60 # 1 minute cooling for Timeout
-                return None
-
-        # 2. US/Crypto (Yfinance)
-        else:
-            def get_yf_price():
-                try:
-                     # Use Ticker.fast_info which is usually reliable
-                     # NOTE: Removed custom session as recent yfinance prefers internal handling or curl_cffi
-                    ticker = yf.Ticker(symbol) 
-                    info = ticker.fast_info
-                    p = info.last_price
-                    prev_close = info.previous_close
-                    volume = int(info.last_volume) if info.last_volume else 0
-                    change = ((p - prev_close) / prev_close) * 100 if prev_close else 0.0
-                    
-                    # CONVERT TO VND (Unified Base Currency)
-                    # Assuming YF returns USD for these symbols.
-                    # TODO: Check currency in info if possible, but for MVP assuming USD.
-                    p_vnd = p * USD_VND_RATE
-                    
-                    return p_vnd, volume, change
-                except Exception as e:
-                    # print(f"YF Price Error {symbol}: {e}")
-                    return None
+# Providers + per-class fallback routes live in market_data (MARKET_DATA_MODE=replay for offline runs)
+market_data = build_market_data()
+ohlcv_store = OHLCVStore(OHLCV_DIR if MARKET_DATA_MODE != "replay" else OHLCV_DIR + "-replay") # Keep replayed bars apart
+
+# One token bucket + circuit breaker per upstream: a throttled source only pauses itself
+QUOTE_LIMITS = {
+    "VCI": dict(rate=1.0, burst=3, timeout=5.0, rate_limit_cooldown=300),
+    "yfinance": dict(rate=2.0, burst=5, timeout=3.0),
+    "stooq": dict(rate=0.5, burst=2, timeout=10.0),
+    "replay": dict(rate=1000.0, burst=1000, timeout=1.0),
+}
+QUOTE_SOURCES = {
+    p.name: QuoteSource(p.name, p.quote, batch_fn=p.quotes if p.batch else None,
+                        **QUOTE_LIMITS.get(p.name, QUOTE_LIMITS["yfinance"]))
+    for p in market_data.providers
+}
+
+def quote_route(symbol: str) -> list:
+    return [QUOTE_SOURCES[p.name] for p in market_data.route(symbol)]
+
+quote_refresher = QuoteRefresher(list(QUOTE_SOURCES.values()), quote_route, concurrency=8)
+refresh_scheduler = RefreshScheduler(quote_refresher)
+ALERT_SYMBOLS = {} # symbol -> active alerts, refreshed by each alert_monitor pass
+
+def collect_interest() -> dict:
+    """symbol -> interest weight from WS subscriptions, open orders, alerts and holdings."""
+    interest = {}
+
+    def add(symbol, weight):
+        if symbol:
+            symbol = symbol.upper()
+            interest[symbol] = interest.get(symbol, 0.0) + weight
+
+    if active_connections > 0:
+        for symbol in BASELINE_SYMBOLS:
+            add(symbol, INTEREST_WEIGHTS["baseline"])
+    for index in (feed_hub.by_symbol, feed_hub.by_book):
+        for symbol, subs in list(index.items()):
+            add(symbol, INTEREST_WEIGHTS["ws"] * len(subs))
+    for symbol, count in list(ALERT_SYMBOLS.items()):
+        add(symbol, INTEREST_WEIGHTS["alert"] * count)
+    if r:
+        try:
+            for symbol, holders in ledger.held_symbols().items():
+                add(symbol, INTEREST_WEIGHTS["holding"] * holders)
+        except Exception as e:
+            print(f"⚠️ Interest holdings error: {e}")
+        try:
+            # Non-empty price levels = resting orders (from any process, incl. the market maker)
+            for symbol in order_state.active_symbols(r):
+                add(symbol, INTEREST_WEIGHTS["order"])
+        except Exception as e:
+            print(f"⚠️ Interest orders error: {e}")
+    return interest
 
-            try:
-                result = await asyncio.wait_for(asyncio.to_thread(get_yf_price), timeout=3.0)
-                if result:
-                     price, volume, change_percent = result
-                else:
-                     return None
-            except: return None
+def quote_payload(symbol: str, result: Quote) -> dict:
+    price = result.price * USD_VND_RATE if result.currency == "USD" else result.price # Unified base currency
+    return {
+        "symbol": symbol,
+        "price": round(price, 0), # VND usually 0 decimals
+        "change_percent": round(result.change_percent, 2),
+        "volume": result.volume,
+        "timestamp": datetime.now().isoformat()
+    }
 
-        return {
-            "symbol": symbol,
-            "price": round(price, 0), # VND usually 0 decimals
-            "change_percent": round(change_percent, 2),
-            "volume": volume,
-            "timestamp": datetime.now().isoformat()
-        }
-    except Exception as e:
-        print(f"Lỗi lấy giá {symbol}: {e}")
-        return None
+async def fetch_real_price(symbol: str):
+    """Hàm lấy giá thực tế từ nguồn (Vnstock/Yfinance/Stooq). Tuyệt đối không Mock."""
+    result = await quote_refresher.fetch(symbol)
+    return quote_payload(symbol, result) if result else None
 
 async def market_data_simulator():
     """
@@ -693,36 +1161,27 @@ async def market_data_simulator():
     Renamed to 'market_data_updater' conceptually, but keeping function name for compatibility if needed.
     """
     print("🚀 Bắt đầu service cập nhật giá REALTIME...")
-    symbols = ["HPG", "VCB", "FPT", "AAPL", "BTC-USD", "GOOG"]
-    
-    # --- Smart Backoff State ---
-    global RATE_LIMIT_UNTIL
     
     while not shutdown_event.is_set():
         try:
-            # Check Backoff
-            if time.time() < RATE_LIMIT_UNTIL:
-                 remaining = int(RATE_LIMIT_UNTIL - time.time())
-                 if remaining % 30 == 0: # Log only occasionally
-                     print(f"⏳ Rate Limit Cooldown: Pausing updates for {remaining}s...")
-                 await asyncio.sleep(10)
-                 continue
-
-            # Chỉ chạy khi có kết nối
-            if r and active_connections > 0:
-                updates = []
-                for symbol in symbols:
-                    if shutdown_event.is_set(): break
-                    real_data = await fetch_real_price(symbol)
-                    
-                    if real_data:
-                        await asyncio.to_thread(r.set, f"stock:{symbol}", json.dumps(real_data))
-                        await asyncio.to_thread(r.publish, "stock_updates", json.dumps(real_data))
-                        updates.append(real_data)
+            # Refresh what is being watched / traded / alerted on, stalest x most-watched first
+            if r:
+                refresh_scheduler.set_interest(await asyncio.to_thread(collect_interest))
+            if r and refresh_scheduler.interest:
+                # Concurrent within the round; each source rate-limited / circuit-broken on its own
+                results = await refresh_scheduler.run_round()
+                if results:
+                    pipe = r.pipeline(transaction=False)
+                    for symbol, result in results.items():
+                        payload = json.dumps(quote_payload(symbol, result))
+                        pipe.set(f"stock:{symbol}", payload)
+                        for channel in feed_channels(symbol): # + legacy 'stock_updates' subscribers
+                            pipe.publish(channel, payload)
+                    await asyncio.to_thread(pipe.execute)
                 
-                await asyncio.sleep(30) # Reduce frequency to respect Rate Limits (Active Users)
+                await asyncio.sleep(QUOTE_REFRESH_INTERVAL) # Round budget per source keeps us under the rate limits
             else:
-                await asyncio.sleep(60) # Idle Mode (No active users)
+                await asyncio.sleep(QUOTE_IDLE_INTERVAL) # Idle Mode (nothing watched)
         except asyncio.CancelledError:
             print("🛑 Service cập nhật giá đã dừng.")
             break
@@ -742,6 +1201,7 @@ async def alert_monitor():
     from firebase_admin import messaging
 
     def check_alerts_sync():
+        global ALERT_SYMBOLS
         try:
             db = get_db()
             if not db or not r: return
@@ -749,6 +1209,7 @@ async def alert_monitor():
             # 1. Fetch all alerts (Blocking I/O)
             # Optimization: Use a query if index exists, else stream
             alerts_stream = db.collection_group("alerts").stream()
+            alert_symbols = {}
             
             # Convert to list to iterate quickly? Or iterate stream
             # Iterating stream involves I/O
@@ -765,6 +1226,7 @@ async def alert_monitor():
                 user_id = alert_data.get("user_id")
                 
                 if not symbol or not target_price or not user_id: continue
+                alert_symbols[symbol] = alert_symbols.get(symbol, 0) + 1 # Drives quote refresh interest
                 
                 # 2. Get Price from Redis (Blocking I/O - insignificant for local/upstash)
                 market_data_json = r.get(f"stock:{symbol}")
@@ -809,6 +1271,7 @@ async def alert_monitor():
                                  print(f"   ⚠️ No FCM Token for user {user_id}")
                      except Exception as fcm_error:
                          print(f"   ❌ FCM Send Error: {fcm_error}")
+            ALERT_SYMBOLS = alert_symbols # Full pass only (a partial one would drop interest)
         except Exception as e:
             print(f"⚠️ Alert Monitor Error: {e}")
 
@@ -882,7 +1345,6 @@ async def update_leaderboard_logic():
 
 
 IS_MAINTENANCE = False
-RATE_LIMIT_UNTIL = 0
 
 
 async def maintenance_monitor():
@@ -904,43 +1366,98 @@ async def maintenance_monitor():
 
 # --- WEBSOCKET ENDPOINT ---
 @app.websocket("/ws/stocks")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, encoding: str = "json", policy: str = None):
+    """
+    Realtime feed. ?encoding=msgpack cho frame nhị phân (MessagePack), mặc định JSON text.
+    ?policy=conflate|drop_oldest|disconnect: xử lý khi client chậm (mặc định FEED_SLOW_POLICY).
+    """
     global active_connections
     await websocket.accept()
     active_connections += 1
     print(f"🔌 Client kết nối. Tổng: {active_connections}")
     
-    # Tạo một kết nối Redis riêng cho Pub/Sub (Redis yêu cầu)
-    pubsub = r.pubsub()
-    await asyncio.to_thread(pubsub.subscribe, "stock_updates")
-    
-    try:
-        # Sử dụng vòng lặp non-blocking thay vì pubsub.listen() (blocking)
+    # Nhận tin từ subscriber dùng chung của process (không mở kết nối Redis riêng)
+    peer = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else ""
+    client = feed_hub.register(encoding, policy, peer)
+
+    async def sender():
+        # Chờ dữ liệu của client (không polling / sleep); chỉ gửi bản mới nhất mỗi mã
         while True:
-            # get_message là non-blocking, trả về None nếu không có tin nhắn
-            message = pubsub.get_message(ignore_subscribe_messages=True)
-            
-            if message:
-                if message["type"] == "message":
-                    # Gửi dữ liệu JSON xuống Flutter
-                    await websocket.send_text(message["data"])
+            for msg in await client.drain():
+                # Gửi xuống Flutter (JSON text hoặc MessagePack, đã mã hóa sẵn 1 lần cho mọi client)
+                await client.send(websocket, msg)
+
+    async def receiver():
+        # Giao thức đăng ký: {"action": "subscribe" | "unsubscribe", "symbols": [...]}
+        while True:
+            try:
+                msg = json.loads(await websocket.receive_text())
+                action = msg.get("action")
+                symbols = [str(s).upper() for s in msg.get("symbols", [])]
+            except (ValueError, AttributeError, TypeError):
+                continue
+            if action == "subscribe":
+                current = feed_hub.subscribe(client, symbols)
+            elif action == "unsubscribe":
+                current = feed_hub.unsubscribe(client, symbols)
+            elif action == "subscribe_book":
+                # Snapshot (20 mức giá) rồi chỉ gửi phần thay đổi (BOOK_DIFF)
+                for s in symbols:
+                    try:
+                        state = await asyncio.to_thread(published_book, s) # Seeded once (engine call)
+                    except Exception as e:
+                        print(f"OrderBook Calc Error: {e}")
+                        continue
+                    # State and PUBLISH move together (Lua): diffs up to its seq were published
+                    # before the read (skipped by the hub), later ones chain on from it
+                    feed_hub.subscribe_book(client, s, FeedMessage.from_data(book_snapshot_message(s, state)))
+                    # A diff fanned out while we read went past this client: resend the newer book
+                    try:
+                        latest = await asyncio.to_thread(published_book, s)
+                    except Exception:
+                        continue # Gap detected client-side (prev_seq) -> REST snapshot
+                    if latest[0] != state[0]:
+                        client.offer_book(s, FeedMessage.from_data(book_snapshot_message(s, latest)))
+                current = sorted(client.symbols) if client.symbols is not None else []
+            elif action == "unsubscribe_book":
+                for s in symbols:
+                    feed_hub.unsubscribe_book(client, s)
+                current = sorted(client.symbols) if client.symbols is not None else []
             else:
-                # Quan trọng: sleep để nhường CPU cho các task khác (như API history)
-                await asyncio.sleep(0.1)
+                continue
+            client.offer(("", "SUBSCRIPTIONS"), FeedMessage.from_data(
+                {"type": "SUBSCRIPTIONS", "symbols": current, "books": sorted(client.books), "encoding": client.encoding}))
+
+    tasks = [asyncio.create_task(sender()), asyncio.create_task(receiver())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            t.result() # Re-raise the disconnect / send error
                 
     except WebSocketDisconnect:
         active_connections -= 1
         print(f"🔌 Client ngắt kết nối. Tổng: {active_connections}")
+    except SlowConsumer as e:
+        active_connections -= 1
+        feed_hub.slow_disconnects += 1
+        print(f"🐢 Client chậm bị ngắt ({peer}): {e}")
+        try:
+            await websocket.close(code=1013) # Try Again Later
+        except Exception:
+            pass
     except Exception as e:
         active_connections -= 1
         print(f"⚠️ Lỗi WebSocket: {e}")
         
     finally:
-        try:
-            pubsub.unsubscribe()
-            pubsub.close()
-        except:
-            pass
+        for t in tasks:
+            t.cancel()
+        feed_hub.unregister(client)
+
+@app.get("/api/metrics/ws")
+async def get_ws_metrics():
+    """WebSocket feed: totals + per-connection lag, buffer and send latency (worst lag first)."""
+    return feed_hub.stats() | {"connections": feed_hub.connection_stats()}
 
 @app.get("/")
 def read_root():
@@ -957,7 +1474,11 @@ def read_root():
         "project": "Stock App Graduation Project",
         "redis_status": redis_status,
         "docs_url": "http://localhost:8000/docs",
-        "rate_limit_cooldown_seconds": max(0, int(RATE_LIMIT_UNTIL - time.time()))
+        "rate_limit_cooldown_seconds": quote_refresher.cooldown_seconds(),
+        "quote_sources": quote_refresher.stats(),
+        "market_data": market_data.stats(),
+        "quote_scheduler": refresh_scheduler.stats(),
+        "ohlcv_store": ohlcv_store.stats()
     }
 
 @app.get("/test-redis")
@@ -1031,103 +1552,6 @@ def generate_mock_history(symbol: str, start_date: str, end_date: str, resolutio
         if resolution != "1D":
              time_str = current.strftime("%Y-%m-%d %H:%M:%S")
 
-def fetch_from_stooq(symbol: str, start_date: str, end_date: str):
-    """Fallback: Fetch data from Stooq (CSV)"""
-    try:
-        # e.g., AAPL.US for Stooq
-        stooq_symbol = f"{symbol.lower()}.us"
-        url = f"https://stooq.com/q/d/l/?s={stooq_symbol}&i=d"
-        
-        print(f"   -> [Stooq] Downloading {stooq_symbol}...")
-        resp = requests.get(url, timeout=10)
-        if resp.status_code != 200: return None
-        
-        from io import StringIO
-        df = pd.read_csv(StringIO(resp.text))
-        
-        # Stooq CSV cols: Date, Open, High, Low, Close, Volume
-        if df.empty or "Date" not in df.columns: return None
-        
-        # Rename lower
-        df.columns = [c.lower() for c in df.columns] 
-        # map date -> time
-        df = df.rename(columns={"date": "time"})
-        
-        # Sort by time
-        df["time"] = pd.to_datetime(df["time"])
-        df = df.sort_values("time")
-        
-        # Filter range
-        s_ts = pd.Timestamp(start_date)
-        e_ts = pd.Timestamp(end_date)
-        df = df[(df["time"] >= s_ts) & (df["time"] <= e_ts)]
-        
-        df["time"] = df["time"].astype(str) # Convert back to string for JSON
-        
-        # Ensure cols
-        required = ['time', 'open', 'high', 'low', 'close', 'volume']
-        if not set(required).issubset(df.columns): return None
-        
-        return json.loads(df[required].to_json(orient="records"))
-    except Exception as e:
-        print(f"   -> [Stooq] Error: {e}")
-        return None
-
-def fetch_stock_history_yfinance(symbol: str, start_date: str, end_date: str, resolution: str):
-    """
-    Lấy dữ liệu lịch sử từ Yfinance (Standard Mode) + Fallback Stooq.
-    """
-    # 1. Try YFinance (No Session - Let YF handle it)
-    try:
-        # Map resolution
-        interval_map = {
-            '1D': '1d', '1W': '1wk', '1M': '1mo',
-            '1m': '1m', '5m': '5m', '15m': '15m', '30m': '30m', '1H': '60m'
-        }
-        interval = interval_map.get(resolution, '1d')
-        
-        yf_symbol = symbol
-        if len(symbol) == 3 and symbol.isalpha():
-             yf_symbol = f"{symbol}.VN"
-
-        print(f"   -> [YFinance] Downloading {yf_symbol}...")
-        
-        # Remove session argument to fix "requires curl_cffi" error
-        ticker = yf.Ticker(yf_symbol) 
-        
-        df = ticker.history(start=start_date, end=end_date, interval=interval, auto_adjust=True)
-
-        if not df.empty:
-            df = df.reset_index()
-            # Rename columns to match expected format
-            df.columns = [c.lower() for c in df.columns]
-            rename_map = {
-                "date": "time", "datetime": "time",
-                "stock splits": "splits"
-            }
-            df = df.rename(columns=rename_map)
-            
-            # Ensure 'time' column is string
-            if 'time' in df.columns:
-                 df['time'] = df['time'].astype(str)
-                 
-                 required = ['time', 'open', 'high', 'low', 'close', 'volume']
-                 if 'close' in df.columns:
-                    for col in required:
-                        if col not in df.columns: df[col] = 0
-                    return json.loads(df[required].to_json(orient="records"))
-        
-        print(f"   -> [YFinance] No data found for {yf_symbol}. Trying Stooq...")
-        
-    except Exception as e:
-        print(f"   -> [YFinance] Error downloading {symbol}: {e}")
-
-    # 2. Fallback to Stooq (US Stocks only generally)
-    if not (len(symbol) == 3 and symbol.isalpha()):
-        return fetch_from_stooq(symbol, start_date, end_date)
-        
-    return None
-
 @app.get("/api/history")
 async def get_stock_history(symbol: str, start_date: str, end_date: str, resolution: str = "1D", period: str = None):
     """
@@ -1135,75 +1559,36 @@ async def get_stock_history(symbol: str, start_date: str, end_date: str, resolut
     """
     print(f"📥 [API] Received history request for: '{symbol}'")
     symbol = symbol.strip().upper()
+    # Both end up in store file paths: whitelist them
+    if resolution not in YFinanceProvider.INTERVALS:
+        raise HTTPException(status_code=400, detail=f"Unsupported resolution '{resolution}'")
+    if not SYMBOL_PATTERN.match(symbol):
+        raise HTTPException(status_code=400, detail="Invalid symbol")
     
-    # 0. Check Redis Cache
-    cache_key = f"acc8_hist:{symbol}:{start_date}:{end_date}:{resolution}"
+    # 0. Date ranges the local store does not cover yet
     try:
-        if r:
-            cached_data = await asyncio.to_thread(r.get, cache_key)
-            if cached_data:
-                print(f"✅ [Cache] Hit for {cache_key}")
-                return json.loads(cached_data)
-    except Exception as e:
-        print(f"⚠️ Cache Error: {e}")
-
-    # 1. Priorities: VNStock for VN, YFinance for everything else
-    
-    # VN Stock Logic
-    if len(symbol) == 3 and symbol.isalpha():
-         def fetch_vn():
-             try:
-                 print(f"      -> [Vnstock-VCI] Fetching {symbol}...")
-                 stock = Vnstock().stock(symbol=symbol, source='VCI')
-                 print(f"      -> [Vnstock-VCI] Got stock object, requesting history...")
-                 
-                 # NOTE: 'history' call can block
-                 df = stock.quote.history(start=start_date, end=end_date, interval=resolution)
-                 
-                 print(f"      -> [Vnstock-VCI] History fetched. Rows: {len(df) if df is not None else 0}")
-                 
-                 if df is not None and not df.empty:
-                     if 'time' in df.columns: df['time'] = df['time'].astype(str)
-                     
-                     # Check if scaling is needed (based on last close)
-                     if not df.empty and 'close' in df.columns and df.iloc[-1]['close'] < 500:
-                         cols = ['open', 'high', 'low', 'close']
-                         for c in cols:
-                             if c in df.columns: df[c] = df[c] * 1000
-                             
-                     return json.loads(df.to_json(orient="records"))
-                 return None
-             except Exception as e:
-                 print(f"      -> [Vnstock Error] {e}") 
-                 return None
-         
-         try:
-             # Timeout after 8 seconds to allow Fallback to YFinance
-             data = await asyncio.wait_for(asyncio.to_thread(fetch_vn), timeout=8.0)
-         except asyncio.TimeoutError:
-             print("      -> [Vnstock] Timeout! Switching to Fallback...")
-             data = None
-         if data: 
-             result = {"symbol": symbol, "source": "Vnstock", "data": data}
-             # Cache Result
-             if r:
-                 # TTL: 1h for old data, 1m for active day
-                 ttl = 60 if resolution in ["1m", "5m", "15m", "1H"] else 300 
-                 await asyncio.to_thread(r.setex, cache_key, ttl, json.dumps(result))
-             return result
-         # Fallback to YFinance if Vnstock fails
-         
-    # YFinance Logic (Universal Fallback)
-    try:
-        data = await asyncio.to_thread(fetch_stock_history_yfinance, symbol, start_date, end_date, resolution)
-        if data:
-            result = {"symbol": symbol, "source": "YFinance", "data": data}
-            if r:
-                ttl = 60 if resolution in ["1m", "5m", "15m", "30m", "1H"] else 300
-                await asyncio.to_thread(r.setex, cache_key, ttl, json.dumps(result))
-            return result
-    except Exception as e:
-        print(f"❌ [API Error] YFinance Fallback Failed: {e}")
+        gaps = await asyncio.to_thread(ohlcv_store.gaps, symbol, resolution, start_date, end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+
+    # 1. Fetch only the gaps (VN: Vnstock -> YFinance .VN, US: YFinance -> Stooq, hedged)
+    async def fetch_gap(gap_start, gap_end):
+        # +1 day: YFinance treats `end` as exclusive
+        upstream_end = (datetime.strptime(gap_end, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        source, bars = await market_data.history(symbol, gap_start, upstream_end, resolution)
+        if source is not None: # Answered (possibly no bars: weekend/holiday) -> gap is covered
+            await asyncio.to_thread(ohlcv_store.write, symbol, resolution, bars, gap_start, gap_end)
+        return source if bars else None
+
+    sources = []
+    if gaps:
+        print(f"   -> [Store] {symbol} {resolution}: fetching {len(gaps)} gap(s) {gaps}")
+        sources = [s for s in await asyncio.gather(*(fetch_gap(a, b) for a, b in gaps)) if s]
+
+    # 2. Serve the requested range from the local store
+    data = await asyncio.to_thread(ohlcv_store.read, symbol, resolution, start_date, end_date)
+    if data:
+        return {"symbol": symbol, "source": "+".join(dict.fromkeys(sources)) or "Store", "data": data}
 
     # FAILED -> Return Empty, NO FAKE DATA
     print(f"❌ [History] Failed to fetch data for {symbol}. Returning empty.")
@@ -1214,52 +1599,38 @@ async def get_market_indices():
     """
     Get Real Market Indices (VN-Index, S&P 500, BTC, etc.)
     """
-    indices = []
-    
-    # 1. VN-Index (from vnstock or simple history fallback)
-    try:
-        # VN-Index symbol is usually 'VNINDEX' or similar in local APIs
-        # Quick hack: Fetch via yfinance for "^VNINDEX" might work or fallback to hardcoded if API unavailable
-        # Actually Vnstock provides market data.
-        
-        # Let's use YFinance for consistency and speed in MVP for Global Indices
-        # VNINDEX on Yahoo is '^VNINDEX' ? Checked: It's '^VNINDEX'
-        
-        tickers = {
-            "VN-Index": "^VNINDEX", 
-            "S&P 500": "^GSPC", 
-            "Bitcoin": "BTC-USD", 
-            "Gold": "GC=F",
-            "Crude Oil": "CL=F"
-        }
-        
-        for name, symbol in tickers.items():
-            try:
-                # Use YFinance
-                tick = yf.Ticker(symbol)
-                # Fast fetch of 'fast_info' or 'history' (1d)
-                # fast_info is better but sometimes missing. History is safer.
-                hist = tick.history(period="2d")
-                
-                if not hist.empty and len(hist) >= 1:
-                    current = hist['Close'].iloc[-1]
-                    prev = hist['Close'].iloc[-2] if len(hist) >= 2 else hist['Open'].iloc[-1]
-                    change = current - prev
-                    percent = (change / prev) * 100
-                    
-                    indices.append({
-                        "name": name,
-                        "price": current,
-                        "change": change,
-                        "percent": percent,
-                        "isPositive": change >= 0
-                    })
-            except Exception as e:
-                print(f"Index Fetch Error ({name}): {e}")
-                
-    except Exception as e:
-        print(f"Market Indices Error: {e}")
-        
+    tickers = {
+        "VN-Index": "^VNINDEX",
+        "S&P 500": "^GSPC",
+        "Bitcoin": "BTC-USD",
+        "Gold": "GC=F",
+        "Crude Oil": "CL=F"
+    }
+    end = datetime.now()
+    start = (end - timedelta(days=7)).strftime("%Y-%m-%d") # Covers weekends/holidays for the last 2 closes
+    end = (end + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    async def one(name, symbol):
+        try:
+            _, bars = await market_data.history(symbol, start, end, "1D")
+            if not bars:
+                return None
+            current = bars[-1]["close"]
+            prev = bars[-2]["close"] if len(bars) >= 2 else bars[-1]["open"]
+            change = current - prev
+            return {
+                "name": name,
+                "price": current,
+                "change": change,
+                "percent": (change / prev) * 100,
+                "isPositive": change >= 0
+            }
+        except Exception as e:
+            print(f"Index Fetch Error ({name}): {e}")
+            return None
+
+    results = await asyncio.gather(*(one(name, symbol) for name, symbol in tickers.items()))
+    indices = [i for i in results if i]
     return {"data": indices}
 
 @app.get("/api/company/overview")
@@ -1313,99 +1684,6 @@ class OrderRequest(BaseModel):
     price: float
     order_type: str = "limit" # "limit" or "market"
 
-# Restored place_order
-@app.post("/api/orders")
-async def place_order(order: OrderRequest):
-    """
-    Đặt lệnh mới (Limit/Market).
-    """
-    # 0. Check Maintenance Mode
-    if IS_MAINTENANCE:
-        raise HTTPException(status_code=503, detail="System is under maintenance. Trading is disabled.")
-
-    if not r:
-        raise HTTPException(status_code=503, detail="Redis unavailable")
-        
-    try:
-        # 1. Validation
-        if order.quantity <= 0:
-            raise HTTPException(status_code=400, detail="Quantity must be > 0")
-        if order.price < 0: # Market order might represent price as 0?
-            raise HTTPException(status_code=400, detail="Price must be positive")
-            
-        # 2. Check Balance/Stocks (Firestore)
-        db = get_db()
-        if not db:
-             raise HTTPException(status_code=503, detail="Database unavailable")
-             
-        user_ref = db.collection("users").document(order.user_id)
-        user_snap = user_ref.get()
-        if not user_snap.exists:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user_data = user_snap.to_dict()
-        
-        # BUY: Check Balance
-        if order.side.lower() == "buy":
-            total_cost = order.price * order.quantity
-            fee = total_cost * TRADING_FEE_RATE
-            required = total_cost + fee
-            
-            balance = user_data.get("balance", 0)
-            if balance < required:
-                raise HTTPException(status_code=400, detail=f"Insufficient balance. Need {required:,.0f} VND")
-                
-            # Hold Money
-            user_ref.update({"balance": firestore.Increment(-required)})
-            
-        # SELL: Check Holdings
-        elif order.side.lower() == "sell":
-            holding_ref = user_ref.collection("holdings").document(order.symbol)
-            holding_snap = holding_ref.get()
-            if not holding_snap.exists:
-                 raise HTTPException(status_code=400, detail=f"Not holding {order.symbol}")
-            
-            holding_data = holding_snap.to_dict()
-            current_qty = holding_data.get("quantity", 0)
-            if current_qty < order.quantity:
-                raise HTTPException(status_code=400, detail=f"Insufficient stocks. Have {current_qty}")
-                
-            # Hold Stocks
-            holding_ref.update({"quantity": firestore.Increment(-order.quantity)})
-            
-        # 3. Save to Redis (Matching Engine)
-        order_id = str(uuid.uuid4())
-        
-        # Redis Hash: order:{id}
-        order_dict = order.dict()
-        order_dict["status"] = "pending"
-        order_dict["filled"] = 0
-        order_dict["timestamp"] = time.time()
-        order_dict["id"] = order_id
-        
-        pipeline = r.pipeline()
-        pipeline.hmset(f"order:{order_id}", order_dict)
-        pipeline.sadd("pending_orders", order_id)
-        pipeline.rpush(f"user_orders:{order.user_id}", order_id)
-        # 4. Trigger Matching Engine (Queue)
-        pipeline.rpush("matching_queue", order_id)
-        pipeline.execute()
-        
-        # 4. Trigger Matching Engine (Async Background?)
-        # For MVP, we can try to match immediately or let a background worker do it.
-        # But we also have Main Loop running `engine.process_orders()`? 
-        # Yes, line 1780+ in main loop handles matching.
-        
-        return {"status": "success", "order_id": order_id, "message": "Order placed successfully"}
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Place Order Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-
-
 @app.get("/api/orders/{user_id}")
 
 @app.get("/api/orders/{user_id}")
@@ -1431,6 +1709,20 @@ def get_orders(user_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch orders: {str(e)}")
 
+@app.get("/api/orders/{user_id}/{order_id}")
+def get_order(user_id: str, order_id: str):
+    """
+    Trạng thái một lệnh từ Redis (status, filled, engine: queued / booked / rejected).
+    POST /api/orders trả về trước khi khớp: client theo dõi kết quả khớp tại đây.
+    """
+    if not r:
+        raise HTTPException(status_code=503, detail="Redis not connected")
+
+    order_info = r.hgetall(f"order:{order_id}")
+    if not order_info or order_info.get("user_id") != user_id:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return {"data": order_info}
+
 class OrderCancelRequest(BaseModel):
     user_id: str
     order_id: str
@@ -1457,34 +1749,67 @@ def cancel_order(req: OrderCancelRequest):
         current_status = str(order_data.get("status", "")).lower()
         print(f"Cancel Request: Order={req.order_id}, Status={current_status}")
         
-        if current_status != "pending":
+        if current_status not in ("pending", "partial"):
              raise HTTPException(status_code=400, detail=f"Cannot cancel order with status '{current_status}'")
              
         if order_data.get("user_id") != req.user_id:
              raise HTTPException(status_code=403, detail="Unauthorized")
 
-        # 2. Refund Logic (Firestore)
+        symbol = order_data.get("symbol")
+
+        # 2. Still queued in the intake stream (whichever worker reads it): close it before it
+        # reaches the engine. The match stage claims with the same atomic check, so one side wins.
+        engine_order = None
+        result, prev_status, quantity, _ = order_state.cancel_order(r, req.order_id, symbol, req.user_id,
+                                                                    queued_only=True)
+        if result == "engine":
+            # 3. Remove from the Matching Engine first (O(1) via order-id index) so the order can
+            # no longer be matched while we refund. A placement in flight is waited out.
+            wait_for_engine_handoff(req.order_id)
+            engine_order = engine.cancel_order(req.order_id, symbol=symbol)
+            if engine_order is None:
+                # Matched in full; Redis may still say 'pending' until the settle stage writes the
+                # fills, so its 'filled' field cannot be trusted for a refund here.
+                raise HTTPException(status_code=400, detail="Order already filled")
+
+            # Atomic Redis transition (Lua): closes the order + pending indexes only if still open.
+            # A concurrent settlement either lands before (we refund less) or keeps 'cancelled'.
+            result, prev_status, quantity, _ = order_state.cancel_order(r, req.order_id, symbol, req.user_id)
+        if result == "forbidden":
+            raise HTTPException(status_code=403, detail="Unauthorized")
+        if result != "ok":
+            raise HTTPException(status_code=400, detail=f"Cannot cancel order with status '{prev_status}'")
+
+        # 4. Refund Logic - only the unfilled part
+        quantity = int(float(quantity))
+        if engine_order is not None:
+            remaining = engine_order.remaining_quantity # Engine is authoritative on fills
+        else:
+            remaining = quantity # Cancelled before reaching the engine
+
+        # Ledger path: releases the hold/lock, the refund reaches Firestore via ledger_reconciler
+        held_refund = ledger.release(req.order_id, remaining)
+        if held_refund is not None:
+            if held_refund:
+                print(f"💰 Refunded {held_refund} to User {req.user_id}")
+            return {"status": "success", "message": "Order cancelled"}
+
+        # Order with no ledger hold (placed before the ledger existed): refund from the order record
         side = str(order_data.get("side", "")).lower()
         price = float(order_data.get("price", 0))
-        quantity = int(order_data.get("quantity"))
-        total_val = price * quantity
+        total_val = price * remaining
         
         db = get_db()
-        if side == "buy" and db:
-             # Refund Money + Fee
-             fee = float(order_data.get("fee", 0)) if "fee" in order_data else (total_val * TRADING_FEE_RATE)
+        if side == "buy" and db and remaining > 0:
+             # Refund Money + Fee (pro rata for a partially filled order)
+             fee = float(order_data["fee"]) * remaining / quantity if "fee" in order_data and quantity else (total_val * TRADING_FEE_RATE)
              refund_amount = total_val + fee
              
              user_ref = db.collection("users").document(req.user_id)
              user_ref.update({"balance": firestore.Increment(refund_amount)})
+             ledger.adjust_cash(req.user_id, refund_amount)
              print(f"💰 Refunded {refund_amount} to User {req.user_id}")
         
-        # 3. Redis Cleanup
-        pipe = r.pipeline()
-        pipe.hset(order_key, "status", "cancelled")
-        pipe.srem("pending_orders", req.order_id)
-        pipe.execute()
-        
         return {"status": "success", "message": "Order cancelled"}
     except HTTPException as he:
         raise he
@@ -1537,177 +1862,184 @@ async def get_batch_quotes(symbols: str):
     """
     symbol_list = [s.strip().upper() for s in symbols.split(",") if s.strip()]
     results = {}
-    
-    # Use existing fetch logic (YFinance/Vnstock)
-    # Optimization: Parallel fetch or bulk YFinance
-    # For MVP: Iterate or use Ticker(space separated)
-    
+
+    # One batch call per provider (VCI price board, yf.Tickers), misses fall through each class route
     try:
-        # 1. Separate VN and US
-        vn_stocks = [s for s in symbol_list if len(s) == 3 and s.isalpha()]
-        us_stocks = [s for s in symbol_list if s not in vn_stocks]
-        
-        # 2. Fetch US/Crypto via YFinance (Bulk)
-        if us_stocks:
-            try:
-                tickers = " ".join(us_stocks)
-                # yf.download is heavy, Tickers is better
-                data = yf.Tickers(tickers)
-                # Ensure we get *some* data. fast_info is best for "Current Price"
-                for sym in us_stocks:
-                    try:
-                        info = data.tickers[sym].fast_info
-                        if info and info.last_price:
-                            # Calculate Change? fast_info doesn't have change easily.
-                            # Use history for 2 days
-                            hist = data.tickers[sym].history(period="2d")
-                            price = info.last_price
-                            change = 0.0
-                            if len(hist) >= 1:
-                                prev = hist['Close'].iloc[-2] if len(hist) >= 2 else hist['Open'].iloc[-1]
-                                change = ((price - prev) / prev) * 100
-                            
-                            results[sym] = {
-                                "symbol": sym,
-                                "price": price,
-                                "change_percent": change,
-                                "name": sym
-                            }
-                    except: pass
-            except Exception as e:
-                 print(f"US Batch Error: {e}")
-
-        # 3. Fetch VN via Vnstock (Iterative for now as bulk choice is limited in wrapper)
-        # Actually Vnstock might not be efficient for batch. 
-        # Hack: Use YFinance for VN stocks too using .VN suffix? 
-        # No, Vnstock is better. Let's precise.
-        for sym in vn_stocks:
-             try:
-                 # Re-use global cached fetch OR direct
-                 # Just single fetch for MVP to ensure accuracy
-                 # Note: This is slow. TODO: Optimize
-                 stock = Vnstock().stock(symbol=sym, source='VCI')
-                 df = stock.quote.history(start= (datetime.now() - timedelta(days=3)).strftime("%Y-%m-%d"), end=datetime.now().strftime("%Y-%m-%d"), interval='1D')
-                 
-                 if not df.empty:
-                     row = df.iloc[-1]
-                     # Vnstock df columns: time, open, high, low, close, volume...
-                     if 'close' in df.columns:
-                         price = float(row['close'])
-                         prev = float(df.iloc[-2]['close']) if len(df) >= 2 else price
-                         change = ((price - prev) / prev) * 100
-                         
-                         # Scale if needed (Vnstock sometimes returns 27.5 for 27500)
-                         if price < 500: price *= 1000
-                         
-                         results[sym] = {
-                             "symbol": sym,
-                             "price": price,
-                             "change_percent": change, 
-                             "name": sym
-                         }
-             except: pass
-             
+        quotes = await market_data.quotes(symbol_list)
+        for sym, q in quotes.items():
+            results[sym] = {
+                "symbol": sym,
+                "price": q.price, # Native currency (USD for US/crypto)
+                "change_percent": q.change_percent,
+                "name": sym
+            }
     except Exception as e:
         print(f"Batch Quote Error: {e}")
         
     return {"data": results}
 
 
-def get_orderbook_data(symbol: str):
+def get_orderbook_data(symbol: str, limit: int = 5):
     """
-    Helper: Calculate OrderBook from Redis (Sync)
+    Helper: Top-N aggregated OrderBook (Top 5 Mua / Top 5 Bán).
+    Served from the engine's incrementally maintained L2 snapshot (lock-free).
+    If the engine is unreachable (shard down / restarting), falls back to the
+    per-symbol Redis level indexes (top N levels of this symbol only).
     """
-    if not r: return {"bids": [], "asks": []}
-    
     try:
-        # 1. Get Pending Orders IDs
-        pending_ids = list(r.smembers("pending_orders"))
-        if not pending_ids: 
-            return {"bids": [], "asks": []}
-        
-        # 2. Get Details (Pipeline for speed)
-        pipe = r.pipeline()
-        for oid in pending_ids:
-            pipe.hgetall(f"order:{oid}")
-        orders = pipe.execute()
-        
-        bids = {} # Price -> Quantity
-        asks = {}
-        
-        for i, order_data in enumerate(orders):
-            if not order_data: continue
-            
-            # Filter by Symbol
-            if order_data.get("symbol") == symbol:
-                side = str(order_data.get("side", "")).lower()
-                try:
-                    price = float(order_data.get("price", 0))
-                    initial_qty = int(order_data.get("quantity", 0))
-                    filled = int(float(order_data.get("filled", 0)))
-                    remaining_qty = initial_qty - filled
-                    
-                    if remaining_qty <= 0: continue
-                    
-                    if side == "buy":
-                        if price in bids: bids[price] += remaining_qty
-                        else: bids[price] = remaining_qty
-                    elif side == "sell":
-                        if price in asks: asks[price] += remaining_qty
-                        else: asks[price] = remaining_qty
-                except ValueError: continue
-
-        # 3. Sort and Format
-        sorted_bids = sorted(bids.items(), key=lambda x: x[0], reverse=True)[:5]
-        sorted_asks = sorted(asks.items(), key=lambda x: x[0])[:5]
-        
-        return {
-            "bids": [{"price": p, "quantity": q} for p, q in sorted_bids],
-            "asks": [{"price": p, "quantity": q} for p, q in sorted_asks]
-        }
+        return engine.get_snapshot(symbol).to_dict(limit)
     except Exception as e:
         print(f"OrderBook Calc Error: {e}")
-        return {"bids": [], "asks": []}
+    try:
+        if r:
+            return order_state.book_depth(r, symbol, limit)
+    except Exception as e:
+        print(f"OrderBook Index Error: {e}")
+    return {"bids": [], "asks": []}
 
 def broadcast_orderbook_update(symbol: str):
     """
-    Helper: Broadcast new OrderBook state to WebSocket
+    Helper: Marks the symbol's OrderBook dirty (Redis set, any worker's broadcaster takes it).
+    orderbook_broadcaster publishes it at most once per ORDERBOOK_BROADCAST_INTERVAL, so a
+    burst of fills = 1 message.
     """
-    if not r: return
+    if r:
+        published_books.mark_dirty(symbol)
+
+def book_levels(snap):
+    return dict(snap.bids[:ORDERBOOK_DIFF_LEVELS]), dict(snap.asks[:ORDERBOOK_DIFF_LEVELS])
+
+def level_diff(old: dict, new: dict) -> list:
+    """[[price, qty], ...] of changed levels; qty 0 = level gone (or out of the window)."""
+    diff = [[p, q] for p, q in new.items() if old.get(p) != q]
+    diff.extend([p, 0] for p in old if p not in new)
+    return diff
+
+def published_book(symbol: str):
+    """(seq, bids, asks) the book stream is at; seeded from the engine on first use."""
+    state = published_books.load([symbol])[symbol]
+    if state is None:
+        snap = engine.get_snapshot(symbol)
+        seeded = (snap.seq, *book_levels(snap))
+        if published_books.publish(r, symbol, None, feed_channel(symbol), seeded):
+            return seeded
+        state = published_books.load([symbol])[symbol] # Another worker seeded it first
+    return state[:3]
+
+def book_snapshot_message(symbol: str, state) -> dict:
+    seq, bids, asks = state
+    return {
+        "type": "BOOK_SNAPSHOT",
+        "symbol": symbol,
+        "seq": seq,
+        "bids": [[p, q] for p, q in sorted(bids.items(), reverse=True)],
+        "asks": [[p, q] for p, q in sorted(asks.items())],
+        "timestamp": time.time()
+    }
+
+def flush_orderbook_broadcasts():
+    """
+    Publishes every dirty symbol (one Redis pipeline to read the published state, one to publish):
+    - ORDER_BOOK: top-5 full book (legacy clients)
+    - BOOK_DIFF: changed levels of the top ORDERBOOK_DIFF_LEVELS since the last diff (book stream)
+    - BOOK_SNAPSHOT instead, when the book seq went backwards (engine reset, shard restart)
+      or no state was published yet (first publish, Redis flushed)
+    A symbol whose state another worker moved in the meantime is marked dirty again.
+    """
+    if not r:
+        return 0
+    symbols = published_books.take_dirty()
+    if not symbols:
+        return 0
+
+    states = published_books.load(symbols)
+    pipe = r.pipeline(transaction=False)
+    queued = [] # (symbol, messages)
+    for symbol in symbols:
+        try:
+            snap = engine.get_snapshot(symbol)
+        except Exception as e:
+            print(f"OrderBook Calc Error: {e}")
+            continue
+        prev = states.get(symbol)
+        bids, asks = book_levels(snap)
+        state = diff = None
+        if prev is None or snap.seq < prev[0]: # Clients replace their book
+            state = (snap.seq, bids, asks)
+            diff = book_snapshot_message(symbol, state)
+        elif snap.seq > prev[0]:
+            bid_diff, ask_diff = level_diff(prev[1], bids), level_diff(prev[2], asks)
+            if bid_diff or ask_diff: # Deeper-only changes keep the stream's seq unchanged
+                state = (snap.seq, bids, asks)
+                diff = {
+                    "type": "BOOK_DIFF",
+                    "symbol": symbol,
+                    "prev_seq": prev[0],
+                    "seq": snap.seq,
+                    "bids": bid_diff,
+                    "asks": ask_diff,
+                    "timestamp": time.time()
+                }
+
+        message = None
+        if prev is None or prev[3] != snap.seq: # Book changed since the last publish
+            message = {
+                "type": "ORDER_BOOK",
+                "symbol": symbol,
+                "seq": snap.seq, # Book version: clients can drop out-of-order updates
+                "data": snap.to_dict(ORDERBOOK_BROADCAST_LEVELS),
+                "timestamp": time.time()
+            }
+        if state is None and message is None:
+            continue
+        # Redis PubSub only carries strings: the WebSocket endpoint forwards
+        # message["data"] (the JSON string) as-is to the client.
+        published_books.publish(pipe, symbol, prev[0] if prev else None, feed_channel(symbol),
+                                state, diff, snap.seq if message else None, message)
+        queued.append((symbol, (diff is not None) + (message is not None)))
+    if not queued:
+        return 0
+
+    published, lost = 0, []
+    for (symbol, count), ok in zip(queued, pipe.execute()):
+        if ok:
+            published += count
+        else:
+            lost.append(symbol)
+    if lost:
+        published_books.mark_dirty(*lost) # Re-diffed against the other worker's state next round
+    return published
+
+async def orderbook_broadcaster():
+    """Background Task: flushes coalesced OrderBook broadcasts every ORDERBOOK_BROADCAST_INTERVAL."""
+    while not shutdown_event.is_set():
+        try:
+            await asyncio.to_thread(flush_orderbook_broadcasts)
+            await asyncio.sleep(ORDERBOOK_BROADCAST_INTERVAL)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"⚠️ Broadcast Error: {e}")
+            await asyncio.sleep(1)
+
+@app.get("/api/orderbook/{symbol}/snapshot")
+def get_order_book_snapshot(symbol: str):
+    """
+    Book stream resync: top-20 BOOK_SNAPSHOT at the stream's current seq.
+    Clients call this when a BOOK_DIFF's prev_seq != their last seq, then apply diffs with seq > snapshot seq.
+    """
+    symbol = symbol.upper()
     try:
-        data = get_orderbook_data(symbol)
-        message = {
-            "type": "ORDER_BOOK",
-            "symbol": symbol,
-            "data": data,
-            "timestamp": time.time()
-        }
-        # Publish to Redis Channel
-        # Note: We must serialize 'data' first or the whole message?
-        # The WebSocket endpoint expects message['data'] to be the payload string or dict?
-        # Line 722: await websocket.send_text(message["data"])
-        # If we publish JSON string as message["data"], client receives string.
-        # If we publish Dict, Redis PubSub receives it? No, Redis PubSub only strings (or bytes).
-        # Standard: r.publish(channel, json.dumps(payload))
-        # The Subscriber receives 'data': payload_string.
-        # Our Subscriber logic:
-        # message = pubsub.get_message()
-        # if message["type"] == "message": 
-        #    await websocket.send_text(message["data"])
-        # So message["data"] is the STRING we publish here.
-        
-        r.publish("stock_updates", json.dumps(message))
-        # print(f"📡 Broadcast OrderBook for {symbol}")
+        return book_snapshot_message(symbol, published_book(symbol))
     except Exception as e:
-        print(f"⚠️ Broadcast Error: {e}")
+        raise HTTPException(status_code=503, detail=f"Order book unavailable: {e}")
 
 @app.get("/api/orderbook/{symbol}")
 def get_order_book(symbol: str):
     """
-    Lấy Sổ lệnh (Order Book) thật từ Redis Pending Orders.
+    Lấy Sổ lệnh (Order Book) thật từ Matching Engine (L2 snapshot).
     Tổng hợp khối lượng theo mức giá (Top 5 Mua / Top 5 Bán).
     """
-    if not r: return {"bids": [], "asks": []}
     return get_orderbook_data(symbol.upper())
 
 @app.get("/api/portfolio/{user_id}")
@@ -2069,6 +2401,7 @@ def admin_add_balance(req: AddBalanceRequest, admin_id: str = Depends(verify_adm
             raise HTTPException(status_code=404, detail="User not found")
             
         user_ref.update({"balance": firestore.Increment(req.amount)})
+        ledger.adjust_cash(req.user_id, req.amount)
         print(f"💰 Admin added {req.amount:,.0f} to {req.user_id}")
         return {"status": "success", "message": f"Added {req.amount:,.0f} VND"}
     except Exception as e:
@@ -2148,6 +2481,16 @@ async def debug_dump_orders():
         "orders": data
     }
 
+@app.post("/api/debug/order_stream/replay")
+async def debug_replay_order_stream(from_id: str = "0"):
+    """Re-delivers order intake entries after `from_id` (stream offset) to the match stage."""
+    if not r: return {"error": "No Redis"}
+    try:
+        await asyncio.to_thread(replay_order_stream, from_id)
+        return {"status": "success", "from_id": from_id, "streams": order_streams()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/debug/reset")
 async def debug_reset():
     """
@@ -2159,8 +2502,8 @@ async def debug_reset():
             r.flushdb()
             print("⚠️ Redis Flushed via API")
         
-        # Reset Engine
-        engine.books.clear()
+        # Reset Engine (+ its journal)
+        reset_engine()
         print("⚠️ Matching Engine State Cleared")
         
         return {"status": "success", "message": "System State Reset"}
@@ -2376,9 +2719,8 @@ def debug_reset_redis():
          raise HTTPException(status_code=503, detail="Redis not connected")
     try:
         r.flushdb()
-        # Also re-hydrate empty engine?
-        global engine
-        engine = MatchingEngine() # Reset engine
+        # Also reset the in-memory engine (books + order-id index) and its journal
+        reset_engine()
         print("⚠️ [DEBUG] Redis Flushed & Engine Reset by User Request.")
         return {"status": "success", "message": "Redis cleared. Please restart app."}
     except Exception as e:
@@ -2422,101 +2764,8 @@ async def get_prediction(symbol: str):
          raise HTTPException(status_code=500, detail=str(e))
 
 
-# --- BACKGROUND WORKER ---
-def run_matching_engine_loop():
-    """
-    Background thread to process the Matching Queue.
-    Pops Order IDs from 'matching_queue', loads them, and runs the Engine.
-    """
-    print("🚀 [BACKGROUND] Matching Engine Loop Started")
-    
-    # Give Redis time to connect
-    time.sleep(2)
-    
-    while not shutdown_event.is_set():
-        try:
-            if not r:
-                time.sleep(1)
-                continue
-            
-            # Blocking Pop (Timeout 1s to allow shutdown check)
-            item = r.blpop("matching_queue", timeout=1)
-            if not item:
-                continue
-                
-            # item is (key, value) tuple
-            _, order_id_bytes = item
-            order_id = order_id_bytes.decode('utf-8')
-            
-            # Fetch Order Data
-            data = r.hgetall(f"order:{order_id}")
-            if not data:
-                print(f"⚠️ [MATCHING] Order {order_id} not found in Redis")
-                continue
-                
-            # Reconstruct Order Object
-            try:
-                side_str = data.get("side", "").upper()
-                type_str = data.get("order_type", "limit").upper() # Note: API uses 'order_type', Helper might use 'type'? Check API. API saves dict() from Pydantic. Pydantic has 'order_type'.
-                
-                # Correction: Pydantic OrderRequest has 'order_type'. Order class has 'type'.
-                # We need to map correctly.
-                
-                price = float(data.get("price", 0))
-                qty = int(float(data.get("quantity", 0)))
-                filled = int(float(data.get("filled", 0)))
-                ts = float(data.get("timestamp", time.time()))
-                
-                order = Order(
-                    id=data.get("id"),
-                    user_id=data.get("user_id"),
-                    symbol=data.get("symbol"),
-                    side=OrderSide[side_str] if side_str in OrderSide.__members__ else OrderSide.BUY,
-                    type=OrderType[type_str] if type_str in OrderType.__members__ else OrderType.LIMIT,
-                    price=price,
-                    quantity=qty,
-                    filled_quantity=filled,
-                    timestamp=ts,
-                    status=OrderStatus.PENDING
-                )
-                
-                # Run Matching
-                trades = engine.place_order(order)
-                
-                # Settle
-                if trades:
-                    process_executed_trades(trades)
-                    
-            except Exception as e:
-                print(f"⚠️ [MATCHING] Processing Error for {order_id}: {e}")
-                
-        except Exception as e:
-            print(f"⚠️ [BACKGROUND] Loop Error: {e}")
-            time.sleep(1)
-
-@app.on_event("startup")
-async def startup_event():
-    print("🌟 SERVER STARTING UP...")
-    
-    # 1. Hydrate Engine (Load Pending Orders)
-    # We should also fill 'matching_queue' if it's empty but 'pending_orders' is not?
-    # hydrate_engine() replays them directly to engine.
-    hydrate_engine()
-    
-    # 2. Start Maintenance Listener
-    start_config_listener()
-    
-    # 3. Start Background Matching Loop
-    t = threading.Thread(target=run_matching_engine_loop, daemon=True)
-    t.start()
-
-@app.on_event("shutdown")
-async def shutdown_event_handler():
-    print("🛑 SERVER SHUTTING DOWN...")
-    shutdown_event.set()
-
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=True) # Compressed WS frames
 
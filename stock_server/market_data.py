@@ -0,0 +1,573 @@
+"""
+Pluggable Market-Data Providers.
+
+Every upstream (Vnstock/VCI, Yahoo Finance, Stooq, a local replay directory) sits behind
+one interface, and each symbol class has its own ordered provider route:
+
+    symbol -> symbol_class() -> [provider, fallback, ...] -> quote / quotes / history
+
+    vn      3-letter HOSE/HNX tickers (HPG)      VCI -> yfinance (.VN)
+    us      US equities (AAPL)                   yfinance -> stooq
+    crypto  pairs (BTC-USD)                      yfinance
+    index   indices / futures (^GSPC, GC=F)      yfinance
+
+- Providers are blocking: `quote(symbol) -> Quote | None`, `quotes(symbols) -> {symbol: Quote}`,
+  `history(symbol, start, end, resolution) -> [bar] | None`. Quote None = no data; history
+  None = failed, [] = answered with no bars (weekend, holiday, before listing). quote() raises
+  RateLimited when the upstream throttles (quote_refresher.QuoteSource pauses that source).
+- History is hedged: the next provider in the route starts if the current one has not
+  answered after `hedge_after` seconds (or came back empty); the first non-empty answer wins.
+- Prices are in the provider's native currency (`Quote.currency`); callers convert.
+
+MARKET_DATA_MODE=replay swaps every route for a ReplayProvider reading MARKET_DATA_REPLAY_DIR
+(no network, deterministic). MARKET_DATA_RECORD_DIR records live answers in the same layout:
+
+    <dir>/quotes/<SYMBOL>.jsonl                 {"t": epoch, "price", "volume", "change_percent", "currency"}
+    <dir>/history/<SYMBOL>/<resolution>.json    [{"time", "open", "high", "low", "close", "volume"}, ...]
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from io import StringIO
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+import requests
+import yfinance as yf
+from vnstock import Vnstock
+
+from quote_refresher import RateLimited
+
+MARKET_DATA_MODE = os.getenv("MARKET_DATA_MODE", "live") # live | replay
+MARKET_DATA_REPLAY_DIR = os.getenv("MARKET_DATA_REPLAY_DIR",
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "replay"))
+MARKET_DATA_REPLAY_SPEED = float(os.getenv("MARKET_DATA_REPLAY_SPEED", "1.0")) # 0 = one record per call
+MARKET_DATA_RECORD_DIR = os.getenv("MARKET_DATA_RECORD_DIR", "") # Live mode: also write answers here
+
+BAR_FIELDS = ("time", "open", "high", "low", "close", "volume")
+
+
+class Quote(NamedTuple):
+    price: float
+    volume: int
+    change_percent: float
+    currency: str = "VND"
+
+
+def symbol_class(symbol: str) -> str:
+    if len(symbol) == 3 and symbol.isalpha():
+        return "vn"
+    if symbol.startswith("^") or symbol.endswith("=F"):
+        return "index"
+    if "-" in symbol:
+        return "crypto"
+    return "us"
+
+
+def _records(df: pd.DataFrame) -> list:
+    return json.loads(df.to_json(orient="records"))
+
+
+class MarketDataProvider:
+    """Base provider: no data for anything. Override what the upstream supports."""
+    name = "none"
+    batch = False # quotes() answers many symbols in one upstream request
+
+    def stats(self) -> dict:
+        return {}
+
+    def quote(self, symbol: str) -> Optional[Quote]:
+        return None
+
+    def quotes(self, symbols: List[str]) -> Dict[str, Quote]:
+        out = {}
+        for symbol in symbols:
+            try:
+                q = self.quote(symbol)
+            except RateLimited:
+                break # The rest would be throttled too
+            except Exception as e:
+                print(f"⚠️ [{self.name}] {symbol}: {e}")
+                continue
+            if q is not None:
+                out[symbol] = q
+        return out
+
+    def history(self, symbol: str, start_date: str, end_date: str, resolution: str = "1D") -> Optional[list]:
+        return None
+
+
+class VnstockProvider(MarketDataProvider):
+    """
+    Vnstock (VCI). Quotes come from the price board: one request for up to
+    `board_size` symbols. Stock clients are pooled per symbol (LRU) instead of
+    being rebuilt on every call.
+    """
+    name = "VCI"
+    batch = True
+    BOARD_FIELDS = {
+        "symbol": ("listing_symbol", "symbol"),
+        "price": ("match_match_price", "match_price", "close_price"),
+        "ref": ("listing_ref_price", "ref_price", "reference_price"),
+        "volume": ("match_accumulated_volume", "accumulated_volume", "total_volume", "volume"),
+    }
+
+    def __init__(self, source: str = "VCI", pool_size: int = 256, board_size: int = 100):
+        self.source = source
+        self.pool_size = pool_size
+        self.board_size = board_size
+        self.pool: "OrderedDict[str, object]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.board_calls = 0
+
+    def client(self, symbol: str):
+        with self.lock:
+            stock = self.pool.get(symbol)
+            if stock is not None:
+                self.pool.move_to_end(symbol)
+                return stock
+        stock = Vnstock().stock(symbol=symbol, source=self.source)
+        with self.lock:
+            self.pool[symbol] = stock
+            while len(self.pool) > self.pool_size:
+                self.pool.popitem(last=False)
+        return stock
+
+    @classmethod
+    def _board_rows(cls, df: pd.DataFrame) -> List[dict]:
+        if isinstance(df.columns, pd.MultiIndex): # (group, field) -> group_field
+            df = df.copy()
+            df.columns = ["_".join(str(c) for c in col if c) for col in df.columns]
+        cols = {}
+        for field, names in cls.BOARD_FIELDS.items():
+            cols[field] = next((n for n in names if n in df.columns), None)
+        if cols["symbol"] is None or cols["price"] is None:
+            raise ValueError(f"Unexpected price board columns: {list(df.columns)[:10]}")
+        return [{f: row.get(c) if c else None for f, c in cols.items()} for row in df.to_dict("records")]
+
+    @staticmethod
+    def throttled(e: Exception) -> bool:
+        msg = str(e).lower()
+        return "429" in msg or "too many requests" in msg or "rate limit" in msg
+
+    def quote(self, symbol: str) -> Optional[Quote]:
+        return self.quotes([symbol]).get(symbol)
+
+    def quotes(self, symbols: List[str]) -> Dict[str, Quote]:
+        """Last match vs reference price from the price board, `board_size` symbols per request."""
+        out = {}
+        for i in range(0, len(symbols), self.board_size):
+            chunk = symbols[i:i + self.board_size]
+            try:
+                board = self.client(chunk[0]).trading.price_board(symbols_list=chunk)
+                self.board_calls += 1
+            except SystemExit as e: # Vnstock exits on throttling
+                raise RateLimited(f"Vnstock RateLimit: {e}")
+            except Exception as e:
+                if self.throttled(e):
+                    raise RateLimited(f"Vnstock RateLimit: {e}")
+                raise # Ordinary failure: callers fall back symbol by symbol
+            if board is None or board.empty:
+                continue
+            for row in self._board_rows(board):
+                symbol = str(row["symbol"] or "").upper()
+                price = float(row["price"] or 0)
+                ref = float(row["ref"] or 0)
+                if not price: # No match yet today: reference price
+                    price = ref
+                if not symbol or not price:
+                    continue
+                change = ((price - ref) / ref) * 100 if ref else 0.0
+                if price < 500: # Fix Scaling (HPG: 26.4 -> 26400)
+                    price *= 1000
+                out[symbol] = Quote(price, int(row["volume"] or 0), change)
+        return out
+
+    def history(self, symbol: str, start_date: str, end_date: str, resolution: str = "1D") -> Optional[list]:
+        try:
+            print(f"      -> [Vnstock-VCI] Fetching {symbol}...")
+            df = self.client(symbol).quote.history(start=start_date, end=end_date, interval=resolution) # Can block
+            print(f"      -> [Vnstock-VCI] History fetched. Rows: {len(df) if df is not None else 0}")
+            if df is None:
+                return None
+            if df.empty:
+                return [] # Answered, no bars in range
+            if 'time' in df.columns:
+                df['time'] = df['time'].astype(str)
+            # Scale thousands-of-VND prices (based on last close)
+            if 'close' in df.columns and df.iloc[-1]['close'] < 500:
+                for c in ('open', 'high', 'low', 'close'):
+                    if c in df.columns:
+                        df[c] = df[c] * 1000
+            return _records(df)
+        except Exception as e:
+            print(f"      -> [Vnstock Error] {e}")
+            return None
+
+    def stats(self) -> dict:
+        return {"pooled_clients": len(self.pool), "board_calls": self.board_calls}
+
+
+class YFinanceProvider(MarketDataProvider):
+    name = "yfinance"
+    INTERVALS = {
+        '1D': '1d', '1W': '1wk', '1M': '1mo',
+        '1m': '1m', '5m': '5m', '15m': '15m', '30m': '30m', '1H': '60m'
+    }
+
+    @staticmethod
+    def ticker(symbol: str) -> str:
+        return f"{symbol}.VN" if symbol_class(symbol) == "vn" else symbol
+
+    @staticmethod
+    def currency(symbol: str) -> str:
+        return "VND" if symbol_class(symbol) == "vn" else "USD"
+
+    def quote(self, symbol: str) -> Optional[Quote]:
+        info = yf.Ticker(self.ticker(symbol)).fast_info
+        p = info.last_price
+        if not p:
+            return None
+        prev_close = info.previous_close
+        volume = int(info.last_volume) if info.last_volume else 0
+        change = ((p - prev_close) / prev_close) * 100 if prev_close else 0.0
+        return Quote(p, volume, change, self.currency(symbol))
+
+    def quotes(self, symbols: List[str]) -> Dict[str, Quote]:
+        """One yf.Tickers for the whole batch; change vs the previous daily close."""
+        out = {}
+        names = {self.ticker(s): s for s in symbols}
+        data = yf.Tickers(" ".join(names))
+        for yf_symbol, symbol in names.items():
+            try:
+                tick = data.tickers[yf_symbol]
+                info = tick.fast_info
+                if not (info and info.last_price):
+                    continue
+                price = info.last_price
+                hist = tick.history(period="2d")
+                change = 0.0
+                if len(hist) >= 1:
+                    prev = hist['Close'].iloc[-2] if len(hist) >= 2 else hist['Open'].iloc[-1]
+                    change = ((price - prev) / prev) * 100
+                volume = int(info.last_volume) if info.last_volume else 0
+                out[symbol] = Quote(price, volume, change, self.currency(symbol))
+            except Exception:
+                pass
+        return out
+
+    def history(self, symbol: str, start_date: str, end_date: str, resolution: str = "1D") -> Optional[list]:
+        yf_symbol = self.ticker(symbol)
+        try:
+            print(f"   -> [YFinance] Downloading {yf_symbol}...")
+            df = yf.Ticker(yf_symbol).history(start=start_date, end=end_date,
+                                              interval=self.INTERVALS.get(resolution, '1d'), auto_adjust=True)
+        except Exception as e:
+            print(f"   -> [YFinance] Error downloading {symbol}: {e}")
+            return None
+        if df.empty:
+            print(f"   -> [YFinance] No data found for {yf_symbol}.")
+            return []
+        df = df.reset_index()
+        df.columns = [c.lower() for c in df.columns]
+        df = df.rename(columns={"date": "time", "datetime": "time", "stock splits": "splits"})
+        if 'time' not in df.columns or 'close' not in df.columns:
+            return None
+        df['time'] = df['time'].astype(str)
+        for col in BAR_FIELDS:
+            if col not in df.columns:
+                df[col] = 0
+        return _records(df[list(BAR_FIELDS)])
+
+
+class StooqProvider(MarketDataProvider):
+    """Daily CSV for US listings (AAPL -> aapl.us)."""
+    name = "stooq"
+
+    def quote(self, symbol: str) -> Optional[Quote]:
+        end = datetime.now()
+        rows = self.history(symbol, (end - timedelta(days=10)).strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+        if not rows:
+            return None
+        last = rows[-1]
+        prev_close = rows[-2]["close"] if len(rows) > 1 else 0
+        change = ((last["close"] - prev_close) / prev_close) * 100 if prev_close else 0.0
+        return Quote(last["close"], int(last.get("volume") or 0), change, "USD")
+
+    def history(self, symbol: str, start_date: str, end_date: str, resolution: str = "1D") -> Optional[list]:
+        try:
+            stooq_symbol = f"{symbol.lower()}.us"
+            print(f"   -> [Stooq] Downloading {stooq_symbol}...")
+            resp = requests.get(f"https://stooq.com/q/d/l/?s={stooq_symbol}&i=d", timeout=10)
+            if resp.status_code != 200:
+                return None
+            df = pd.read_csv(StringIO(resp.text))
+            if df.empty or "Date" not in df.columns:
+                return None
+            df.columns = [c.lower() for c in df.columns]
+            df = df.rename(columns={"date": "time"})
+            df["time"] = pd.to_datetime(df["time"])
+            df = df.sort_values("time")
+            df = df[(df["time"] >= pd.Timestamp(start_date)) & (df["time"] <= pd.Timestamp(end_date))]
+            df["time"] = df["time"].astype(str)
+            if not set(BAR_FIELDS).issubset(df.columns):
+                return None
+            return _records(df[list(BAR_FIELDS)])
+        except Exception as e:
+            print(f"   -> [Stooq] Error: {e}")
+            return None
+
+
+class ReplayProvider(MarketDataProvider):
+    """
+    Serves recorded quotes/bars from disk (layout in the module docstring).
+    Quotes follow a replay clock that starts at the first record and runs at `speed` x
+    real time, looping at the end; speed 0 steps one record per call instead (fully
+    deterministic, independent of timing). Symbols with no quote file fall back to
+    their last two daily bars.
+    """
+    name = "replay"
+
+    def __init__(self, root: str, speed: float = 1.0):
+        self.root = root
+        self.speed = speed
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.tapes: Dict[str, Tuple[List[float], List[Quote]]] = {}
+        self.steps: Dict[str, int] = {}
+        self.bars: Dict[Tuple[str, str], list] = {}
+
+    def _tape(self, symbol: str) -> Tuple[List[float], List[Quote]]:
+        tape = self.tapes.get(symbol)
+        if tape is None:
+            times, quotes = [], []
+            path = os.path.join(self.root, "quotes", f"{symbol}.jsonl")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    rows = sorted((json.loads(line) for line in f if line.strip()), key=lambda q: q["t"])
+                for q in rows:
+                    times.append(float(q["t"]))
+                    quotes.append(Quote(float(q["price"]), int(q.get("volume") or 0),
+                                        float(q.get("change_percent") or 0.0), q.get("currency", "VND")))
+            tape = self.tapes[symbol] = (times, quotes)
+        return tape
+
+    def _bars(self, symbol: str, resolution: str) -> list:
+        key = (symbol, resolution)
+        bars = self.bars.get(key)
+        if bars is None:
+            path = os.path.join(self.root, "history", symbol, f"{resolution}.json")
+            bars = []
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    bars = sorted(json.load(f), key=lambda b: b["time"])
+            self.bars[key] = bars
+        return bars
+
+    def quote(self, symbol: str) -> Optional[Quote]:
+        with self.lock:
+            times, quotes = self._tape(symbol)
+            if not quotes:
+                bars = self._bars(symbol, "1D")
+                if not bars:
+                    return None
+                last = bars[-1]
+                prev = bars[-2]["close"] if len(bars) > 1 else 0
+                change = ((last["close"] - prev) / prev) * 100 if prev else 0.0
+                return Quote(float(last["close"]), int(last.get("volume") or 0), change,
+                             "VND" if symbol_class(symbol) == "vn" else "USD")
+            if self.speed <= 0:
+                i = self.steps.get(symbol, 0)
+                self.steps[symbol] = i + 1
+                return quotes[i % len(quotes)]
+            span = times[-1] - times[0]
+            elapsed = (time.monotonic() - self.started) * self.speed
+            at = times[0] + (elapsed % span if span > 0 else 0)
+            return quotes[max(bisect_right(times, at) - 1, 0)]
+
+    def history(self, symbol: str, start_date: str, end_date: str, resolution: str = "1D") -> Optional[list]:
+        with self.lock:
+            bars = self._bars(symbol, resolution)
+        if not bars:
+            return None # Nothing recorded for this series
+        return [b for b in bars if start_date <= b["time"][:10] <= end_date]
+
+
+class RecordingProvider(MarketDataProvider):
+    """Passes through to `inner` and writes every answer in the replay layout."""
+
+    def __init__(self, inner: MarketDataProvider, root: str):
+        self.inner = inner
+        self.name = inner.name
+        self.batch = inner.batch
+        self.root = root
+        self.lock = threading.Lock()
+
+    def _save_quote(self, symbol: str, q: Quote):
+        path = os.path.join(self.root, "quotes", f"{symbol}.jsonl")
+        row = {"t": time.time(), **q._asdict()}
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(row) + "\n")
+
+    def quote(self, symbol: str) -> Optional[Quote]:
+        q = self.inner.quote(symbol)
+        if q is not None:
+            self._save_quote(symbol, q)
+        return q
+
+    def quotes(self, symbols: List[str]) -> Dict[str, Quote]:
+        out = self.inner.quotes(symbols)
+        for symbol, q in out.items():
+            self._save_quote(symbol, q)
+        return out
+
+    def history(self, symbol: str, start_date: str, end_date: str, resolution: str = "1D") -> Optional[list]:
+        rows = self.inner.history(symbol, start_date, end_date, resolution)
+        if rows:
+            path = os.path.join(self.root, "history", symbol, f"{resolution}.json")
+            with self.lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                merged = {}
+                if os.path.exists(path):
+                    with open(path, encoding="utf-8") as f:
+                        merged = {b["time"]: b for b in json.load(f)}
+                merged.update({b["time"]: b for b in rows})
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump([merged[t] for t in sorted(merged)], f)
+        return rows
+
+    def stats(self) -> dict:
+        return self.inner.stats()
+
+
+class MarketData:
+    def __init__(self, routes: Dict[str, List[MarketDataProvider]], hedge_after: Optional[Dict[str, float]] = None,
+                 history_timeout: float = 30.0):
+        """
+        routes: symbol class -> providers in fallback order.
+        hedge_after: symbol class -> seconds before the next provider is started alongside
+        a slow one (missing = wait for each provider in turn).
+        """
+        self.routes = routes
+        self.hedge_after = hedge_after or {}
+        self.history_timeout = history_timeout
+        self.providers = list({id(p): p for ps in routes.values() for p in ps}.values())
+        self.hedges = 0
+
+    def route(self, symbol: str) -> List[MarketDataProvider]:
+        return self.routes.get(symbol_class(symbol), [])
+
+    async def history(self, symbol: str, start_date: str, end_date: str,
+                      resolution: str = "1D") -> Tuple[Optional[str], list]:
+        """
+        -> (provider name, bars) from the first provider with data. (name, []) when every
+        provider answered but had no bars; (None, []) when any of them failed / timed out.
+        """
+        providers = list(self.route(symbol))
+        hedge_after = self.hedge_after.get(symbol_class(symbol))
+        running: Dict[asyncio.Task, str] = {}
+        failed = False
+        empty_source = None
+
+        def launch():
+            p = providers.pop(0)
+            task = asyncio.create_task(asyncio.to_thread(p.history, symbol, start_date, end_date, resolution))
+            running[task] = p.name
+
+        deadline = time.monotonic() + self.history_timeout
+        try:
+            if providers:
+                launch()
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait = min(hedge_after, remaining) if hedge_after is not None and providers else remaining
+                done, _ = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    result = None if task.cancelled() or task.exception() is not None else task.result()
+                    if result:
+                        return name, result
+                    if result is None:
+                        failed = True
+                    else:
+                        empty_source = empty_source or name
+                if providers and time.monotonic() < deadline and (not done or not running):
+                    if not done:
+                        self.hedges += 1
+                        print(f"      -> [MarketData] {running[next(iter(running))]} slow for {symbol}, hedging...")
+                    launch()
+            failed = failed or bool(running) or bool(providers) # Timed out before all answered
+        finally:
+            for task in running:
+                task.cancel() # Thread keeps running; its answer is ignored
+        return (None if failed else empty_source), []
+
+    async def quotes(self, symbols: List[str]) -> Dict[str, Quote]:
+        """Batch quotes: one quotes() call per provider, symbols it missed fall through the route."""
+        todo: Dict[str, List[MarketDataProvider]] = {s: list(self.route(s)) for s in dict.fromkeys(symbols)}
+        out: Dict[str, Quote] = {}
+        while True:
+            groups: Dict[int, Tuple[MarketDataProvider, List[str]]] = {}
+            for symbol, route in todo.items():
+                if route:
+                    p = route.pop(0)
+                    groups.setdefault(id(p), (p, []))[1].append(symbol)
+            if not groups:
+                return out
+
+            async def one(p, syms):
+                try:
+                    return await asyncio.to_thread(p.quotes, syms)
+                except RateLimited as e:
+                    print(f"⏳ [{p.name}] Rate limited: {e}")
+                    return {}
+                except Exception as e:
+                    print(f"⚠️ [{p.name}] Batch quote error: {e}")
+                    if not p.batch or len(syms) < 2:
+                        return {}
+                    # One bad symbol must not cost the whole batch: ask one by one
+                    return await asyncio.to_thread(MarketDataProvider.quotes, p, syms)
+
+            for found in await asyncio.gather(*(one(p, syms) for p, syms in groups.values())):
+                out.update(found)
+                for symbol in found:
+                    todo.pop(symbol, None)
+
+    def stats(self) -> dict:
+        return {
+            "routes": {cls: [p.name for p in ps] for cls, ps in self.routes.items()},
+            "hedge_after": self.hedge_after,
+            "hedges": self.hedges,
+            "providers": {p.name: p.stats() for p in self.providers},
+        }
+
+
+def build_market_data(mode: str = MARKET_DATA_MODE) -> MarketData:
+    if mode == "replay":
+        replay = ReplayProvider(MARKET_DATA_REPLAY_DIR, MARKET_DATA_REPLAY_SPEED)
+        print(f"📼 Market data: replaying {MARKET_DATA_REPLAY_DIR} (speed {MARKET_DATA_REPLAY_SPEED}x)")
+        return MarketData({cls: [replay] for cls in ("vn", "us", "crypto", "index")})
+
+    vci, yahoo, stooq = VnstockProvider(), YFinanceProvider(), StooqProvider()
+    if MARKET_DATA_RECORD_DIR:
+        vci, yahoo, stooq = (RecordingProvider(p, MARKET_DATA_RECORD_DIR) for p in (vci, yahoo, stooq))
+        print(f"⏺️ Market data: recording to {MARKET_DATA_RECORD_DIR}")
+    return MarketData(
+        {
+            "vn": [vci, yahoo],
+            "us": [yahoo, stooq],
+            "crypto": [yahoo],
+            "index": [yahoo],
+        },
+        # Vnstock history can hang for a long time: bring in Yahoo after 8s (was a hard timeout)
+        hedge_after={"vn": 8.0, "us": 5.0},
+    )
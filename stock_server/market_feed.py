@@ -0,0 +1,517 @@
+"""
+WebSocket Market Feed Hub.
+
+ONE redis.asyncio Pub/Sub subscriber per process, fanned out in memory to every
+connected WebSocket client:
+
+    Redis 'stock_updates:{symbol}' --(1 connection, push)--> FeedHub --> FeedClient (per socket)
+
+- Publishers use one channel per symbol (`feed_channel`); the hub pattern-subscribes once.
+  During the transition, quotes and ORDER_BOOK messages also go to the legacy shared
+  'stock_updates' channel (`feed_channels`) for subscribers outside this hub; the hub's
+  pattern does not match it. FEED_LEGACY_CHANNEL=0 stops that once they have moved.
+- No per-client Redis connection and no get_message() polling: the listener awaits
+  pushed messages, the socket loops await their own client.
+- Per-client symbol subscriptions: a client only gets the symbols it subscribed to
+  (clients that never subscribe keep receiving every symbol, as before).
+- Slow consumers: each socket has a bounded buffer drained by its own sender. Policy
+  (FEED_SLOW_POLICY): conflate (default: keep only the LATEST message per (symbol, type)),
+  drop_oldest, or disconnect past FEED_MAX_PENDING / FEED_MAX_LAG. A frame that stalls
+  FEED_SEND_TIMEOUT closes the socket. Lag and send latency are tracked per connection
+  (`connection_stats()`).
+- Encoding: JSON text (default) or MessagePack binary (`/ws/stocks?encoding=msgpack`),
+  where price levels become [price, quantity] pairs. Each message is encoded at most
+  once per encoding and the bytes are shared by every subscriber (`FeedMessage`).
+  Frames are further compressed by permessage-deflate when the client offers it.
+- Book stream: after `subscribe_book` a client gets one BOOK_SNAPSHOT (20 levels),
+  then BOOK_DIFF messages {prev_seq, seq, bids/asks: [[price, qty], ...]} with qty 0 =
+  level removed. Pending diffs are merged (never dropped), so seq stays contiguous per
+  client; on prev_seq != last seq the client resyncs via GET /api/orderbook/{symbol}/snapshot.
+  After an engine reset or shard restart (seq goes backwards) the server pushes a fresh
+  BOOK_SNAPSHOT; clients replace their book with it, whatever its seq.
+  Book-stream clients no longer get the top-5 ORDER_BOOK messages of that symbol.
+- Book-stream state (`PublishedBooks`) lives in Redis, so every API worker diffs against
+  the same published book; each publish is a compare-and-set + PUBLISH in one Lua script.
+- The listener reconnects with backoff if the Redis connection drops.
+
+Client protocol (text frames):
+    {"action": "subscribe", "symbols": ["AAPL", "VCB"]}
+    {"action": "unsubscribe", "symbols": ["AAPL"]}
+    {"action": "subscribe_book", "symbols": ["AAPL"]}
+    {"action": "unsubscribe_book", "symbols": ["AAPL"]}
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as aioredis
+
+from order_pipeline import LatencyHistogram
+
+try:
+    import msgpack
+except ImportError: # Optional: binary encoding disabled, clients fall back to JSON
+    msgpack = None
+
+FEED_CHANNEL = "stock_updates"
+FEED_LEGACY_CHANNEL = os.getenv("FEED_LEGACY_CHANNEL", "1") == "1" # Also publish on FEED_CHANNEL itself
+QUOTE = "QUOTE" # Message type of plain quote payloads (no 'type' field)
+ORDER_BOOK = "ORDER_BOOK" # Legacy top-5 full book
+BOOK_SNAPSHOT = "BOOK_SNAPSHOT"
+BOOK_DIFF = "BOOK_DIFF"
+ENCODINGS = ("json", "msgpack") if msgpack else ("json",)
+
+# Slow-consumer policies (what happens when a client's buffer passes FEED_MAX_PENDING)
+CONFLATE = "conflate" # Latest message per (symbol, type) only; overflow drops oldest
+DROP_OLDEST = "drop_oldest" # Every message kept in order; overflow drops oldest
+DISCONNECT = "disconnect" # Every message kept; overflow or lag > FEED_MAX_LAG closes the socket
+SLOW_POLICIES = (CONFLATE, DROP_OLDEST, DISCONNECT)
+FEED_SLOW_POLICY = os.getenv("FEED_SLOW_POLICY", CONFLATE)
+FEED_MAX_PENDING = 512 # Buffered messages per socket
+FEED_MAX_LAG = 5.0 # Seconds (disconnect policy)
+FEED_SEND_TIMEOUT = 10.0 # One frame stuck this long = dead link, closed under every policy
+
+_CLIENT_IDS = itertools.count(1)
+
+
+def feed_channel(symbol: str) -> str:
+    return f"{FEED_CHANNEL}:{symbol}"
+
+
+def feed_channels(symbol: str) -> List[str]:
+    """Channels a quote / ORDER_BOOK is published on: per-symbol, plus the legacy shared one."""
+    return [feed_channel(symbol), FEED_CHANNEL] if FEED_LEGACY_CHANNEL else [feed_channel(symbol)]
+
+
+def _compact(obj):
+    # {"price": p, "quantity": q} levels -> [p, q] (most of a book payload)
+    if isinstance(obj, dict):
+        if len(obj) == 2 and "price" in obj and "quantity" in obj:
+            return [obj["price"], obj["quantity"]]
+        return {k: _compact(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_compact(v) for v in obj]
+    return obj
+
+
+def merge_book(base: dict, diff: dict) -> dict:
+    """Applies a BOOK_DIFF (absolute level quantities) onto a pending BOOK_SNAPSHOT or BOOK_DIFF."""
+    out = dict(base, seq=diff["seq"], timestamp=diff["timestamp"])
+    for side in ("bids", "asks"):
+        levels = {p: q for p, q in base[side]}
+        levels.update((p, q) for p, q in diff[side])
+        if base["type"] == BOOK_SNAPSHOT:
+            levels = {p: q for p, q in levels.items() if q > 0}
+        out[side] = [[p, q] for p, q in sorted(levels.items(), reverse=(side == "bids"))]
+    return out
+
+
+# Book-stream state shared by the API workers:
+#   book_stream:{symbol}    HASH seq, bids, asks (JSON [[price, qty], ...]) as last published,
+#                                broadcast_seq (book seq of the last ORDER_BOOK)
+#   book_stream:symbols     SET of symbols with a published state
+#   book_stream:dirty       SET of symbols changed since the last broadcast flush
+BOOK_STREAM_SYMBOLS = "book_stream:symbols"
+BOOK_STREAM_DIRTY = "book_stream:dirty"
+
+# KEYS: state hash, symbols set
+# ARGV: expected seq ('' = no state), channel, new seq ('' = keep state), bids, asks,
+#       book-stream message ('' = none), ORDER_BOOK seq ('' = none), ORDER_BOOK message, symbol,
+#       legacy channel for the ORDER_BOOK ('' = none)
+# Returns 1 when published, 0 when another worker moved the state first (nothing written)
+PUBLISH_BOOK_LUA = """
+local seq = redis.call('HGET', KEYS[1], 'seq') or ''
+if seq ~= ARGV[1] then
+    return 0
+end
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], 'seq', ARGV[3], 'bids', ARGV[4], 'asks', ARGV[5])
+    redis.call('SADD', KEYS[2], ARGV[9])
+end
+if ARGV[6] ~= '' then
+    redis.call('PUBLISH', ARGV[2], ARGV[6])
+end
+if ARGV[7] ~= '' then
+    redis.call('HSET', KEYS[1], 'broadcast_seq', ARGV[7])
+    redis.call('PUBLISH', ARGV[2], ARGV[8])
+    if ARGV[10] ~= '' then
+        redis.call('PUBLISH', ARGV[10], ARGV[8])
+    end
+end
+return 1
+"""
+
+
+def book_stream_key(symbol: str) -> str:
+    return f"book_stream:{symbol}"
+
+
+def _levels_json(levels: dict) -> str:
+    return json.dumps([[p, q] for p, q in levels.items()])
+
+
+class PublishedBooks:
+    """
+    Book-stream state as last published, in Redis (sync client) so any worker can flush:
+    dirty symbols are taken by whichever broadcaster flushes first, and `publish()` only
+    lands on the state it was diffed against, so messages leave in seq order.
+    State tuples: (seq, {price: qty} bids, {price: qty} asks, broadcast_seq or None).
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._publish = None
+
+    def mark_dirty(self, *symbols: str):
+        if symbols:
+            self.client.sadd(BOOK_STREAM_DIRTY, *symbols)
+
+    def take_dirty(self) -> List[str]:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.smembers(BOOK_STREAM_DIRTY)
+        pipe.delete(BOOK_STREAM_DIRTY)
+        return list(pipe.execute()[0])
+
+    def load(self, symbols: List[str]) -> Dict[str, Optional[Tuple]]:
+        pipe = self.client.pipeline(transaction=False)
+        for symbol in symbols:
+            pipe.hmget(book_stream_key(symbol), "seq", "bids", "asks", "broadcast_seq")
+        states = {}
+        for symbol, (seq, bids, asks, broadcast_seq) in zip(symbols, pipe.execute()):
+            states[symbol] = None if seq is None else (
+                int(seq), {p: q for p, q in json.loads(bids)}, {p: q for p, q in json.loads(asks)},
+                int(broadcast_seq) if broadcast_seq is not None else None)
+        return states
+
+    def publish(self, client, symbol: str, expected_seq: Optional[int], channel: str,
+                state: Optional[Tuple] = None, message: Optional[dict] = None,
+                book_seq: Optional[int] = None, book: Optional[dict] = None):
+        """
+        Queues (on a pipeline) or runs the compare-and-set: moves the state to `state`
+        (seq, bids, asks), publishes `message` and/or the ORDER_BOOK `book` at `book_seq`.
+        """
+        if self._publish is None:
+            self._publish = self.client.register_script(PUBLISH_BOOK_LUA)
+        seq, bids, asks = state or ("", {}, {})
+        return self._publish(keys=[book_stream_key(symbol), BOOK_STREAM_SYMBOLS], args=[
+            "" if expected_seq is None else expected_seq, channel, seq,
+            _levels_json(bids) if state else "", _levels_json(asks) if state else "",
+            json.dumps(message) if message else "",
+            "" if book_seq is None else book_seq, json.dumps(book) if book else "", symbol,
+            FEED_CHANNEL if FEED_LEGACY_CHANNEL else "",
+        ], client=client)
+
+    def mark_all_dirty(self):
+        """Engine reset: every published symbol is flushed again (and re-sends its ORDER_BOOK)."""
+        symbols = list(self.client.smembers(BOOK_STREAM_SYMBOLS))
+        if symbols:
+            pipe = self.client.pipeline(transaction=False)
+            for symbol in symbols:
+                pipe.hdel(book_stream_key(symbol), "broadcast_seq")
+            pipe.sadd(BOOK_STREAM_DIRTY, *symbols)
+            pipe.execute()
+
+
+class FeedMessage:
+    """One feed message, encoded lazily once per encoding and shared by all clients."""
+    __slots__ = ("text", "data", "_binary")
+
+    def __init__(self, text: str, data: Optional[dict] = None):
+        self.text = text # JSON as published
+        self.data = data # Parsed form (for the binary encoding)
+        self._binary: Optional[bytes] = None
+
+    @classmethod
+    def from_data(cls, data: dict) -> "FeedMessage":
+        return cls(json.dumps(data), data)
+
+    @property
+    def kind(self) -> str:
+        return self.data.get("type", QUOTE) if isinstance(self.data, dict) else QUOTE
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            data = _compact(self.data) if self.data is not None else self.text # Non-JSON: sent as a string
+            self._binary = msgpack.packb(data, use_bin_type=True)
+        return self._binary
+
+
+class SlowConsumer(Exception):
+    """Client fell too far behind (disconnect policy) or a single send stalled."""
+
+
+class FeedClient:
+    """One connected WebSocket: its subscriptions, bounded outbound buffer and lag metrics."""
+
+    def __init__(self, encoding: str = "json", policy: str = FEED_SLOW_POLICY,
+                 max_pending: int = FEED_MAX_PENDING, peer: str = ""):
+        self.id = next(_CLIENT_IDS)
+        self.peer = peer
+        self.encoding = encoding if encoding in ENCODINGS else "json"
+        self.policy = policy if policy in SLOW_POLICIES else CONFLATE
+        self.max_pending = max_pending
+        self.symbols: Optional[Set[str]] = None # None = every symbol (never subscribed)
+        # Outbound buffer, oldest first: (symbol, type) -> latest message when conflating,
+        # (symbol, type, n) per message otherwise; book streams always use (symbol, "BOOK")
+        self.pending: Dict[tuple, FeedMessage] = {}
+        self.books: Dict[str, int] = {} # Book-stream symbol -> seq of the last snapshot/diff queued
+        self.ready = asyncio.Event()
+        self.connected_at = time.time()
+        self.oldest_at = 0.0 # Enqueue time of the oldest unsent message
+        self.overflowed = False
+        self.queued = 0
+        self.sent = 0
+        self.conflated = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+        self.lag_hist = LatencyHistogram() # Enqueue -> taken for sending
+        self.send_hist = LatencyHistogram() # Per-frame websocket send
+
+    def _enqueue(self, key: tuple, msg: FeedMessage):
+        if self.overflowed:
+            return # Being disconnected: stop buffering
+        if not self.pending:
+            self.oldest_at = time.time()
+        self.pending[key] = msg
+        self.queued += 1
+        if len(self.pending) > self.max_pending:
+            if self.policy == DISCONNECT:
+                self.overflowed = True
+            else:
+                # Drop oldest (a dropped book entry shows up as a seq gap -> client resyncs)
+                del self.pending[next(iter(self.pending))]
+                self.dropped += 1
+        self.ready.set()
+
+    def offer(self, key: Tuple[str, str], msg: FeedMessage):
+        if self.policy != CONFLATE:
+            key = key + (self.queued,) # Every message kept, in order
+        elif key in self.pending:
+            self.conflated += 1 # Superseded before it was sent
+        self._enqueue(key, msg)
+
+    def offer_book(self, symbol: str, msg: FeedMessage):
+        """
+        Queues a BOOK_SNAPSHOT/BOOK_DIFF; diffs already covered are skipped, pending ones merged.
+        A snapshot always replaces the client's book (and anything pending), even at a lower seq.
+        """
+        data = msg.data
+        last_seq = self.books.get(symbol)
+        if last_seq is None:
+            return
+        key = (symbol, "BOOK")
+        pending = self.pending.get(key)
+        if data["type"] == BOOK_DIFF:
+            if data["seq"] <= last_seq:
+                return # Already part of the snapshot the client has/gets
+            if pending is not None:
+                msg = FeedMessage.from_data(merge_book(pending.data, data))
+                self.conflated += 1
+        self.books[symbol] = data["seq"]
+        self._enqueue(key, msg)
+
+    def lag(self) -> float:
+        return time.time() - self.oldest_at if self.pending else 0.0
+
+    async def send(self, websocket, msg: FeedMessage):
+        if self.overflowed:
+            raise SlowConsumer(f"{len(self.pending)} messages behind") # Stop mid-batch
+        start = time.perf_counter()
+        try:
+            frame = websocket.send_bytes(msg.binary()) if self.encoding == "msgpack" else websocket.send_text(msg.text)
+            await asyncio.wait_for(frame, FEED_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise SlowConsumer(f"send stalled > {FEED_SEND_TIMEOUT}s")
+        finally:
+            self.send_hist.observe(time.perf_counter() - start)
+        self.sent += 1
+
+    async def drain(self) -> List[FeedMessage]:
+        """Waits for data, then takes everything pending (oldest first)."""
+        await self.ready.wait()
+        self.ready.clear()
+        lag = self.lag()
+        if self.overflowed or (self.policy == DISCONNECT and lag > FEED_MAX_LAG):
+            raise SlowConsumer(f"{len(self.pending)} messages / {lag:.1f}s behind")
+        self.lag_hist.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        out = list(self.pending.values())
+        self.pending = {}
+        return out
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "peer": self.peer,
+            "encoding": self.encoding,
+            "policy": self.policy,
+            "connected_s": round(time.time() - self.connected_at, 1),
+            "symbols": len(self.symbols) if self.symbols is not None else "all",
+            "books": len(self.books),
+            "pending": len(self.pending),
+            "lag_s": round(self.lag(), 3),
+            "max_lag_s": round(self.max_lag, 3),
+            "queued": self.queued,
+            "sent": self.sent,
+            "conflated": self.conflated,
+            "dropped": self.dropped,
+            "lag": self.lag_hist.snapshot(),
+            "send": self.send_hist.snapshot(),
+        }
+
+
+class FeedHub:
+    def __init__(self, url: str, channel: str = FEED_CHANNEL):
+        self.url = url
+        self.pattern = f"{channel}:*"
+        self.clients: Set[FeedClient] = set()
+        self.firehose: Set[FeedClient] = set() # Clients without explicit subscriptions
+        self.by_symbol: Dict[str, Set[FeedClient]] = {}
+        self.by_book: Dict[str, Set[FeedClient]] = {}
+        self.last: Dict[Tuple[str, str], FeedMessage] = {} # Latest per (symbol, type), replayed on subscribe
+        self.task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.reconnects = 0
+        self.slow_disconnects = 0
+
+    # --- Lifecycle ---
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._listen(), name="feed-hub")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _listen(self):
+        backoff = 1
+        while True:
+            client = aioredis.from_url(self.url, decode_responses=True, socket_connect_timeout=5)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(self.pattern)
+                print(f"📡 [FEED] Subscribed to '{self.pattern}' ({len(self.clients)} clients)")
+                backoff = 1
+                async for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self.received += 1
+                        self.fan_out(message["channel"].split(":", 1)[1], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.reconnects += 1
+                print(f"⚠️ [FEED] Subscriber error, reconnecting in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                try:
+                    await pubsub.aclose()
+                    await client.aclose()
+                except Exception:
+                    pass
+
+    # --- Fan-out ---
+    def fan_out(self, symbol: str, payload: str):
+        try:
+            msg = FeedMessage(payload, json.loads(payload)) # Parsed once, not per client
+        except Exception:
+            msg = FeedMessage(payload)
+        kind = msg.kind
+        if kind in (BOOK_DIFF, BOOK_SNAPSHOT):
+            for c in self.by_book.get(symbol, ()):
+                c.offer_book(symbol, msg)
+            return
+        key = (symbol, kind)
+        self.last[key] = msg
+        for c in self.firehose:
+            if kind != ORDER_BOOK or symbol not in c.books:
+                c.offer(key, msg)
+        for c in self.by_symbol.get(symbol, ()):
+            if kind != ORDER_BOOK or symbol not in c.books:
+                c.offer(key, msg)
+
+    def register(self, encoding: str = "json", policy: Optional[str] = None, peer: str = "") -> FeedClient:
+        c = FeedClient(encoding, policy or FEED_SLOW_POLICY, peer=peer)
+        self.clients.add(c)
+        self.firehose.add(c)
+        return c
+
+    def unregister(self, c: FeedClient):
+        self.clients.discard(c)
+        self.firehose.discard(c)
+        for symbol in c.symbols or ():
+            self._drop_interest(symbol, c)
+        for symbol in list(c.books):
+            self._drop_interest(symbol, c, self.by_book)
+
+    def subscribe(self, c: FeedClient, symbols: List[str]) -> List[str]:
+        if c.symbols is None: # First subscribe: leave the all-symbols feed
+            c.symbols = set()
+            self.firehose.discard(c)
+            c.pending.clear()
+        added = [s for s in symbols if s not in c.symbols]
+        for symbol in added:
+            c.symbols.add(symbol)
+            self.by_symbol.setdefault(symbol, set()).add(c)
+            # Current state right away instead of waiting for the next tick
+            for key, msg in self.last.items():
+                if key[0] == symbol:
+                    c.offer(key, msg)
+        return sorted(c.symbols)
+
+    def unsubscribe(self, c: FeedClient, symbols: List[str]) -> List[str]:
+        if c.symbols is None:
+            return []
+        for symbol in symbols:
+            if symbol in c.symbols:
+                c.symbols.discard(symbol)
+                self._drop_interest(symbol, c)
+            for key in [k for k in c.pending if k[0] == symbol and k[1] != "BOOK"]:
+                del c.pending[key]
+        return sorted(c.symbols)
+
+    def subscribe_book(self, c: FeedClient, symbol: str, snapshot: FeedMessage):
+        """
+        Starts the book stream with `snapshot` (a BOOK_SNAPSHOT). Call without awaiting
+        between reading the snapshot and this, so no diff can slip in between.
+        """
+        self.by_book.setdefault(symbol, set()).add(c)
+        c.books[symbol] = -1
+        c.pending.pop((symbol, ORDER_BOOK), None)
+        c.offer_book(symbol, snapshot)
+
+    def unsubscribe_book(self, c: FeedClient, symbol: str):
+        c.books.pop(symbol, None)
+        c.pending.pop((symbol, "BOOK"), None)
+        self._drop_interest(symbol, c, self.by_book)
+
+    def _drop_interest(self, symbol: str, c: FeedClient, index: Optional[dict] = None):
+        index = self.by_symbol if index is None else index
+        subs = index.get(symbol)
+        if subs is not None:
+            subs.discard(c)
+            if not subs:
+                del index[symbol]
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "firehose_clients": len(self.firehose),
+            "subscribed_symbols": len(self.by_symbol),
+            "book_streams": sum(len(c.books) for c in self.clients),
+            "received": self.received,
+            "reconnects": self.reconnects,
+            "conflated": sum(c.conflated for c in self.clients),
+            "dropped": sum(c.dropped for c in self.clients),
+            "slow_disconnects": self.slow_disconnects,
+            "max_lag_s": round(max((c.lag() for c in self.clients), default=0.0), 3),
+        }
+
+    def connection_stats(self) -> List[dict]:
+        """Per-connection lag metrics, worst lag first."""
+        return [c.stats() for c in sorted(self.clients, key=lambda c: c.lag(), reverse=True)]
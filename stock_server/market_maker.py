@@ -2,7 +2,10 @@ import asyncio
 import time
 import random
 import uuid
-from matching_engine import engine, Order, OrderSide, OrderType, OrderStatus
+import inspect
+from matching_engine import Order, OrderSide, OrderType, OrderStatus
+from engine_service import get_engine
+import order_state
 from vnstock import Vnstock
 
 # Simple caching for bot start price to avoid frequent API calls
@@ -10,6 +13,11 @@ from vnstock import Vnstock
 # The Reference Price can be updated from real API every minute.
 PRICE_CACHE = {}
 
+# Resting bot quote ids per symbol, replaced on every refresh cycle
+BOT_QUOTES = {}
+
+engine = get_engine() # In-process engine or sharded engine service client
+
 async def fetch_reference_price(symbol: str) -> float:
     # MVP: Mock fetching or simple logic
     # Try to get from cache
@@ -44,9 +52,8 @@ async def run_bot_cycle(symbol: str, callback=None, redis_client=None):
     spread_percent = 0.002 # 0.2% Spread
     num_orders = 3
     
-    # Helper to sync to Redis
-    def sync_to_redis(order: Order):
-        if not redis_client: return
+    # Helper to sync to Redis (queued on the cycle's pipeline)
+    def sync_to_redis(pipe, order: Order):
         data = {
             "order_id": order.id,
             "user_id": order.user_id,
@@ -59,53 +66,62 @@ async def run_bot_cycle(symbol: str, callback=None, redis_client=None):
             "status": "pending",
             "timestamp": order.timestamp
         }
-        redis_client.hset(f"order:{order.id}", mapping=data)
-        redis_client.sadd("pending_orders", order.id)
+        pipe.hset(f"order:{order.id}", mapping=data)
+        order_state.add_pending(pipe, order.id, order.symbol, data["side"], order.price, order.remaining_quantity)
 
-    # 1. Place ASKS (Sell Orders) above ref_price
-    for i in range(num_orders):
-        # Price increases as we go up the book
-        level_price = ref_price * (1 + spread_percent * (i + 1))
+    def round_price(level_price: float) -> float:
         # Round logic (important for VND vs USD)
         if ref_price > 1000: # VND
-            level_price = round(level_price / 50) * 50 # Round to nearest 50 dong
-        else: # USD
-            level_price = round(level_price, 2)
-            
-        ask_order = Order(
+            return round(level_price / 50) * 50 # Round to nearest 50 dong
+        return round(level_price, 2) # USD
+
+    batch = []
+
+    # 1. ASKS (Sell Orders) above ref_price
+    for i in range(num_orders):
+        # Price increases as we go up the book
+        batch.append(Order(
             id=f"BOT_ASK_{uuid.uuid4().hex[:8]}",
             user_id="MARKET_MAKER_BOT",
             symbol=symbol,
             side=OrderSide.SELL,
             type=OrderType.LIMIT,
-            price=level_price,
+            price=round_price(ref_price * (1 + spread_percent * (i + 1))),
             quantity=random.randint(10, 100) * 10
-        )
-        sync_to_redis(ask_order) # Persist first
-        trades = engine.place_order(ask_order)
-        if trades and callback: await callback(trades)
+        ))
 
-    # 2. Place BIDS (Result Orders) below ref_price
+    # 2. BIDS (Buy Orders) below ref_price
     for i in range(num_orders):
         # Price decreases as we go down
-        level_price = ref_price * (1 - spread_percent * (i + 1))
-        if ref_price > 1000:
-            level_price = round(level_price / 50) * 50
-        else:
-            level_price = round(level_price, 2)
-
-        bid_order = Order(
+        batch.append(Order(
             id=f"BOT_BID_{uuid.uuid4().hex[:8]}",
             user_id="MARKET_MAKER_BOT",
             symbol=symbol,
             side=OrderSide.BUY,
             type=OrderType.LIMIT,
-            price=level_price,
+            price=round_price(ref_price * (1 - spread_percent * (i + 1))),
             quantity=random.randint(10, 100) * 10
-        )
-        sync_to_redis(bid_order) # Persist first
-        trades = engine.place_order(bid_order)
-        if trades and callback: await callback(trades)
+        ))
+
+    # 3. Pull the previous cycle's quotes (O(1) cancel per order) so the book
+    # holds the current ladder instead of accumulating stale bot orders.
+    stale_ids = [oid for oid in BOT_QUOTES.get(symbol, []) if engine.cancel_order(oid, symbol)]
+    BOT_QUOTES[symbol] = [o.id for o in batch]
+
+    # 4. Persist first: stale cancels + new ladder in ONE Redis round trip
+    if redis_client:
+        pipe = redis_client.pipeline()
+        for oid in stale_ids:
+            order_state.expire_order(pipe, oid, symbol) # Stale quote: atomic close (Lua)
+        for order in batch:
+            sync_to_redis(pipe, order)
+        pipe.execute()
+
+    # 5. Match the whole ladder in one engine step
+    trades = [t for group in engine.place_orders(batch) for t in group]
+    if trades and callback:
+        result = callback(trades)
+        if inspect.isawaitable(result): await result
         
     # print(f"🤖 Bot refreshed liquidity for {symbol} around {ref_price}")
 
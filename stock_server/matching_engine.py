@@ -1,10 +1,9 @@
 import time
-import heapq
-import uuid
+import itertools
 import threading
-from typing import List, Dict, Optional
+from bisect import bisect_left, insort
+from typing import List, Dict, NamedTuple, Optional, Tuple
 from enum import Enum
-import dataclasses
 
 # --- Enum Types ---
 class OrderSide(str, Enum):
@@ -21,132 +20,486 @@ class OrderStatus(str, Enum):
     FILLED = "FILLED"
     CANCELED = "CANCELED"
 
+# --- Price Ticks & Sequences ---
+# Prices live in the book as integer ticks: 1 tick = 0.01 currency unit, which covers
+# VND step sizes (integer dong) and USD cents exactly. Float prices only exist at the API edge.
+PRICE_SCALE = 100
+
+def to_ticks(price: float) -> int:
+    return int(round(float(price) * PRICE_SCALE))
+
+def from_ticks(ticks: int) -> float:
+    return ticks / PRICE_SCALE
+
+# Monotonic sequence numbers: order time priority + trade ids (next() on count is atomic in CPython)
+_ORDER_SEQ = itertools.count(1)
+_TRADE_SEQ = itertools.count(1)
+_SEQ_LOCK = threading.Lock()
+# Boot prefix keeps sequence-based trade ids unique across restarts
+TRADE_ID_PREFIX = f"T{int(time.time() * 1000):x}-"
+
+def next_order_seq() -> int:
+    return next(_ORDER_SEQ)
+
+def advance_order_seq(seq: int):
+    """Keeps newly issued order sequence numbers above `seq` (after restoring persisted orders)."""
+    global _ORDER_SEQ
+    with _SEQ_LOCK:
+        nxt = next(_ORDER_SEQ)
+        if nxt <= seq:
+            _ORDER_SEQ = itertools.count(seq + 1)
+
+def set_trade_id_prefix(tag: str):
+    """Adds `tag` (e.g. the engine shard) to the boot prefix: processes booted in the same millisecond differ."""
+    global TRADE_ID_PREFIX
+    TRADE_ID_PREFIX = f"T{int(time.time() * 1000):x}{tag}-"
+
 # --- Data Models ---
-@dataclasses.dataclass(order=True)
 class Order:
-    # Custom sort order for Heap:
-    # - Bids: Highest Price first, then Earliest Timestamp
-    # - Asks: Lowest Price first, then Earliest Timestamp
-    # We'll handle sorting logic in the OrderBook add method, mainly just store data here.
-    
-    id: str = dataclasses.field(compare=False)
-    user_id: str = dataclasses.field(compare=False)
-    symbol: str = dataclasses.field(compare=False)
-    side: OrderSide = dataclasses.field(compare=False)
-    type: OrderType = dataclasses.field(compare=False)
-    price: float # Limit Price (MAX for Market Buy, 0 for Market Sell generally, but handled via logic)
-    quantity: int = dataclasses.field(compare=False)
-    filled_quantity: int = dataclasses.field(default=0, compare=False)
-    timestamp: float = dataclasses.field(default_factory=time.time, compare=False)
-    status: OrderStatus = dataclasses.field(default=OrderStatus.PENDING, compare=False)
+    """
+    Compact resting-order record (__slots__, no per-instance dict).
+    - price_ticks: integer limit price in ticks (see PRICE_SCALE); `price` is the float view.
+    - seq: monotonically increasing sequence number = time priority inside a price level.
+    - timestamp: wall-clock time, kept for Redis/UI only.
+    """
+    __slots__ = ("id", "user_id", "symbol", "side", "type", "price_ticks", "quantity",
+                 "filled_quantity", "timestamp", "status", "seq")
+
+    def __init__(self, id: str, user_id: str, symbol: str, side: OrderSide, type: OrderType,
+                 price: float = 0.0, quantity: int = 0, filled_quantity: int = 0,
+                 timestamp: Optional[float] = None, status: OrderStatus = OrderStatus.PENDING,
+                 seq: Optional[int] = None, price_ticks: Optional[int] = None):
+        self.id = id
+        self.user_id = user_id
+        self.symbol = symbol
+        self.side = side
+        self.type = type
+        # Limit Price (MAX for Market Buy, 0 for Market Sell generally, but handled via logic)
+        self.price_ticks = to_ticks(price) if price_ticks is None else price_ticks
+        self.quantity = quantity
+        self.filled_quantity = filled_quantity
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.status = status
+        self.seq = next_order_seq() if seq is None else seq
+
+    @property
+    def price(self) -> float:
+        return self.price_ticks / PRICE_SCALE
 
     @property
     def remaining_quantity(self) -> int:
         return self.quantity - self.filled_quantity
 
     def to_dict(self):
-        return dataclasses.asdict(self)
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "symbol": self.symbol,
+            "side": self.side,
+            "type": self.type,
+            "price": self.price,
+            "quantity": self.quantity,
+            "filled_quantity": self.filled_quantity,
+            "timestamp": self.timestamp,
+            "status": self.status,
+            "seq": self.seq
+        }
+
+    def __repr__(self):
+        return (f"Order(id={self.id!r}, symbol={self.symbol!r}, side={self.side.value}, "
+                f"price={self.price}, qty={self.filled_quantity}/{self.quantity}, "
+                f"seq={self.seq}, status={self.status.value})")
+
+# Price levels per side kept in the lock-free BookSnapshot
+SNAPSHOT_LEVELS = 20
+
+class BookSnapshot(NamedTuple):
+    """
+    Immutable top-of-book / L2 view, republished by the book after every change
+    that touches its top SNAPSHOT_LEVELS. Readers grab it without the book lock.
+    bids/asks: ((price, total_qty), ...) best level first.
+    """
+    symbol: str
+    seq: int
+    timestamp: float
+    bids: Tuple[Tuple[float, int], ...]
+    asks: Tuple[Tuple[float, int], ...]
+
+    @property
+    def best_bid(self) -> float:
+        return self.bids[0][0] if self.bids else 0.0
+
+    @property
+    def best_ask(self) -> float:
+        return self.asks[0][0] if self.asks else 0.0
+
+    def to_dict(self, limit: int = SNAPSHOT_LEVELS):
+        return {
+            "bids": [{"price": p, "quantity": q} for p, q in self.bids[:limit]],
+            "asks": [{"price": p, "quantity": q} for p, q in self.asks[:limit]]
+        }
+
+class OrderNode:
+    """Intrusive list node linking a resting order into its PriceLevel."""
+    __slots__ = ("order", "prev", "next")
+
+    def __init__(self, order: Order):
+        self.order = order
+        self.prev: Optional["OrderNode"] = None
+        self.next: Optional["OrderNode"] = None
+
+class PriceLevel:
+    """
+    FIFO queue of resting orders at one price (doubly linked list).
+    Head is the order with time priority; popping a filled head and unlinking
+    a cancelled node are both O(1).
+    """
+    __slots__ = ("ticks", "price", "head_node", "tail_node", "count", "total_qty")
+
+    def __init__(self, ticks: int):
+        self.ticks = ticks
+        self.price = ticks / PRICE_SCALE # Float view for snapshots/UI
+        self.head_node: Optional[OrderNode] = None
+        self.tail_node: Optional[OrderNode] = None
+        self.count = 0
+        self.total_qty = 0 # Aggregated remaining quantity (L2), kept incrementally
+
+    def append(self, order: Order) -> OrderNode:
+        node = OrderNode(order)
+        after = self.tail_node
+        # Late arrival carrying an older sequence (e.g. replay): keep time priority
+        while after is not None and after.order.seq > order.seq:
+            after = after.prev
+
+        node.prev = after
+        if after is None:
+            node.next = self.head_node
+            self.head_node = node
+        else:
+            node.next = after.next
+            after.next = node
+        if node.next is None:
+            self.tail_node = node
+        else:
+            node.next.prev = node
+        self.count += 1
+        self.total_qty += order.remaining_quantity
+        return node
+
+    def unlink(self, node: OrderNode):
+        if node.prev is None:
+            self.head_node = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is None:
+            self.tail_node = node.prev
+        else:
+            node.next.prev = node.prev
+        node.prev = node.next = None
+        self.count -= 1
+        self.total_qty -= node.order.remaining_quantity
+
+    @property
+    def head(self) -> Order:
+        return self.head_node.order
+
+    @property
+    def orders(self):
+        node = self.head_node
+        while node is not None:
+            yield node.order
+            node = node.next
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+class BookSide:
+    """
+    One side of the book: price levels keyed by an integer tick key, plus a sorted key index.
+    Keys are stored ascending with the BEST price last (bids: ticks, asks: -ticks),
+    so best level lookup and removal of an emptied best level are O(1).
+    A NEW price level costs a binary search plus a list insert: O(L) in the number of
+    levels (one C memmove), not O(log L). Orders joining an existing level, fills and
+    cancels never touch the key list, except to drop a level that became empty.
+    """
+    def __init__(self, is_bid: bool):
+        self.is_bid = is_bid
+        self.levels: Dict[int, PriceLevel] = {}
+        self._keys: List[int] = []
+        self.order_count = 0
+
+    def _key(self, ticks: int) -> int:
+        return ticks if self.is_bid else -ticks
+
+    def add(self, order: Order):
+        key = self._key(order.price_ticks)
+        level = self.levels.get(key)
+        if level is None:
+            level = PriceLevel(order.price_ticks)
+            self.levels[key] = level
+            insort(self._keys, key)
+        node = level.append(order)
+        self.order_count += 1
+        return level, node
+
+    def unlink(self, level: PriceLevel, node: OrderNode):
+        level.unlink(node)
+        self.order_count -= 1
+        if not level:
+            self.remove_level(level)
+
+    def best(self) -> Optional[PriceLevel]:
+        if not self._keys:
+            return None
+        return self.levels[self._keys[-1]]
+
+    def remove_level(self, level: PriceLevel):
+        key = self._key(level.ticks)
+        del self.levels[key]
+        if self._keys[-1] == key:
+            self._keys.pop()
+        else:
+            self._keys.pop(bisect_left(self._keys, key))
+
+    def iter_levels(self):
+        # Best price first
+        for key in reversed(self._keys):
+            yield self.levels[key]
+
+    def top_levels(self, n: int) -> Tuple[Tuple[float, int], ...]:
+        keys, levels = self._keys, self.levels
+        return tuple((levels[k].price, levels[k].total_qty) for k in keys[:-n - 1:-1])
+
+    def __len__(self):
+        return self.order_count
+
+    def __bool__(self):
+        return self.order_count > 0
 
 class OrderBook:
-    def __init__(self, symbol: str):
+    def __init__(self, symbol: str, index: Optional[Dict[str, tuple]] = None, journal=None):
         self.symbol = symbol
-        # We use lists and sort them. For MVP high-frequency is not needed.
-        # Bids: [Order(price=100), Order(price=99)] (Desc)
-        self.bids: List[Order] = [] 
-        # Asks: [Order(price=101), Order(price=102)] (Asc)
-        self.asks: List[Order] = []
+        # Price-level indexed book: each side maps price -> FIFO PriceLevel.
+        # Bids: best = highest price. Asks: best = lowest price.
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
+        # Resting order index: order_id -> (book, level, node). Shared with the engine.
+        self.index = index if index is not None else {}
         self.lock = threading.Lock()
+        # Lock-free readers use this; replaced (never mutated) under the lock.
+        self.snapshot = BookSnapshot(symbol, 0, time.time(), (), ())
+        self._dirty_bids = False
+        self._dirty_asks = False
+        # Optional EngineJournal (order_journal.py). Events are appended under self.lock
+        # so the per-book journal order matches the in-memory mutation order.
+        self.journal = journal
+
+    def _side_of(self, order: Order) -> BookSide:
+        return self.bids if order.side == OrderSide.BUY else self.asks
+
+    def _touch(self, side: BookSide, ticks: int):
+        # Only changes inside the published top levels require a new snapshot
+        keys = side._keys
+        if side.is_bid:
+            if len(keys) <= SNAPSHOT_LEVELS or ticks >= keys[-SNAPSHOT_LEVELS]:
+                self._dirty_bids = True
+        elif len(keys) <= SNAPSHOT_LEVELS or -ticks >= keys[-SNAPSHOT_LEVELS]:
+            self._dirty_asks = True
+
+    def _publish(self):
+        # Caller holds self.lock. Rebuilds only the side(s) that changed.
+        if not (self._dirty_bids or self._dirty_asks):
+            return
+        prev = self.snapshot
+        self.snapshot = BookSnapshot(
+            self.symbol,
+            prev.seq + 1,
+            time.time(),
+            self.bids.top_levels(SNAPSHOT_LEVELS) if self._dirty_bids else prev.bids,
+            self.asks.top_levels(SNAPSHOT_LEVELS) if self._dirty_asks else prev.asks
+        )
+        self._dirty_bids = self._dirty_asks = False
 
     def add_order(self, order: Order):
         with self.lock:
-            if order.side == OrderSide.BUY:
-                self.bids.append(order)
-                # Sort Bids: Descending Price, Ascending Time
-                self.bids.sort(key=lambda x: (-x.price, x.timestamp))
+            if self.journal is not None:
+                self.journal.append_new(order)
+            self._rest(order)
+
+    def _rest(self, order: Order, publish: bool = True):
+        # Caller holds self.lock
+        side = self._side_of(order)
+        level, node = side.add(order)
+        self.index[order.id] = (self, level, node)
+        self._touch(side, order.price_ticks)
+        if publish:
+            self._publish()
+
+    def restore_order(self, order: Order):
+        """Replay path: rests an order exactly as recorded. No matching, no journaling."""
+        with self.lock:
+            self._rest(order)
+
+    def apply_fill(self, order_id: str, qty: int) -> Optional[Order]:
+        """Replay path: applies a recorded fill to a resting order. Never generates trades."""
+        with self.lock:
+            entry = self.index.get(order_id)
+            if entry is None or entry[0] is not self:
+                return None
+            _, level, node = entry
+            order = node.order
+            side = self._side_of(order)
+            self._touch(side, order.price_ticks)
+            order.filled_quantity += qty
+            level.total_qty -= qty
+            if order.remaining_quantity <= 0:
+                order.status = OrderStatus.FILLED
+                side.unlink(level, node)
+                del self.index[order_id]
             else:
-                self.asks.append(order)
-                # Sort Asks: Ascending Price, Ascending Time
-                self.asks.sort(key=lambda x: (x.price, x.timestamp))
-    
-    def remove_order(self, order_id: str):
+                order.status = OrderStatus.PARTIAL
+            self._publish()
+            return order
+
+    def resting_orders(self):
+        """Resting orders in priority order (bids best-first FIFO, then asks). Caller holds self.lock."""
+        for side in (self.bids, self.asks):
+            for level in side.iter_levels():
+                yield from level.orders
+
+    def remove_order(self, order_id: str) -> Optional[Order]:
+        """
+        Removes a resting order in O(1) via the id index.
+        Returns the removed order, or None if it is no longer resting (filled/unknown).
+        """
+        with self.lock:
+            entry = self.index.get(order_id)
+            if entry is None or entry[0] is not self:
+                return None
+            _, level, node = entry
+            del self.index[order_id]
+            order = node.order
+            if self.journal is not None:
+                self.journal.append_cancel(self.symbol, order_id)
+            side = self._side_of(order)
+            self._touch(side, order.price_ticks)
+            side.unlink(level, node)
+            order.status = OrderStatus.CANCELED
+            self._publish()
+            return order
+
+    def add_orders(self, orders: List[Order]) -> List[List[Dict]]:
+        """
+        Batch step: rests and matches each order in sequence under ONE lock acquisition.
+        Same result as add_order()+match() per order; the top-of-book snapshot is
+        published once at the end. Returns trades grouped per input order.
+        """
+        results = []
         with self.lock:
-            self.bids = [o for o in self.bids if o.id != order_id]
-            self.asks = [o for o in self.asks if o.id != order_id]
+            for order in orders:
+                if self.journal is not None:
+                    self.journal.append_new(order)
+                self._rest(order, publish=False)
+                results.append(self._match_locked())
+            self._publish()
+
+        total = sum(len(t) for t in results)
+        if total:
+            print(f"✅ MATCH! {self.symbol}: {total} trades executed (batch of {len(orders)})")
+        return results
 
     def match(self) -> List[Dict]:
         """
         Executes matching logic.
         Returns a list of 'Trade' dicts (executed transactions).
         """
-        transactions = []
         with self.lock:
-            print(f"🔍 Matching Check: {len(self.bids)} Bids, {len(self.asks)} Asks")
-            while self.bids and self.asks:
-                best_bid = self.bids[0]
-                best_ask = self.asks[0]
-
-                print(f"   Compare: Bid({best_bid.price}) vs Ask({best_ask.price})")
-
-                # Check Price Crossing
-                # Spread = Ask - Bid. Matching happens if Ask <= Bid.
-                if best_ask.price > best_bid.price:
-                    # Print explicit reason for user clarity
-                    print(f"   -> No Match (Best Bid {best_bid.price} < Best Ask {best_ask.price})")
-                    break # No match possible
-                
-                print(f"✅ MATCH! Bid({best_bid.price}) >= Ask({best_ask.price})")
-                
-                # MATCH FOUND!
-                # Price logic: Transaction happens at the Maker's price (the one who was there first)
-                # If Bid came first (Maker), price = Bid. If Ask came first, price = Ask.
-                # Simplified: Always match at the price of the order that was ALREADY in the book.
-                # However, for simplicity here, we'll match at the price of the LIMIT order being filled if both limit.
-                # Standard convention: Match at the price of the 'resting' order (Maker).
-                
-                # Let's assume we match at the mid-point or simply the best_ask price for simplicity in simulation.
-                # Real exchange: Match price = Price of the order that was in the book first.
-                match_price = best_ask.price if best_ask.timestamp < best_bid.timestamp else best_bid.price
-                
-                match_qty = min(best_bid.remaining_quantity, best_ask.remaining_quantity)
-                
-                # Create Transaction
-                trade = {
-                    "id": str(uuid.uuid4()),
-                    "symbol": self.symbol,
-                    "buy_order_id": best_bid.id,
-                    "sell_order_id": best_ask.id,
-                    "price": match_price,
-                    "quantity": match_qty,
-                    "timestamp": time.time(),
-                    "buyer_id": best_bid.user_id,
-                    "seller_id": best_ask.user_id
-                }
-                transactions.append(trade)
-                
-                # Update Quantities
-                best_bid.filled_quantity += match_qty
-                best_ask.filled_quantity += match_qty
+            transactions = self._match_locked()
+            self._publish()
+
+        if transactions:
+            print(f"✅ MATCH! {self.symbol}: {len(transactions)} trades executed")
+        return transactions
+
+    def _match_locked(self) -> List[Dict]:
+        # Caller holds self.lock and publishes the snapshot afterwards
+        transactions = []
+        bids, asks = self.bids, self.asks
+        while bids and asks:
+            bid_level = bids.best()
+            ask_level = asks.best()
+
+            # Check Price Crossing
+            # Spread = Ask - Bid. Matching happens if Ask <= Bid.
+            if ask_level.ticks > bid_level.ticks:
+                break # No match possible
+
+            best_bid = bid_level.head
+            best_ask = ask_level.head
+
+            # Real exchange: Match price = Price of the order that was in the book first (Maker).
+            maker_level = ask_level if best_ask.seq < best_bid.seq else bid_level
+            match_price = maker_level.price
+            
+            match_qty = min(best_bid.remaining_quantity, best_ask.remaining_quantity)
+            
+            # Create Transaction
+            trade = {
+                "id": f"{TRADE_ID_PREFIX}{next(_TRADE_SEQ)}",
+                "symbol": self.symbol,
+                "buy_order_id": best_bid.id,
+                "sell_order_id": best_ask.id,
+                "price": match_price,
+                "quantity": match_qty,
+                "timestamp": time.time(),
+                "buyer_id": best_bid.user_id,
+                "seller_id": best_ask.user_id
+            }
+            transactions.append(trade)
+            if self.journal is not None:
+                self.journal.append_fill(self.symbol, best_bid.id, best_ask.id, match_qty, match_price)
+            
+            # Update Quantities (order + level aggregate)
+            best_bid.filled_quantity += match_qty
+            best_ask.filled_quantity += match_qty
+            bid_level.total_qty -= match_qty
+            ask_level.total_qty -= match_qty
+            
+            # Update Status checking
+            if best_bid.remaining_quantity == 0:
+                best_bid.status = OrderStatus.FILLED
+                bids.unlink(bid_level, bid_level.head_node) # Remove filled (O(1))
+                self.index.pop(best_bid.id, None)
+            else:
+                best_bid.status = OrderStatus.PARTIAL
                 
-                # Update Status checking
-                if best_bid.remaining_quantity == 0:
-                    best_bid.status = OrderStatus.FILLED
-                    self.bids.pop(0) # Remove filled
-                else:
-                    best_bid.status = OrderStatus.PARTIAL
-                    
-                if best_ask.remaining_quantity == 0:
-                    best_ask.status = OrderStatus.FILLED
-                    self.asks.pop(0) # Remove filled
-                else:
-                    best_ask.status = OrderStatus.PARTIAL
-                    
+            if best_ask.remaining_quantity == 0:
+                best_ask.status = OrderStatus.FILLED
+                asks.unlink(ask_level, ask_level.head_node) # Remove filled (O(1))
+                self.index.pop(best_ask.id, None)
+            else:
+                best_ask.status = OrderStatus.PARTIAL
+
+        if transactions:
+            # Fills always hit the best levels of both sides
+            self._dirty_bids = self._dirty_asks = True
+
         return transactions
 
     def get_depth(self, limit: int = 10):
-        # Return snapshot for UI
+        """Aggregated L2 levels (price -> total remaining qty), best first."""
+        if limit <= SNAPSHOT_LEVELS:
+            snap = self.snapshot # Lock-free
+            bids, asks = snap.bids[:limit], snap.asks[:limit]
+        else:
+            with self.lock:
+                bids, asks = self.bids.top_levels(limit), self.asks.top_levels(limit)
         return {
-            "bids": [{"price": o.price, "qty": o.remaining_quantity} for o in self.bids[:limit]],
-            "asks": [{"price": o.price, "qty": o.remaining_quantity} for o in self.asks[:limit]]
+            "bids": [{"price": p, "qty": q} for p, q in bids],
+            "asks": [{"price": p, "qty": q} for p, q in asks]
         }
 
 # --- Singleton Engine ---
@@ -157,13 +510,15 @@ class MatchingEngine:
         if cls._instance is None:
             cls._instance = super(MatchingEngine, cls).__new__(cls)
             cls._instance.books = {} # Dict[str, OrderBook]
+            cls._instance.order_index = {} # Dict[order_id, (OrderBook, PriceLevel, OrderNode)]
+            cls._instance.journal = None # Optional EngineJournal
             cls._instance.lock = threading.Lock()
         return cls._instance
 
     def get_book(self, symbol: str) -> OrderBook:
         with self.lock:
             if symbol not in self.books:
-                self.books[symbol] = OrderBook(symbol)
+                self.books[symbol] = OrderBook(symbol, index=self.order_index, journal=self.journal)
             return self.books[symbol]
 
     def place_order(self, order: Order) -> List[Dict]:
@@ -172,24 +527,71 @@ class MatchingEngine:
         trades = book.match()
         return trades
 
+    def place_orders(self, batch: List[Order]) -> List[List[Dict]]:
+        """
+        Bulk entry: places a list of orders, one lock acquisition + match step per book.
+        Orders keep their relative sequence within each symbol.
+        Returns trades grouped per order (same length/order as `batch`).
+        """
+        by_symbol: Dict[str, List[int]] = {}
+        for i, order in enumerate(batch):
+            by_symbol.setdefault(order.symbol, []).append(i)
+
+        results: List[List[Dict]] = [[] for _ in batch]
+        for symbol, idxs in by_symbol.items():
+            grouped = self.get_book(symbol).add_orders([batch[i] for i in idxs])
+            for i, trades in zip(idxs, grouped):
+                results[i] = trades
+        return results
+
+    def cancel_order(self, order_id: str, symbol: Optional[str] = None) -> Optional[Order]:
+        """
+        Cancels a resting order by id in O(1).
+        Returns the cancelled Order, or None if it is not resting (already filled/cancelled/unknown).
+        `symbol` is only a routing hint for the sharded engine client (engine_service.py).
+        """
+        entry = self.order_index.get(order_id)
+        if entry is None:
+            return None
+        return entry[0].remove_order(order_id)
+
+    def restore_order(self, order: Order):
+        """Rests an order without matching or journaling (startup recovery)."""
+        self.get_book(order.symbol).restore_order(order)
+
+    def apply_fill(self, symbol: str, order_id: str, qty: int) -> Optional[Order]:
+        """Applies a recorded fill without matching or journaling (startup recovery)."""
+        return self.get_book(symbol).apply_fill(order_id, qty)
+
+    def attach_journal(self, journal):
+        """Starts journaling every new/cancel/fill event (call after recovery)."""
+        with self.lock:
+            self.journal = journal
+            for book in self.books.values():
+                book.journal = journal
+
+    def reset(self):
+        with self.lock:
+            self.books.clear()
+            self.order_index.clear()
+
     def get_orderbook(self, symbol: str):
         return self.get_book(symbol).get_depth()
 
+    def get_snapshot(self, symbol: str) -> BookSnapshot:
+        """Latest immutable top-of-book / L2 snapshot. Lock-free."""
+        book = self.books.get(symbol)
+        if book is None:
+            return BookSnapshot(symbol, 0, time.time(), (), ())
+        return book.snapshot
+
     def get_best_ask(self, symbol: str) -> float:
-        book = self.get_book(symbol)
-        with book.lock:
-            # Asks are sorted ascending (Lowest Price first)
-            if book.asks:
-                return book.asks[0].price
-            return 0.0
+        # Lowest ask level from the lock-free snapshot
+        return self.get_snapshot(symbol).best_ask
 
     def get_best_bid(self, symbol: str) -> float:
-        book = self.get_book(symbol)
-        with book.lock:
-            # Bids are sorted descending (Highest Price first)
-            if book.bids:
-                return book.bids[0].price
-            return 0.0
+        # Highest bid level from the lock-free snapshot
+        return self.get_snapshot(symbol).best_bid
 
 # Global Instance
 engine = MatchingEngine()
@@ -0,0 +1,167 @@
+"""
+Local Columnar OHLCV Store.
+
+One series per (symbol, resolution) on local disk, read through a NumPy memory map:
+
+    <root>/<resolution dir>/<SYMBOL>.npy     structured array sorted by t, one row per bar
+    <root>/<resolution dir>/<SYMBOL>.json    {"coverage": [[first_date, last_date], ...]}
+
+    row = (t: int64 wall-clock epoch seconds, open, high, low, close, volume: float64)
+
+`coverage` lists the inclusive date ranges already fetched upstream (merged, sorted), so a
+request only downloads `gaps()` and any covered sub-range is a local slice (searchsorted on
+the memory map). Ranges that can still change (today's bar, the current week/month) are
+never marked covered and get re-fetched.
+
+Resolution dirs are case-safe ('1M' -> '1m_', '1m' -> '1m'), for Windows/macOS filesystems.
+"""
+import json
+import os
+import re
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+BAR_DTYPE = np.dtype([
+    ("t", "<i8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"), ("close", "<f8"), ("volume", "<f8"),
+])
+DAILY_RESOLUTIONS = {"1D", "1W", "1M"} # Bar time rendered as a date
+SETTLE_DAYS = {"1W": 7, "1M": 31} # Bars this recent may still change (default 1 = today)
+SYMBOL_PATTERN = re.compile(r"^[A-Z0-9.^=-]{1,15}$") # Also a file name: no separators / '..'
+RESOLUTION_PATTERN = re.compile(r"^[0-9]{1,3}[A-Za-z]{1,2}$")
+
+
+def _day(s: str) -> date:
+    return datetime.strptime(s[:10], "%Y-%m-%d").date()
+
+
+def _epoch(value) -> int:
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_localize(None) # Keep exchange wall-clock time
+    return int(ts.value // 1_000_000_000)
+
+
+class OHLCVStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self.locks_guard = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+
+    # --- Layout ---
+    def _paths(self, symbol: str, resolution: str) -> Tuple[str, str]:
+        if not SYMBOL_PATTERN.match(symbol) or ".." in symbol or not RESOLUTION_PATTERN.match(resolution):
+            raise ValueError(f"Invalid series {symbol!r}/{resolution!r}")
+        folder = os.path.join(self.root, "".join(c.lower() + "_" if c.isupper() else c for c in resolution))
+        return os.path.join(folder, f"{symbol}.npy"), os.path.join(folder, f"{symbol}.json")
+
+    def _lock(self, symbol: str, resolution: str) -> threading.Lock:
+        with self.locks_guard:
+            return self.locks.setdefault((symbol, resolution), threading.Lock())
+
+    def _coverage(self, meta_path: str) -> List[List[str]]:
+        if not os.path.exists(meta_path):
+            return []
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f).get("coverage", [])
+
+    # --- Coverage ---
+    def gaps(self, symbol: str, resolution: str, start_date: str, end_date: str) -> List[Tuple[str, str]]:
+        """Inclusive date ranges of [start_date, end_date] not fetched yet. Raises ValueError on bad dates."""
+        start, end = _day(start_date), _day(end_date)
+        with self._lock(symbol, resolution):
+            coverage = self._coverage(self._paths(symbol, resolution)[1])
+        gaps = []
+        cursor = start
+        for a, b in coverage:
+            a, b = _day(a), _day(b)
+            if b < cursor:
+                continue
+            if a > end:
+                break
+            if a > cursor:
+                gaps.append((cursor, a - timedelta(days=1)))
+            cursor = max(cursor, b + timedelta(days=1))
+        if cursor <= end:
+            gaps.append((cursor, end))
+        return [(a.isoformat(), b.isoformat()) for a, b in gaps]
+
+    @staticmethod
+    def _merge(coverage: List[List[str]], start: date, end: date) -> List[List[str]]:
+        ranges = sorted([(_day(a), _day(b)) for a, b in coverage] + [(start, end)])
+        merged = [list(ranges[0])]
+        for a, b in ranges[1:]:
+            if a <= merged[-1][1] + timedelta(days=1):
+                merged[-1][1] = max(merged[-1][1], b)
+            else:
+                merged.append([a, b])
+        return [[a.isoformat(), b.isoformat()] for a, b in merged]
+
+    # --- Read / write ---
+    def read(self, symbol: str, resolution: str, start_date: str, end_date: str) -> list:
+        """Bars with start_date <= day <= end_date, as JSON-ready dicts."""
+        lo = _epoch(_day(start_date))
+        hi = _epoch(_day(end_date) + timedelta(days=1))
+        bars_path = self._paths(symbol, resolution)[0]
+        with self._lock(symbol, resolution):
+            if not os.path.exists(bars_path):
+                return []
+            series = np.load(bars_path, mmap_mode="r")
+            t = series["t"]
+            rows = np.array(series[np.searchsorted(t, lo, "left"):np.searchsorted(t, hi, "left")])
+            del series, t # Release the map before a writer replaces the file
+        self.reads += 1
+        if resolution in DAILY_RESOLUTIONS:
+            times = rows["t"].astype("datetime64[s]").astype("datetime64[D]").astype(str)
+        else:
+            times = np.char.replace(np.datetime_as_string(rows["t"].astype("datetime64[s]"), unit="s"), "T", " ")
+        return [
+            {"time": str(tm), "open": float(r["open"]), "high": float(r["high"]), "low": float(r["low"]),
+             "close": float(r["close"]), "volume": int(r["volume"]) if float(r["volume"]).is_integer() else float(r["volume"])}
+            for tm, r in zip(times, rows)
+        ]
+
+    def write(self, symbol: str, resolution: str, bars: list, start_date: str, end_date: str,
+              today: Optional[date] = None):
+        """
+        Merges `bars` (provider dicts: time/open/high/low/close/volume; newer rows win on equal
+        time) and marks [start_date, end_date] covered, minus the still-changing tail.
+        """
+        incoming = np.array([
+            (_epoch(b["time"]), b.get("open") or 0, b.get("high") or 0, b.get("low") or 0,
+             b.get("close") or 0, b.get("volume") or 0)
+            for b in bars if b.get("time") is not None and b.get("close") is not None
+        ], dtype=BAR_DTYPE)
+        today = today or date.today()
+        covered_end = min(_day(end_date), today - timedelta(days=SETTLE_DAYS.get(resolution, 1)))
+
+        bars_path, meta_path = self._paths(symbol, resolution)
+        with self._lock(symbol, resolution):
+            os.makedirs(os.path.dirname(bars_path), exist_ok=True)
+            if os.path.exists(bars_path):
+                current = np.load(bars_path) # Full copy (no map held while replacing)
+                merged = np.concatenate([incoming, current])
+            else:
+                merged = incoming
+            # First occurrence per t wins -> incoming overrides stored bars
+            _, first = np.unique(merged["t"], return_index=True)
+            merged = merged[first] # np.unique sorts by t
+            tmp = bars_path + ".tmp.npy"
+            np.save(tmp, merged)
+            os.replace(tmp, bars_path)
+
+            coverage = self._coverage(meta_path)
+            if _day(start_date) <= covered_end:
+                coverage = self._merge(coverage, _day(start_date), covered_end)
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"coverage": coverage, "rows": int(len(merged))}, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        self.writes += 1
+
+    def stats(self) -> dict:
+        return {"series": len(self.locks), "reads": self.reads, "writes": self.writes}
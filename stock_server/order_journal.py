@@ -0,0 +1,308 @@
+"""
+Append-only Matching Engine Journal.
+
+Every engine event (NEW / CANCEL / FILL) gets a sequence number and is appended to
+memory-mapped segment files on local disk. Periodic snapshots capture all resting
+orders at a known sequence, so startup = load latest snapshot + replay the journal
+tail. Replay applies recorded events literally (rest order / apply fill / remove)
+and never runs matching, so it cannot produce spurious trades.
+
+Layout (JOURNAL_DIR):
+    seg-<first_seq>.log      Preallocated mmap segment, records back to back, zero-filled tail
+    snap-<seq>.json          Resting orders of every book at <seq>
+
+Record: <payload_len:u32><crc32:u32><seq:u64><type:u8><payload JSON>
+    NEW    [id, user_id, symbol, side, type, price_ticks, quantity, filled, timestamp, seq]
+    CANCEL [symbol, order_id]
+    FILL   [symbol, buy_order_id, sell_order_id, quantity, price]
+Prices of resting orders are integer ticks (matching_engine.PRICE_SCALE); `seq` is the
+order's time-priority sequence number and is restored verbatim.
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from matching_engine import Order, OrderSide, OrderType, OrderStatus, advance_order_seq, to_ticks
+
+EV_NEW = 1
+EV_CANCEL = 2
+EV_FILL = 3
+
+_HEADER = struct.Struct("<IIQB")
+_CRC_FIELDS = struct.Struct("<QB")
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024 # 16MB per segment
+DEFAULT_SNAPSHOT_EVERY = 50_000 # events between snapshots
+SNAPSHOTS_TO_KEEP = 2
+
+
+def order_to_row(order: Order):
+    return [order.id, order.user_id, order.symbol, order.side.value, order.type.value,
+            order.price_ticks, order.quantity, order.filled_quantity, order.timestamp, order.seq]
+
+
+def order_from_row(row) -> Order:
+    if len(row) == 9:
+        # Pre-tick journal row: [..., float price, ..., timestamp] without seq
+        oid, user_id, symbol, side, o_type, price, qty, filled, ts = row
+        ticks, seq = to_ticks(price), None
+    else:
+        oid, user_id, symbol, side, o_type, ticks, qty, filled, ts, seq = row
+    return Order(
+        id=oid,
+        user_id=user_id,
+        symbol=symbol,
+        side=OrderSide(side),
+        type=OrderType(o_type),
+        price_ticks=ticks,
+        quantity=qty,
+        filled_quantity=filled,
+        timestamp=ts,
+        status=OrderStatus.PARTIAL if filled else OrderStatus.PENDING,
+        seq=seq
+    )
+
+
+class _Segment:
+    """One preallocated, memory-mapped journal file opened for appending."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.pos = 0
+
+    def fits(self, n: int) -> bool:
+        return self.pos + n <= self.size
+
+    def write(self, data: bytes):
+        end = self.pos + len(data)
+        self.mm[self.pos:end] = data
+        self.pos = end
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        try:
+            self.mm.flush()
+            self.mm.close()
+        finally:
+            self.file.close()
+
+
+def _segment_first_seq(path: str) -> int:
+    return int(os.path.basename(path)[4:-4])
+
+
+def _iter_segment(path: str):
+    """Yields (seq, type, payload) until the zero-filled tail or a torn/corrupt record."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos, end = 0, len(mm)
+            while pos + _HEADER.size <= end:
+                length, crc, seq, ev_type = _HEADER.unpack_from(mm, pos)
+                if length == 0 and seq == 0:
+                    return # Unwritten (preallocated) space
+                body_start = pos + _HEADER.size
+                body_end = body_start + length
+                if body_end > end:
+                    return # Torn write at the tail
+                payload = mm[body_start:body_end]
+                if zlib.crc32(payload, zlib.crc32(_CRC_FIELDS.pack(seq, ev_type))) != crc:
+                    return # Torn/corrupt record: everything after it is untrusted
+                yield seq, ev_type, payload
+                pos = body_end
+
+
+class EngineJournal:
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 snapshot_every: int = DEFAULT_SNAPSHOT_EVERY):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.last_seq = 0
+        self.snapshot_seq = 0
+        self._segment = None
+        os.makedirs(directory, exist_ok=True)
+
+    # --- Write path (called by OrderBook under its lock) ---
+    def _append(self, ev_type: int, row):
+        payload = json.dumps(row, separators=(",", ":")).encode("utf-8")
+        with self.lock:
+            seq = self.last_seq + 1
+            crc = zlib.crc32(payload, zlib.crc32(_CRC_FIELDS.pack(seq, ev_type)))
+            record = _HEADER.pack(len(payload), crc, seq, ev_type) + payload
+            if self._segment is None or not self._segment.fits(len(record)):
+                self._roll(seq, len(record))
+            self._segment.write(record)
+            self.last_seq = seq
+
+    def append_new(self, order: Order):
+        self._append(EV_NEW, order_to_row(order))
+
+    def append_cancel(self, symbol: str, order_id: str):
+        self._append(EV_CANCEL, [symbol, order_id])
+
+    def append_fill(self, symbol: str, buy_order_id: str, sell_order_id: str, qty: int, price: float):
+        self._append(EV_FILL, [symbol, buy_order_id, sell_order_id, qty, price])
+
+    def _roll(self, first_seq: int, min_size: int):
+        # Caller holds self.lock
+        if self._segment is not None:
+            self._segment.close()
+        path = os.path.join(self.directory, f"seg-{first_seq:020d}.log")
+        # A leftover file with this name can only hold records >= first_seq, i.e. none valid.
+        self._segment = _Segment(path, max(self.segment_size, min_size))
+
+    def _segment_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, "seg-*.log")))
+
+    def _snapshot_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, "snap-*.json")))
+
+    # --- Snapshots ---
+    def needs_snapshot(self) -> bool:
+        return self.last_seq - self.snapshot_seq >= self.snapshot_every
+
+    def write_snapshot(self, engine) -> int:
+        """
+        Captures every resting order at a single journal sequence.
+        All book locks are held while reading, so no event can slip between the
+        captured state and the recorded sequence.
+        """
+        with engine.lock:
+            books = sorted(engine.books.items())
+            for _, book in books:
+                book.lock.acquire()
+            try:
+                seq = self.last_seq
+                state = {
+                    symbol: [order_to_row(o) for o in book.resting_orders()]
+                    for symbol, book in books
+                }
+            finally:
+                for _, book in reversed(books):
+                    book.lock.release()
+
+        if seq == self.snapshot_seq and self._snapshot_paths():
+            return seq
+
+        with self.lock:
+            if self._segment is not None:
+                self._segment.flush()
+
+        path = os.path.join(self.directory, f"snap-{seq:020d}.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "created_at": time.time(), "books": state}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.snapshot_seq = seq
+        self._prune(seq)
+        return seq
+
+    def _prune(self, snap_seq: int):
+        # Old snapshots
+        for path in self._snapshot_paths()[:-SNAPSHOTS_TO_KEEP]:
+            try: os.remove(path)
+            except OSError: pass
+
+        # Segments whose every record is <= snap_seq (next segment starts at or before snap_seq+1).
+        # Keep everything the OLDEST retained snapshot still needs.
+        snaps = self._snapshot_paths()
+        keep_from = int(os.path.basename(snaps[0])[5:-5]) if snaps else snap_seq
+        segments = self._segment_paths()
+        active = self._segment.path if self._segment is not None else None
+        for path, nxt in zip(segments, segments[1:]):
+            if path == active:
+                continue
+            if _segment_first_seq(nxt) <= keep_from + 1:
+                try: os.remove(path)
+                except OSError: pass
+
+    # --- Recovery ---
+    def recover(self, engine) -> dict:
+        """
+        Loads the latest snapshot into `engine` and replays the journal tail after it.
+        Must run before engine.attach_journal(). Returns replay stats.
+        """
+        t0 = time.time()
+        stats = {"snapshot_seq": 0, "snapshot_orders": 0, "replayed_events": 0, "last_seq": 0}
+
+        snap_seq = 0
+        max_order_seq = 0
+        for path in reversed(self._snapshot_paths()):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snap = json.load(f)
+            except Exception as e:
+                print(f"⚠️ [JOURNAL] Unreadable snapshot {os.path.basename(path)}: {e}")
+                continue
+            snap_seq = int(snap.get("seq", 0))
+            for rows in snap.get("books", {}).values():
+                for row in rows:
+                    order = order_from_row(row)
+                    max_order_seq = max(max_order_seq, order.seq)
+                    engine.restore_order(order)
+                    stats["snapshot_orders"] += 1
+            break
+
+        last_seq = snap_seq
+        for path in self._segment_paths():
+            for seq, ev_type, payload in _iter_segment(path):
+                if seq <= snap_seq:
+                    continue
+                row = json.loads(payload)
+                if ev_type == EV_NEW:
+                    order = order_from_row(row)
+                    max_order_seq = max(max_order_seq, order.seq)
+                    engine.restore_order(order)
+                elif ev_type == EV_CANCEL:
+                    symbol, order_id = row
+                    engine.get_book(symbol).remove_order(order_id)
+                elif ev_type == EV_FILL:
+                    symbol, buy_id, sell_id, qty, _ = row
+                    engine.apply_fill(symbol, buy_id, qty)
+                    engine.apply_fill(symbol, sell_id, qty)
+                last_seq = max(last_seq, seq)
+                stats["replayed_events"] += 1
+
+        # New orders must queue behind every restored one
+        advance_order_seq(max_order_seq)
+        self.last_seq = last_seq
+        self.snapshot_seq = snap_seq
+        stats["snapshot_seq"] = snap_seq
+        stats["last_seq"] = last_seq
+        stats["seconds"] = round(time.time() - t0, 3)
+        return stats
+
+    # --- Lifecycle ---
+    def reset(self):
+        """Deletes all segments and snapshots (used together with a Redis flush)."""
+        with self.lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            for path in self._segment_paths() + self._snapshot_paths():
+                try: os.remove(path)
+                except OSError: pass
+            self.last_seq = 0
+            self.snapshot_seq = 0
+
+    def close(self):
+        with self.lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
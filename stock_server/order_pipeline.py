@@ -0,0 +1,229 @@
+"""
+Staged Asynchronous Pipeline.
+
+A chain of stages, each with its own bounded asyncio.Queue and worker pool:
+
+    submit() -> [stage 1] -> [stage 2] -> ... -> [stage N]
+
+- Backpressure: a full queue blocks the upstream worker; `submit()` gives up after
+  `timeout` and raises PipelineBusy (the HTTP layer answers 503).
+- Blocking handlers (Firestore / Redis / engine calls) run in worker threads.
+- A stage built with `ack=True` resolves `job.accepted` once it succeeds, so the
+  caller can answer early while the later stages keep running.
+- Per-stage latency histograms for queue wait and service time (`stats()`).
+- `stop(drain=True)` refuses new jobs and lets queued ones finish every stage first.
+
+main.py wires the order path as two pipelines joined by a Redis stream:
+validate/reserve -> persist (+ XADD) | XREADGROUP -> match -> settle -> notify.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, List, Optional
+
+
+class PipelineBusy(Exception):
+    """The first stage queue stayed full for the whole submit timeout."""
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (ms); percentiles resolve to the bucket upper bound."""
+    BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1) # last = overflow
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.BOUNDS_MS[i] if i < len(self.BOUNDS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {f"le_{b}": c for b, c in zip(self.BOUNDS_MS, self.counts)} | {"overflow": self.counts[-1]},
+        }
+
+
+class Job:
+    """
+    Unit of work flowing through the pipeline. Handlers attach their own attributes.
+    Set `stopped = True` in a handler to end the job's trip after that stage.
+    """
+
+    def __init__(self):
+        self.accepted: Optional[asyncio.Future] = None
+        self.enqueued_at = 0.0
+        self.stopped = False
+
+    def _resolve(self, result=None, error: Optional[BaseException] = None):
+        fut = self.accepted
+        if fut is None or fut.done():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+
+class Stage:
+    def __init__(self, name: str, handler: Callable, workers: int = 1, maxsize: int = 1000,
+                 blocking: bool = True, ack: bool = False):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.blocking = blocking # Run handler in a thread (sync I/O)
+        self.ack = ack # Resolve job.accepted after this stage
+        self.next: Optional["Stage"] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.errors = 0
+        self.wait_hist = LatencyHistogram()
+        self.service_hist = LatencyHistogram()
+
+    async def put(self, job: Job):
+        job.enqueued_at = time.perf_counter()
+        await self.queue.put(job) # Blocks while full = backpressure
+
+    async def _run(self, job: Job):
+        if self.blocking:
+            await asyncio.to_thread(self.handler, job)
+        else:
+            result = self.handler(job)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            start = time.perf_counter()
+            self.wait_hist.observe(start - job.enqueued_at)
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                job.stopped = True
+                if job.accepted is not None and not job.accepted.done():
+                    job._resolve(error=e)
+                else:
+                    print(f"⚠️ [PIPELINE] {self.name} failed after accept: {e}")
+            else:
+                self.processed += 1
+                if self.ack:
+                    job._resolve(job)
+            finally:
+                self.service_hist.observe(time.perf_counter() - start)
+
+            try:
+                if job.stopped or self.next is None:
+                    job._resolve(job) # No-op once acked/failed
+                else:
+                    await self.next.put(job)
+            finally:
+                self.queue.task_done() # After the hand-off, so join() covers jobs moving downstream
+
+    def start(self):
+        self.queue = asyncio.Queue(self.maxsize)
+        self.tasks = [asyncio.create_task(self._worker(), name=f"{self.name}-{i}") for i in range(self.workers)]
+
+    async def drain(self):
+        """Waits until every job queued here has been handled and passed on."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_max": self.maxsize,
+            "processed": self.processed,
+            "errors": self.errors,
+            "wait": self.wait_hist.snapshot(),
+            "service": self.service_hist.snapshot(),
+        }
+
+
+class Pipeline:
+    def __init__(self, name: str, stages: List[Stage]):
+        self.name = name
+        self.stages = stages
+        for a, b in zip(stages, stages[1:]):
+            a.next = b
+        self.rejected = 0
+        self.started = False
+
+    async def start(self):
+        for stage in self.stages:
+            stage.start()
+        self.started = True
+
+    async def stop(self, drain: bool = False, timeout: float = 30.0):
+        """
+        Stops the workers. With `drain`, new submits are refused first and every queued
+        job finishes its remaining stages, stage by stage in order (up to `timeout` s).
+        """
+        self.started = False
+        if drain:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                left = sum(s.queue.qsize() for s in self.stages if s.queue)
+                print(f"⚠️ [PIPELINE] {self.name}: drain timed out, {left} jobs dropped")
+        for stage in self.stages:
+            await stage.stop()
+
+    async def _drain(self):
+        for stage in self.stages:
+            await stage.drain()
+
+    async def submit(self, job: Job, timeout: Optional[float] = None) -> asyncio.Future:
+        """Enqueues `job` at the first stage. Returns the future resolved by the ack stage."""
+        if not self.started:
+            raise PipelineBusy(f"{self.name}: not accepting orders (stopped)")
+        job.accepted = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self.stages[0].put(job), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PipelineBusy(f"{self.name}: {self.stages[0].name} queue full")
+        return job.accepted
+
+    def stats(self) -> dict:
+        return {
+            "pipeline": self.name,
+            "running": self.started,
+            "rejected_busy": self.rejected,
+            "stages": [s.stats() for s in self.stages],
+        }
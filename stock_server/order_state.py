@@ -0,0 +1,269 @@
+"""
+Atomic Order State Transitions (Redis Lua).
+
+Every transition of an `order:{id}` hash runs as ONE server-side script (EVALSHA via
+redis-py `register_script`, auto-loaded on NOSCRIPT), so a fill can never interleave
+with a cancel/expire, and each transition costs a single round trip (or a slot in a
+pipeline). The scripts also keep the open-order indexes in sync:
+
+    pending_orders                  SET of all open order ids
+    book:{symbol}:{side}:orders     ZSET order_id -> price (open orders of one side)
+    book:{symbol}:{side}:levels     ZSET price_ticks -> price (non-empty price levels)
+    book:{symbol}:{side}:depth      HASH price_ticks -> resting quantity (level aggregate)
+    book:symbols                    SET of symbols with at least one price level (either side)
+
+`book_depth()` reads the top N levels of one symbol in one script call, without
+touching the order hashes of other symbols.
+
+Statuses written: partial, matched (fully filled), cancelled, expired, rejected.
+Open statuses (case-insensitive, new orders may be 'PENDING'): pending, partial.
+
+Orders taken in through the intake stream also carry an 'engine' field: queued (persisted,
+not matched yet) -> matching (claimed by one consumer) -> booked (handed to the engine).
+`claim_order()` and a queued-only `cancel_order()` race atomically, so an order cancelled
+while queued never reaches the book, whichever worker holds it.
+"""
+from matching_engine import PRICE_SCALE, to_ticks, from_ticks
+
+PENDING_SET = "pending_orders"
+ACTIVE_SYMBOLS = "book:symbols"
+
+# Shared by the transition scripts. KEYS[3..5] = buy orders/levels/depth, KEYS[6..8] = sell,
+# KEYS[9] = active symbols set.
+_BOOK_LUA = """
+local function book_keys(side)
+    if string.lower(side or '') == 'sell' then
+        return KEYS[6], KEYS[7], KEYS[8]
+    end
+    return KEYS[3], KEYS[4], KEYS[5]
+end
+-- Level of an order: the 'price_ticks' stored by add_pending; older orders fall back to
+-- matching_engine.to_ticks (Python round() = half-to-even on the same double)
+local function price_ticks(stored, price)
+    if stored then
+        return stored
+    end
+    local x = (tonumber(price) or 0) * %d
+    local f = math.floor(x)
+    local d = x - f
+    if d > 0.5 or (d == 0.5 and f %% 2 == 1) then
+        f = f + 1
+    end
+    return string.format('%%d', f)
+end
+-- Removes qty from an aggregate level, dropping the level once empty
+local function level_sub(levels, depth, ticks, qty)
+    if qty <= 0 then
+        return
+    end
+    local left = tonumber(redis.call('HINCRBYFLOAT', depth, ticks, -qty))
+    if left <= 0.0001 then
+        redis.call('HDEL', depth, ticks)
+        redis.call('ZREM', levels, ticks)
+        -- Last level of the symbol gone (empty ZSETs are deleted): no longer active
+        if redis.call('EXISTS', KEYS[4]) == 0 and redis.call('EXISTS', KEYS[7]) == 0 then
+            local symbol = redis.call('HGET', KEYS[1], 'symbol')
+            if symbol then
+                redis.call('SREM', KEYS[9], symbol)
+            end
+        end
+    end
+end
+""" % PRICE_SCALE
+
+# KEYS: order hash, pending set, book keys (see _BOOK_LUA) | ARGV: order_id, fill qty
+# Returns {status, filled, quantity}; status '' = unknown order.
+FILL_LUA = _BOOK_LUA + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'', '0', '0'}
+end
+local fill = tonumber(ARGV[2])
+local filled = tonumber(redis.call('HINCRBYFLOAT', KEYS[1], 'filled', ARGV[2]))
+local fields = redis.call('HMGET', KEYS[1], 'quantity', 'status', 'side', 'price', 'price_ticks')
+local quantity = tonumber(fields[1]) or 0
+local status = string.lower(fields[2] or '')
+if status == 'pending' or status == 'partial' then
+    local orders, levels, depth = book_keys(fields[3])
+    -- Only the part that was still resting leaves the level
+    local resting = math.max(quantity - (filled - fill), 0)
+    level_sub(levels, depth, price_ticks(fields[5], fields[4]), math.min(fill, resting))
+    if filled >= quantity - 0.0001 then
+        status = 'matched'
+        redis.call('SREM', KEYS[2], ARGV[1])
+        redis.call('ZREM', orders, ARGV[1])
+    else
+        status = 'partial'
+    end
+    redis.call('HSET', KEYS[1], 'status', status)
+end
+-- A fill settling after a cancel/expire keeps the closed status (qty is still recorded)
+return {status, tostring(filled), tostring(quantity)}
+"""
+
+# KEYS: order hash, pending set, book keys (see _BOOK_LUA)
+# ARGV: order_id, new status, owner ('' = any), required engine stage ('' = any)
+# Returns {result, previous status, quantity, filled}; result: ok | missing | forbidden | closed
+# | engine (open, but past the required stage: the caller has to go through the engine)
+CLOSE_LUA = _BOOK_LUA + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'missing', '', '0', '0'}
+end
+local fields = redis.call('HMGET', KEYS[1], 'status', 'user_id', 'quantity', 'filled', 'side', 'price',
+                          'price_ticks', 'engine')
+local status = string.lower(fields[1] or '')
+local quantity = fields[3] or '0'
+local filled = fields[4] or '0'
+if ARGV[3] ~= '' and fields[2] ~= ARGV[3] then
+    return {'forbidden', status, quantity, filled}
+end
+if status ~= 'pending' and status ~= 'partial' then
+    return {'closed', status, quantity, filled}
+end
+if ARGV[4] ~= '' and fields[8] ~= ARGV[4] then
+    return {'engine', status, quantity, filled}
+end
+local orders, levels, depth = book_keys(fields[5])
+level_sub(levels, depth, price_ticks(fields[7], fields[6]), (tonumber(quantity) or 0) - (tonumber(filled) or 0))
+redis.call('HSET', KEYS[1], 'status', ARGV[2])
+redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('ZREM', orders, ARGV[1])
+return {'ok', status, quantity, filled}
+"""
+
+# KEYS: order hash | Returns the engine stage found ('' = unknown order / no stage).
+# Only a 'queued' open order moves to 'matching': the caller owns its hand-off to the engine.
+CLAIM_LUA = """
+local fields = redis.call('HMGET', KEYS[1], 'status', 'engine')
+local status = string.lower(fields[1] or '')
+local stage = fields[2] or ''
+if stage == 'queued' and status ~= 'pending' and status ~= 'partial' then
+    return 'closed' -- Cancelled while queued
+end
+if stage == 'queued' then
+    redis.call('HSET', KEYS[1], 'engine', 'matching')
+end
+return stage
+"""
+
+# KEYS: buy levels, buy depth, sell levels, sell depth | ARGV: limit
+# Returns {{ticks, qty, ...} bids best-first, {ticks, qty, ...} asks best-first}
+DEPTH_LUA = """
+local function side(levels, depth, best_high)
+    local n = tonumber(ARGV[1])
+    local ticks
+    if best_high then
+        ticks = redis.call('ZREVRANGE', levels, 0, n - 1)
+    else
+        ticks = redis.call('ZRANGE', levels, 0, n - 1)
+    end
+    local out = {}
+    if #ticks == 0 then
+        return out
+    end
+    local qty = redis.call('HMGET', depth, unpack(ticks))
+    for i = 1, #ticks do
+        out[#out + 1] = ticks[i]
+        out[#out + 1] = qty[i] or '0'
+    end
+    return out
+end
+return {side(KEYS[1], KEYS[2], true), side(KEYS[3], KEYS[4], false)}
+"""
+
+_scripts = {}
+
+
+def _script(client, name: str, source: str):
+    # Registered once; the SHA is reused with whatever client/pipeline is passed in
+    script = _scripts.get(name)
+    if script is None:
+        script = _scripts[name] = client.register_script(source)
+    return script
+
+
+def book_key(symbol: str, side: str, kind: str) -> str:
+    """kind: orders | levels | depth"""
+    return f"book:{symbol}:{side}:{kind}"
+
+
+def _keys(order_id: str, symbol: str):
+    return [f"order:{order_id}", PENDING_SET] + [
+        book_key(symbol, side, kind) for side in ("buy", "sell") for kind in ("orders", "levels", "depth")] + [
+        ACTIVE_SYMBOLS]
+
+
+def add_pending(pipe, order_id: str, symbol: str, side: str, price: float, remaining: float):
+    """
+    Indexes a new open order and adds its resting quantity to the level aggregate (queued on `pipe`).
+    The level is stored on the order hash as 'price_ticks', so the scripts take the same level off.
+    """
+    side = str(side).lower()
+    ticks = to_ticks(price)
+    pipe.hset(f"order:{order_id}", "price_ticks", ticks)
+    pipe.sadd(PENDING_SET, order_id)
+    pipe.zadd(book_key(symbol, side, "orders"), {order_id: price})
+    pipe.zadd(book_key(symbol, side, "levels"), {ticks: price})
+    pipe.hincrbyfloat(book_key(symbol, side, "depth"), ticks, remaining)
+    pipe.sadd(ACTIVE_SYMBOLS, symbol)
+
+
+def fill_order(client, order_id: str, symbol: str, qty: float):
+    """Applies a fill: filled += qty, status partial/matched, index cleanup when done."""
+    return _script(client, "fill", FILL_LUA)(
+        keys=_keys(order_id, symbol), args=[order_id, float(qty)], client=client)
+
+
+def cancel_order(client, order_id: str, symbol: str, user_id: str = "", queued_only: bool = False):
+    """
+    Closes an open order as 'cancelled' (only by `user_id` when given).
+    `queued_only`: only while it still waits in the intake stream; result 'engine' otherwise.
+    """
+    return _script(client, "close", CLOSE_LUA)(
+        keys=_keys(order_id, symbol), args=[order_id, "cancelled", user_id, "queued" if queued_only else ""],
+        client=client)
+
+
+def expire_order(client, order_id: str, symbol: str):
+    """Closes an open order as 'expired' (system-initiated, no owner check)."""
+    return _script(client, "close", CLOSE_LUA)(
+        keys=_keys(order_id, symbol), args=[order_id, "expired", "", ""], client=client)
+
+
+def reject_order(client, order_id: str, symbol: str):
+    """Closes an open order as 'rejected' (it could not be handed to the engine)."""
+    return _script(client, "close", CLOSE_LUA)(
+        keys=_keys(order_id, symbol), args=[order_id, "rejected", "", ""], client=client)
+
+
+def claim_order(client, order_id: str):
+    """Intake consumer: queued -> matching. Returns the stage found ('queued' = claimed, go ahead)."""
+    return _script(client, "claim", CLAIM_LUA)(keys=[f"order:{order_id}"], client=client)
+
+
+def active_symbols(client) -> set:
+    """Symbols with resting orders (non-empty price levels), from any process."""
+    return client.smembers(ACTIVE_SYMBOLS)
+
+
+def sync_active_symbols(client) -> int:
+    """
+    One-off backfill of the active set from the level keys (orders indexed before the set
+    existed). Scans the keyspace once: call at startup, not per refresh round.
+    """
+    symbols = {key.split(":")[1] for key in client.scan_iter(match="book:*:levels", count=500)}
+    if symbols:
+        client.sadd(ACTIVE_SYMBOLS, *symbols)
+    return len(symbols)
+
+
+def book_depth(client, symbol: str, limit: int = 5) -> dict:
+    """Top-N aggregated levels per side from the Redis indexes (same shape as BookSnapshot.to_dict)."""
+    bids, asks = _script(client, "depth", DEPTH_LUA)(
+        keys=[book_key(symbol, "buy", "levels"), book_key(symbol, "buy", "depth"),
+              book_key(symbol, "sell", "levels"), book_key(symbol, "sell", "depth")],
+        args=[limit], client=client)
+
+    def levels(flat):
+        return [{"price": from_ticks(int(flat[i])), "quantity": int(float(flat[i + 1]))}
+                for i in range(0, len(flat), 2)]
+    return {"bids": levels(bids), "asks": levels(asks)}
@@ -0,0 +1,318 @@
+"""
+Concurrent Quote Refresher.
+
+Fetches quotes for many symbols at once, each upstream source guarded on its own:
+
+    symbol -> [source, fallback, ...] -> TokenBucket -> CircuitBreaker -> fetch (thread + timeout)
+
+- Bounded parallelism (`concurrency`): a refresh round costs ~ the slowest fetch,
+  not the sum of all fetches.
+- TokenBucket per source: sustained requests/second + burst. Callers wait for a token
+  up to `max_wait`, otherwise the symbol is skipped this round.
+- CircuitBreaker per source: opens after `failure_threshold` consecutive failures for
+  `cooldown` seconds (a RateLimited error opens it at once for `rate_limit_cooldown`),
+  then lets a single probe through. A throttled source only pauses itself; the other
+  sources (and the next source in a symbol's route) keep going.
+
+Fetch functions are blocking `fn(symbol) -> result | None` (None = no data, not a failure)
+and raise RateLimited when the upstream throttles. A source with a `batch_fn(symbols) ->
+{symbol: result}` answers all of a round's symbols routed to it first in one request per
+`batch_size` symbols (one token each); symbols it misses continue down their route, and
+the symbols of a chunk that failed retry that source one by one.
+
+RefreshScheduler decides *which* symbols a round refreshes: priority = staleness x interest
+(interest = how many watchers / orders / alerts / holdings reference the symbol), taken
+from a heap until each source's per-round budget is spent. Hundreds of tracked symbols
+share the same upstream rate budget; the most-watched, stalest ones go first.
+"""
+import asyncio
+import heapq
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class RateLimited(Exception):
+    """Raised by a fetch function when the upstream source throttles us."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate # Tokens per second
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, max_wait: float) -> bool:
+        """Takes one token, waiting up to `max_wait` seconds. False = gave up."""
+        deadline = time.monotonic() + max_wait
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            wait = (1 - self.tokens) / self.rate
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def remaining(self) -> float:
+        return max(0.0, self.open_until - time.time()) if self.state == self.OPEN else 0.0
+
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.time() < self.open_until
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.time() < self.open_until:
+                return False
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False # One probe at a time
+            self.probing = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self, cooldown: Optional[float] = None):
+        self.failures += 1
+        self.probing = False
+        if cooldown is not None or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.open_until = time.time() + (cooldown if cooldown is not None else self.cooldown)
+            self.trips += 1
+
+
+class QuoteSource:
+    def __init__(self, name: str, fn: Callable, rate: float, burst: int, timeout: float,
+                 failure_threshold: int = 3, cooldown: float = 60.0, rate_limit_cooldown: float = 300.0,
+                 max_wait: float = 10.0, batch_fn: Optional[Callable] = None, batch_size: int = 100):
+        self.name = name
+        self.fn = fn
+        self.batch_fn = batch_fn
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.ok = 0
+        self.empty = 0
+        self.failed = 0
+        self.skipped = 0
+
+    async def _call(self, fn: Callable, arg, label: str):
+        if self.breaker.is_open() or not await self.bucket.acquire(self.max_wait):
+            self.skipped += 1
+            return None
+        if not self.breaker.allow():
+            self.skipped += 1
+            return None
+        try:
+            result = await asyncio.wait_for(asyncio.to_thread(fn, arg), self.timeout)
+        except RateLimited as e:
+            self.failed += 1
+            self.breaker.record_failure(self.rate_limit_cooldown)
+            print(f"⏳ [{self.name}] Rate limited, pausing this source {self.rate_limit_cooldown:.0f}s: {e}")
+            return None
+        except asyncio.TimeoutError:
+            self.failed += 1
+            self.breaker.record_failure()
+            return None
+        except Exception as e:
+            self.failed += 1
+            self.breaker.record_failure()
+            print(f"⚠️ [{self.name}] {label}: {e}")
+            return None
+        self.breaker.record_success()
+        if not result:
+            self.empty += 1
+        else:
+            self.ok += 1
+        return result
+
+    async def fetch(self, symbol: str):
+        return await self._call(self.fn, symbol, symbol)
+
+    async def fetch_many(self, symbols: List[str]) -> Tuple[Dict[str, object], List[str]]:
+        """
+        batch_fn over `batch_size` chunks (sequential: one token each).
+        Returns (answers, symbols of chunks that failed or were skipped).
+        """
+        out, failed = {}, []
+        for i in range(0, len(symbols), self.batch_size):
+            chunk = symbols[i:i + self.batch_size]
+            result = await self._call(self.batch_fn, chunk, f"batch of {len(chunk)}")
+            if result is None:
+                failed.extend(chunk)
+            else:
+                out.update(result)
+        return out, failed
+
+    def round_budget(self) -> int:
+        """Requests one refresh round can start without any being skipped (burst + refill while waiting)."""
+        return max(1, int(self.bucket.capacity + self.bucket.rate * self.max_wait))
+
+    def symbol_budget(self) -> int:
+        return self.round_budget() * (self.batch_size if self.batch_fn else 1)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "cooldown_seconds": int(self.breaker.remaining()),
+            "trips": self.breaker.trips,
+            "tokens": round(self.bucket.tokens, 2),
+            "ok": self.ok,
+            "empty": self.empty,
+            "failed": self.failed,
+            "skipped": self.skipped,
+        }
+
+
+class QuoteRefresher:
+    def __init__(self, sources: List[QuoteSource], route: Callable[[str], List[QuoteSource]], concurrency: int = 8):
+        """route(symbol) -> sources to try in order (first non-None result wins)."""
+        self.sources = sources
+        self.route = route
+        self.concurrency = concurrency
+        self.last_round_seconds = 0.0
+
+    async def fetch(self, symbol: str, skip: Optional[QuoteSource] = None):
+        for source in self.route(symbol):
+            if source is skip:
+                continue
+            result = await source.fetch(symbol)
+            if result is not None:
+                return result
+        return None
+
+    async def refresh(self, symbols: Iterable[str]) -> Dict[str, object]:
+        """
+        Fetches every symbol concurrently (bounded). Symbols whose first source batches go
+        out as one request per source; the rest (and batch misses) one by one.
+        Returns {symbol: result} for the ones that answered.
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+        symbols = list(dict.fromkeys(symbols))
+        start = time.perf_counter()
+
+        batches: Dict[QuoteSource, List[str]] = {}
+        for symbol in symbols:
+            route = self.route(symbol)
+            if route and route[0].batch_fn is not None:
+                batches.setdefault(route[0], []).append(symbol)
+        found: Dict[str, object] = {}
+        firsts: Dict[str, QuoteSource] = {}
+        for source, (answers, failed) in zip(batches, await asyncio.gather(*(s.fetch_many(b) for s, b in batches.items()))):
+            asked = set(batches[source])
+            found.update({s: q for s, q in answers.items() if q is not None and s in asked})
+            # Answered-but-missing symbols skip this source; a failed chunk retries it one by one
+            firsts.update({s: source for s in asked.difference(failed)})
+
+        async def one(symbol):
+            async with sem:
+                return symbol, await self.fetch(symbol, skip=firsts.get(symbol))
+
+        results = await asyncio.gather(*(one(s) for s in symbols if s not in found))
+        self.last_round_seconds = time.perf_counter() - start
+        found.update({s: q for s, q in results if q is not None})
+        return found
+
+    def cooldown_seconds(self) -> int:
+        return int(max((s.breaker.remaining() for s in self.sources), default=0))
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "last_round_seconds": round(self.last_round_seconds, 3),
+            "sources": {s.name: s.stats() for s in self.sources},
+        }
+
+
+class RefreshScheduler:
+    def __init__(self, refresher: QuoteRefresher, max_staleness: float = 3600.0):
+        """max_staleness caps the staleness factor (never-fetched symbols count as this old)."""
+        self.refresher = refresher
+        self.max_staleness = max_staleness
+        self.interest: Dict[str, float] = {}
+        self.attempted: Dict[str, float] = {} # symbol -> last time it was fetched (answered or not)
+        self.refreshed: Dict[str, float] = {} # symbol -> last time it got a quote
+        self.last_plan: List[str] = []
+
+    def set_interest(self, interest: Dict[str, float]):
+        self.interest = {s: w for s, w in interest.items() if w > 0}
+        for table in (self.attempted, self.refreshed): # Forget symbols nobody references anymore
+            for s in [s for s in table if s not in self.interest]:
+                del table[s]
+
+    def priority(self, symbol: str, now: float) -> float:
+        last = self.attempted.get(symbol)
+        staleness = self.max_staleness if last is None else min(now - last, self.max_staleness)
+        return staleness * self.interest.get(symbol, 0.0)
+
+    def plan(self) -> List[str]:
+        """Highest priority first, each symbol charged to the first source of its route that is not open."""
+        now = time.time()
+        heap = [(-self.priority(s, now), s) for s in self.interest]
+        heapq.heapify(heap)
+        budget: Dict[str, int] = {}
+        planned = []
+        while heap:
+            neg, symbol = heapq.heappop(heap)
+            if neg >= 0:
+                break # Just refreshed (or no interest)
+            for source in self.refresher.route(symbol):
+                if source.breaker.is_open():
+                    continue
+                left = budget.setdefault(source.name, source.symbol_budget())
+                if left > 0:
+                    budget[source.name] = left - 1
+                    planned.append(symbol)
+                break
+        return planned
+
+    async def run_round(self) -> Dict[str, object]:
+        planned = self.last_plan = self.plan()
+        if not planned:
+            return {}
+        results = await self.refresher.refresh(planned)
+        now = time.time()
+        for symbol in planned:
+            self.attempted[symbol] = now
+        for symbol in results:
+            self.refreshed[symbol] = now
+        return results
+
+    def stats(self) -> dict:
+        now = time.time()
+        top = sorted(self.interest, key=lambda s: -self.priority(s, now))[:10]
+        return {
+            "tracked_symbols": len(self.interest),
+            "last_round_symbols": len(self.last_plan),
+            "never_refreshed": sum(1 for s in self.interest if s not in self.refreshed),
+            "max_age_seconds": int(max((now - self.refreshed.get(s, 0) for s in self.interest if s in self.refreshed), default=0)),
+            "source_budgets": {s.name: s.symbol_budget() for s in self.refresher.sources},
+            "top": [{"symbol": s, "interest": self.interest[s], "priority": round(self.priority(s, now), 1)} for s in top],
+        }
@@ -0,0 +1,399 @@
+"""
+Pre-Trade Risk Cache (Account Ledger) in Redis.
+
+Keeps per-user cash and share positions in Redis so order checks are one script call
+instead of Firestore reads, and every API worker (and a restarted one) sees the same
+holds:
+
+    ledger:acct:{uid}           HASH cash (available = Firestore 'balance' + unflushed deltas),
+                                     reserved_cash (held by open buys), holds (open hold count)
+    ledger:acct:{uid}:shares    HASH symbol -> owned quantity (= Firestore holdings 'quantity')
+    ledger:acct:{uid}:locked    HASH symbol -> quantity promised to open sell orders
+    ledger:hold:{order_id}      HASH user_id, symbol, side, remaining, unit_cash (per open order)
+    ledger:pending              HASH uid -> balance delta not yet written to Firestore
+    ledger:accounts / :holds    SETs of hydrated user ids / open hold order ids
+    ledger:touched              ZSET uid -> last use (idle eviction)
+
+- Accounts are hydrated lazily from Firestore on first use (1 user doc + 1 holdings query);
+  the hydrate script only writes if no other worker got there first.
+- Reserve, release and settlement are Lua scripts (like order_state.py): the check and the
+  update are one atomic step, so two workers can never spend the same cash or shares.
+- Balance changes made by reservations/releases are queued in ledger:pending and written
+  to Firestore asynchronously by `drain_pending()` callers (main.ledger_reconciler). The
+  queue survives a crash of the process that made them.
+- Idle accounts with no open hold and nothing unflushed are evicted, so the next use
+  re-reads Firestore (picks up external edits).
+"""
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+ACCOUNT_IDLE_TTL = 300 # seconds before an idle account is dropped and re-hydrated on next use
+
+ACCOUNTS_SET = "ledger:accounts"
+HOLDS_SET = "ledger:holds"
+PENDING_KEY = "ledger:pending"
+TOUCHED_KEY = "ledger:touched"
+
+
+class RiskCheckError(Exception):
+    """Pre-trade check failed. `status_code`/`detail` map onto the HTTP error."""
+
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+def account_key(user_id: str, kind: str = "") -> str:
+    """kind: '' (cash hash) | shares | locked"""
+    return f"ledger:acct:{user_id}" + (f":{kind}" if kind else "")
+
+
+def hold_key(order_id: str) -> str:
+    return f"ledger:hold:{order_id}"
+
+
+# KEYS: acct, shares, accounts set, touched | ARGV: uid, cash, now, symbol1, qty1, ...
+# Returns 1 if this call created the account, 0 if it already existed.
+HYDRATE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'cash', ARGV[2], 'reserved_cash', '0', 'holds', '0')
+redis.call('DEL', KEYS[2])
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[1])
+return 1
+"""
+
+# KEYS: acct, shares, locked, hold, holds set, pending, touched
+# ARGV: uid, order_id, symbol, side (buy|sell), quantity, total cash (buys), now
+# Returns ok | missing (account not hydrated) | insufficient
+RESERVE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 'missing'
+end
+redis.call('ZADD', KEYS[7], ARGV[7], ARGV[1])
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 'ok' -- Already held for this order
+end
+local qty = tonumber(ARGV[5])
+local unit = '0'
+if ARGV[4] == 'buy' then
+    local total = tonumber(ARGV[6])
+    if (tonumber(redis.call('HGET', KEYS[1], 'cash')) or 0) < total then
+        return 'insufficient'
+    end
+    redis.call('HINCRBYFLOAT', KEYS[1], 'cash', -total)
+    redis.call('HINCRBYFLOAT', KEYS[1], 'reserved_cash', total)
+    redis.call('HINCRBYFLOAT', KEYS[6], ARGV[1], -total)
+    unit = tostring(total / qty)
+else
+    local owned = tonumber(redis.call('HGET', KEYS[2], ARGV[3])) or 0
+    local locked = tonumber(redis.call('HGET', KEYS[3], ARGV[3])) or 0
+    if owned - locked < qty then
+        return 'insufficient'
+    end
+    redis.call('HINCRBYFLOAT', KEYS[3], ARGV[3], qty)
+end
+redis.call('HSET', KEYS[4], 'user_id', ARGV[1], 'symbol', ARGV[3], 'side', ARGV[4],
+           'remaining', ARGV[5], 'unit_cash', unit)
+redis.call('HINCRBY', KEYS[1], 'holds', 1)
+redis.call('SADD', KEYS[5], ARGV[2])
+return 'ok'
+"""
+
+# Shared by RELEASE/TRADE: takes `qty` off a hold, dropping it once nothing remains
+_HOLD_LUA = """
+local function hold_sub(hold, acct, order_id, remaining, qty)
+    if remaining - qty <= 0 then
+        redis.call('DEL', hold)
+        redis.call('SREM', KEYS[#KEYS], order_id)
+        if redis.call('EXISTS', acct) == 1 then
+            redis.call('HINCRBY', acct, 'holds', -1)
+        end
+    else
+        redis.call('HSET', hold, 'remaining', tostring(remaining - qty))
+    end
+end
+"""
+
+# KEYS: hold, acct, locked, pending, holds set | ARGV: order_id, quantity ('' = all that remains)
+# Returns the cash given back ('0' for sells), nil if the order holds nothing.
+RELEASE_LUA = _HOLD_LUA + """
+local h = redis.call('HMGET', KEYS[1], 'user_id', 'symbol', 'side', 'remaining', 'unit_cash')
+if not h[1] then
+    return false
+end
+local remaining = tonumber(h[4]) or 0
+local qty = remaining
+if ARGV[2] ~= '' then
+    qty = math.max(math.min(tonumber(ARGV[2]), remaining), 0)
+end
+hold_sub(KEYS[1], KEYS[2], ARGV[1], remaining, qty)
+local live = redis.call('EXISTS', KEYS[2]) == 1
+if h[3] == 'buy' then
+    local amount = (tonumber(h[5]) or 0) * qty
+    redis.call('HINCRBYFLOAT', KEYS[4], h[1], amount)
+    if live then
+        redis.call('HINCRBYFLOAT', KEYS[2], 'cash', amount)
+        redis.call('HINCRBYFLOAT', KEYS[2], 'reserved_cash', -amount)
+    end
+    return tostring(amount)
+end
+if live then
+    redis.call('HINCRBYFLOAT', KEYS[3], h[2], -qty)
+end
+return '0'
+"""
+
+# KEYS: buy hold, sell hold, buyer acct, buyer shares, seller acct, seller shares, seller locked, holds set
+# ARGV: buy_order_id, sell_order_id, quantity, symbol, price, fee_rate, skip_user, buyer_id, seller_id
+TRADE_LUA = _HOLD_LUA + """
+local qty = tonumber(ARGV[3])
+local buyer = redis.call('EXISTS', KEYS[3]) == 1
+local seller = redis.call('EXISTS', KEYS[5]) == 1
+
+local h = redis.call('HMGET', KEYS[1], 'remaining', 'unit_cash')
+if h[1] then
+    if buyer then
+        redis.call('HINCRBYFLOAT', KEYS[3], 'reserved_cash', -(tonumber(h[2]) or 0) * qty)
+    end
+    hold_sub(KEYS[1], KEYS[3], ARGV[1], tonumber(h[1]) or 0, qty)
+end
+if buyer and ARGV[8] ~= ARGV[7] then
+    redis.call('HINCRBYFLOAT', KEYS[4], ARGV[4], qty)
+end
+
+h = redis.call('HMGET', KEYS[2], 'remaining')
+if h[1] then
+    if seller then
+        redis.call('HINCRBYFLOAT', KEYS[7], ARGV[4], -qty)
+    end
+    hold_sub(KEYS[2], KEYS[5], ARGV[2], tonumber(h[1]) or 0, qty)
+end
+if seller and ARGV[9] ~= ARGV[7] then
+    local revenue = tonumber(ARGV[5]) * qty
+    redis.call('HINCRBYFLOAT', KEYS[5], 'cash', revenue - revenue * tonumber(ARGV[6]))
+    redis.call('HINCRBYFLOAT', KEYS[6], ARGV[4], -qty)
+end
+return 1
+"""
+
+# KEYS: acct | ARGV: delta. Only mirrors into a hydrated account.
+ADJUST_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBYFLOAT', KEYS[1], 'cash', ARGV[1])
+return 1
+"""
+
+# KEYS: pending | Returns the queued deltas as a flat HGETALL list and clears them.
+DRAIN_LUA = """
+local pending = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return pending
+"""
+
+# KEYS: acct, shares, locked, accounts set, touched, pending | ARGV: uid, cutoff
+# Returns 1 if evicted. Busy accounts (open holds, unflushed cash, recent use) stay.
+EVICT_LUA = """
+local touched = tonumber(redis.call('ZSCORE', KEYS[5], ARGV[1]))
+if touched and touched >= tonumber(ARGV[2]) then
+    return 0
+end
+if (tonumber(redis.call('HGET', KEYS[1], 'holds')) or 0) > 0 then
+    return 0
+end
+local pending = tonumber(redis.call('HGET', KEYS[6], ARGV[1]))
+if pending and pending ~= 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+redis.call('SREM', KEYS[4], ARGV[1])
+redis.call('ZREM', KEYS[5], ARGV[1])
+return 1
+"""
+
+_scripts = {}
+
+
+def _script(client, name: str, source: str):
+    # Registered once; the SHA is reused with whatever client/pipeline is passed in
+    script = _scripts.get(name)
+    if script is None:
+        script = _scripts[name] = client.register_script(source)
+    return script
+
+
+class AccountLedger:
+    def __init__(self, loader: Callable[[str], Tuple[Optional[float], Dict[str, int]]], client,
+                 idle_ttl: float = ACCOUNT_IDLE_TTL):
+        """
+        loader(user_id) -> (balance, {symbol: quantity}); balance None = user not found.
+        client: Redis client (decode_responses=True) shared by every worker.
+        """
+        self.loader = loader
+        self.client = client
+        self.idle_ttl = idle_ttl
+        self.hydrations = 0
+
+    # --- Hydration ---
+    def hydrate(self, user_id: str) -> bool:
+        """Loads the account from Firestore unless Redis has it. False if the user does not exist."""
+        balance, shares = self.loader(user_id)
+        if balance is None:
+            return False
+        args = [user_id, float(balance), time.time()]
+        for symbol, qty in shares.items():
+            args += [symbol, float(qty or 0)]
+        created = _script(self.client, "hydrate", HYDRATE_LUA)(
+            keys=[account_key(user_id), account_key(user_id, "shares"), ACCOUNTS_SET, TOUCHED_KEY],
+            args=args, client=self.client)
+        self.hydrations += int(created)
+        return True
+
+    def account(self, user_id: str) -> Optional[dict]:
+        """Current ledger view of a hydrated account, None if it is not cached."""
+        pipe = self.client.pipeline(transaction=False)
+        for kind in ("", "shares", "locked"):
+            pipe.hgetall(account_key(user_id, kind))
+        acct, shares, locked = pipe.execute()
+        if not acct:
+            return None
+        return {
+            "user_id": user_id,
+            "cash": float(acct.get("cash", 0)),
+            "reserved_cash": float(acct.get("reserved_cash", 0)),
+            "shares": {s: float(q) for s, q in shares.items()},
+            "locked": {s: float(q) for s, q in locked.items() if float(q)},
+        }
+
+    # --- Pre-trade reservations ---
+    def _reserve(self, order_id: str, user_id: str, symbol: str, side: str, quantity: int, total: float):
+        keys = [account_key(user_id), account_key(user_id, "shares"), account_key(user_id, "locked"),
+                hold_key(order_id), HOLDS_SET, PENDING_KEY, TOUCHED_KEY]
+        script = _script(self.client, "reserve", RESERVE_LUA)
+        for _ in range(2):
+            result = script(keys=keys, args=[user_id, order_id, symbol, side, quantity, total, time.time()],
+                            client=self.client)
+            if result != "missing":
+                return result
+            if not self.hydrate(user_id):
+                raise RiskCheckError("User wallet not found", 404)
+        raise RiskCheckError("User wallet not found", 404) # Evicted again between hydrate and reserve
+
+    def reserve_buy(self, order_id: str, user_id: str, symbol: str, quantity: int, total: float):
+        """Holds `total` cash for a buy order (queued as a Firestore balance decrement)."""
+        if self._reserve(order_id, user_id, symbol, "buy", quantity, total) == "insufficient":
+            raise RiskCheckError(f"Insufficient funds (Req: {total:,.0f})")
+
+    def reserve_sell(self, order_id: str, user_id: str, symbol: str, quantity: int):
+        """Locks shares for a sell order (Firestore quantity only moves at settlement)."""
+        if self._reserve(order_id, user_id, symbol, "sell", quantity, 0) == "insufficient":
+            raise RiskCheckError(f"Not enough {symbol} shares to sell")
+
+    def release(self, order_id: str, quantity: Optional[int] = None) -> Optional[float]:
+        """
+        Frees what an order still holds (cancel / rejected order).
+        `quantity` = unfilled part per the engine; the rest stays reserved for fills
+        matched but not settled yet. Returns the cash given back (buys), 0.0 for sells,
+        None if the order holds nothing here.
+        """
+        user_id = self.client.hget(hold_key(order_id), "user_id")
+        if user_id is None:
+            return None
+        amount = _script(self.client, "release", RELEASE_LUA)(
+            keys=[hold_key(order_id), account_key(user_id), account_key(user_id, "locked"), PENDING_KEY, HOLDS_SET],
+            args=[order_id, "" if quantity is None else quantity], client=self.client)
+        return None if amount is None else float(amount)
+
+    # --- Settlement mirror (Firestore itself is written by process_executed_trades) ---
+    def apply_trades(self, trades: list, fee_rate: float, skip_user: str = ""):
+        script = _script(self.client, "trade", TRADE_LUA)
+        pipe = self.client.pipeline(transaction=False)
+        for t in trades:
+            buyer, seller = t.get("buyer_id") or "", t.get("seller_id") or ""
+            script(keys=[hold_key(t["buy_order_id"]), hold_key(t["sell_order_id"]),
+                         account_key(buyer), account_key(buyer, "shares"),
+                         account_key(seller), account_key(seller, "shares"), account_key(seller, "locked"),
+                         HOLDS_SET],
+                   args=[t["buy_order_id"], t["sell_order_id"], t["quantity"], t["symbol"], t["price"],
+                         fee_rate, skip_user, buyer, seller],
+                   client=pipe)
+        pipe.execute()
+
+    def adjust_cash(self, user_id: str, delta: float):
+        """Mirrors a balance change already written to Firestore elsewhere (e.g. deposit)."""
+        _script(self.client, "adjust", ADJUST_LUA)(keys=[account_key(user_id)], args=[delta], client=self.client)
+
+    # --- Async reconciliation ---
+    def drain_pending(self) -> Dict[str, float]:
+        """Takes the queued balance deltas (caller writes them to Firestore)."""
+        flat = _script(self.client, "drain", DRAIN_LUA)(keys=[PENDING_KEY], client=self.client)
+        pending = {flat[i]: float(flat[i + 1]) for i in range(0, len(flat), 2)}
+        return {uid: d for uid, d in pending.items() if d}
+
+    def restore_pending(self, deltas: Dict[str, float]):
+        """Puts deltas back after a failed Firestore write (retried on the next drain)."""
+        if not deltas:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for uid, d in deltas.items():
+            pipe.hincrbyfloat(PENDING_KEY, uid, d)
+        pipe.execute()
+
+    def evict_idle(self) -> int:
+        cutoff = time.time() - self.idle_ttl
+        idle = self.client.zrangebyscore(TOUCHED_KEY, "-inf", cutoff)
+        if not idle:
+            return 0
+        script = _script(self.client, "evict", EVICT_LUA)
+        pipe = self.client.pipeline(transaction=False)
+        for uid in idle:
+            script(keys=[account_key(uid), account_key(uid, "shares"), account_key(uid, "locked"),
+                         ACCOUNTS_SET, TOUCHED_KEY, PENDING_KEY],
+                   args=[uid, cutoff], client=pipe)
+        return sum(pipe.execute())
+
+    def held_symbols(self) -> Dict[str, int]:
+        """symbol -> number of cached accounts holding it (one pipelined read)."""
+        users = self.client.smembers(ACCOUNTS_SET)
+        if not users:
+            return {}
+        pipe = self.client.pipeline(transaction=False)
+        for uid in users:
+            pipe.hgetall(account_key(uid, "shares"))
+        counts: Dict[str, int] = {}
+        for shares in pipe.execute():
+            for symbol, qty in shares.items():
+                if float(qty) > 0:
+                    counts[symbol] = counts.get(symbol, 0) + 1
+        return counts
+
+    def reset(self):
+        """Drops cached accounts and open holds. Queued deltas stay (still owed to Firestore)."""
+        users = self.client.smembers(ACCOUNTS_SET)
+        holds = self.client.smembers(HOLDS_SET)
+        keys = [account_key(uid, kind) for uid in users for kind in ("", "shares", "locked")]
+        keys += [hold_key(oid) for oid in holds]
+        keys += [ACCOUNTS_SET, HOLDS_SET, TOUCHED_KEY]
+        for start in range(0, len(keys), 500):
+            self.client.delete(*keys[start:start + 500])
+
+    def stats(self) -> dict:
+        pipe = self.client.pipeline(transaction=False)
+        pipe.scard(ACCOUNTS_SET)
+        pipe.scard(HOLDS_SET)
+        pipe.hlen(PENDING_KEY)
+        accounts, holds, pending = pipe.execute()
+        return {
+            "accounts": accounts,
+            "open_reservations": holds,
+            "pending_users": pending,
+            "hydrations": self.hydrations,
+        }
@@ -0,0 +1,42 @@
+"""
+Offline unit suite: matching engine, journal, pipeline, Redis Lua scripts, feed and stores.
+
+    cd stock_server && python -m pytest
+
+Redis tests run the real scripts on fakeredis (pip install -r requirements-dev.txt) and
+are skipped when fakeredis / its Lua runtime is not installed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching_engine import MatchingEngine, Order, OrderSide, OrderType
+
+
+@pytest.fixture
+def redis_client():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def engine():
+    eng = MatchingEngine() # Process-wide singleton: hand it over empty, leave it empty
+    eng.reset()
+    eng.journal = None
+    yield eng
+    eng.reset()
+    eng.journal = None
+
+
+@pytest.fixture
+def make_order():
+    def make(order_id, side, price, quantity, symbol="HPG", user_id="u1", filled=0):
+        return Order(id=order_id, user_id=user_id, symbol=symbol,
+                     side=OrderSide.BUY if side == "buy" else OrderSide.SELL,
+                     type=OrderType.LIMIT, price=price, quantity=quantity, filled_quantity=filled)
+    return make
@@ -0,0 +1,49 @@
+import json
+
+from market_feed import FEED_CHANNEL, PublishedBooks, feed_channel, feed_channels, merge_book
+
+
+def test_merge_book_applies_absolute_levels():
+    snapshot = {"type": "BOOK_SNAPSHOT", "seq": 1, "timestamp": 0, "bids": [[10.0, 5], [9.9, 1]], "asks": [[10.1, 2]]}
+    diff = {"type": "BOOK_DIFF", "seq": 3, "timestamp": 1, "bids": [[9.9, 0], [10.0, 7]], "asks": [[10.2, 4]]}
+    merged = merge_book(snapshot, diff)
+    assert merged["seq"] == 3
+    assert merged["bids"] == [[10.0, 7]] # qty 0 drops the level from a snapshot
+    assert merged["asks"] == [[10.1, 2], [10.2, 4]]
+
+
+def test_legacy_channel_is_kept_during_the_transition():
+    assert feed_channels("HPG") == [feed_channel("HPG"), FEED_CHANNEL]
+
+
+def test_published_state_is_compare_and_set(redis_client):
+    r = redis_client
+    books = PublishedBooks(r)
+    pubsub = r.pubsub()
+    pubsub.subscribe(feed_channel("HPG"))
+    pubsub.get_message(timeout=0.1)
+
+    assert books.publish(r, "HPG", None, feed_channel("HPG"), (1, {10.0: 5}, {}), {"type": "BOOK_SNAPSHOT"})
+    assert books.load(["HPG"])["HPG"] == (1, {10.0: 5}, {}, None)
+    # A second worker diffing against the same (now stale) base loses and publishes nothing
+    assert not books.publish(r, "HPG", None, feed_channel("HPG"), (2, {}, {}), {"type": "BOOK_DIFF"})
+    assert books.publish(r, "HPG", 1, feed_channel("HPG"), (2, {}, {}), {"type": "BOOK_DIFF"},
+                         book_seq=2, book={"type": "ORDER_BOOK"})
+
+    received = []
+    while (msg := pubsub.get_message(timeout=0.1)) is not None:
+        received.append(json.loads(msg["data"])["type"])
+    assert received == ["BOOK_SNAPSHOT", "BOOK_DIFF", "ORDER_BOOK"]
+    assert books.load(["HPG", "VCB"]) == {"HPG": (2, {}, {}, 2), "VCB": None}
+
+
+def test_dirty_symbols_are_taken_once(redis_client):
+    first, second = PublishedBooks(redis_client), PublishedBooks(redis_client)
+    first.mark_dirty("HPG", "VCB")
+    assert sorted(second.take_dirty()) == ["HPG", "VCB"]
+    assert first.take_dirty() == []
+
+    first.publish(redis_client, "HPG", None, feed_channel("HPG"), (1, {}, {}), book_seq=1, book={"type": "ORDER_BOOK"})
+    first.mark_all_dirty() # Engine reset: republish every known book, ORDER_BOOK included
+    assert second.take_dirty() == ["HPG"]
+    assert second.load(["HPG"])["HPG"][3] is None
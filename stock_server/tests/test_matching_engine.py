@@ -0,0 +1,83 @@
+import random
+
+from matching_engine import SNAPSHOT_LEVELS, OrderSide, OrderStatus
+
+
+def fills(trades):
+    return [(t["buy_order_id"], t["sell_order_id"], t["quantity"], t["price"]) for t in trades]
+
+
+def test_price_then_time_priority(engine, make_order):
+    engine.place_order(make_order("s1", "sell", 10.0, 3))
+    engine.place_order(make_order("s2", "sell", 10.0, 3))
+    engine.place_order(make_order("s3", "sell", 9.5, 3))
+
+    trades = engine.place_order(make_order("b1", "buy", 10.0, 8))
+
+    # Best price first, then arrival order inside the level; each at the resting (maker) price
+    assert fills(trades) == [("b1", "s3", 3, 9.5), ("b1", "s1", 3, 10.0), ("b1", "s2", 2, 10.0)]
+    snap = engine.get_snapshot("HPG")
+    assert snap.asks == ((10.0, 1),)
+    assert snap.bids == ()
+
+
+def test_incoming_order_trades_at_maker_price(engine, make_order):
+    engine.place_order(make_order("b1", "buy", 10.0, 5))
+    trades = engine.place_order(make_order("s1", "sell", 9.0, 2))
+    assert fills(trades) == [("b1", "s1", 2, 10.0)]
+    assert engine.get_snapshot("HPG").bids == ((10.0, 3),)
+
+
+def test_cancel_returns_remaining_once(engine, make_order):
+    engine.place_order(make_order("b1", "buy", 10.0, 5))
+    engine.place_order(make_order("s1", "sell", 10.0, 2))
+
+    cancelled = engine.cancel_order("b1")
+    assert cancelled.remaining_quantity == 3
+    assert engine.cancel_order("b1") is None
+    assert engine.cancel_order("s1") is None # Fully filled, no longer resting
+    assert engine.get_snapshot("HPG").bids == ()
+
+
+def test_place_orders_matches_like_sequential_placement(engine, make_order):
+    def batch():
+        return [make_order("s1", "sell", 10.0, 4), make_order("b1", "buy", 10.5, 3),
+                make_order("v1", "sell", 20.0, 1, symbol="VCB"), make_order("b2", "buy", 10.0, 4),
+                make_order("v2", "buy", 21.0, 1, symbol="VCB")]
+
+    sequential = [fills(engine.place_order(o)) for o in batch()]
+    snaps = {s: engine.get_snapshot(s)[3:] for s in ("HPG", "VCB")}
+    engine.reset()
+
+    assert [fills(t) for t in engine.place_orders(batch())] == sequential
+    assert {s: engine.get_snapshot(s)[3:] for s in ("HPG", "VCB")} == snaps
+
+
+def test_snapshot_matches_resting_orders(engine, make_order):
+    rng = random.Random(7)
+    placed, last_seq = [], 0
+    for i in range(3000):
+        if placed and rng.random() < 0.3:
+            engine.cancel_order(placed.pop(rng.randrange(len(placed))))
+        else:
+            side = rng.choice(("buy", "sell"))
+            price = round(rng.uniform(95, 105), 1)
+            engine.place_order(make_order(f"o{i}", side, price, rng.randint(1, 50)))
+            placed.append(f"o{i}")
+
+        snap = engine.get_snapshot("HPG")
+        assert snap.seq >= last_seq
+        last_seq = snap.seq
+        if i % 100:
+            continue
+        book = engine.get_book("HPG")
+        with book.lock:
+            levels = {OrderSide.BUY: {}, OrderSide.SELL: {}}
+            for o in book.resting_orders():
+                assert o.status != OrderStatus.FILLED
+                levels[o.side][o.price] = levels[o.side].get(o.price, 0) + o.remaining_quantity
+        bids = tuple(sorted(levels[OrderSide.BUY].items(), reverse=True)[:SNAPSHOT_LEVELS])
+        asks = tuple(sorted(levels[OrderSide.SELL].items())[:SNAPSHOT_LEVELS])
+        assert (snap.bids, snap.asks) == (bids, asks)
+        if bids and asks:
+            assert bids[0][0] < asks[0][0] # Never left crossed
@@ -0,0 +1,52 @@
+from datetime import date
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+
+from ohlcv_store import OHLCVStore
+
+FUTURE = date(2030, 1, 1) # "today" far after every range: everything settles
+
+
+def bars(*days, close=10.0):
+    return [{"time": d, "open": 1, "high": 2, "low": 0.5, "close": close, "volume": 100} for d in days]
+
+
+def test_gaps_cover_only_what_was_not_fetched(tmp_path):
+    store = OHLCVStore(str(tmp_path))
+    assert store.gaps("HPG", "1D", "2024-01-01", "2024-01-31") == [("2024-01-01", "2024-01-31")]
+
+    store.write("HPG", "1D", bars("2024-01-02"), "2024-01-01", "2024-01-10", today=FUTURE)
+    store.write("HPG", "1D", bars("2024-01-22"), "2024-01-20", "2024-01-25", today=FUTURE)
+
+    assert store.gaps("HPG", "1D", "2024-01-01", "2024-01-31") == [
+        ("2024-01-11", "2024-01-19"), ("2024-01-26", "2024-01-31")]
+    assert store.gaps("HPG", "1D", "2024-01-03", "2024-01-09") == []
+
+    # Adjacent ranges merge
+    store.write("HPG", "1D", [], "2024-01-11", "2024-01-19", today=FUTURE)
+    assert store.gaps("HPG", "1D", "2024-01-01", "2024-01-25") == []
+
+
+def test_unsettled_tail_is_never_covered(tmp_path):
+    store = OHLCVStore(str(tmp_path))
+    store.write("HPG", "1D", bars("2024-03-01"), "2024-03-01", "2024-03-05", today=date(2024, 3, 5))
+    assert store.gaps("HPG", "1D", "2024-03-01", "2024-03-05") == [("2024-03-05", "2024-03-05")]
+
+
+def test_read_slices_dates_and_newer_rows_win(tmp_path):
+    store = OHLCVStore(str(tmp_path))
+    store.write("HPG", "1D", bars("2024-01-02", "2024-01-03", "2024-01-04"), "2024-01-01", "2024-01-05", today=FUTURE)
+    store.write("HPG", "1D", bars("2024-01-03", close=12.5), "2024-01-03", "2024-01-03", today=FUTURE)
+
+    rows = store.read("HPG", "1D", "2024-01-03", "2024-01-04")
+    assert [(b["time"], b["close"]) for b in rows] == [("2024-01-03", 12.5), ("2024-01-04", 10.0)]
+    assert rows[0]["volume"] == 100
+
+
+def test_invalid_series_names_are_rejected(tmp_path):
+    store = OHLCVStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.gaps("../etc", "1D", "2024-01-01", "2024-01-02")
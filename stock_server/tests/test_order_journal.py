@@ -0,0 +1,70 @@
+from matching_engine import MatchingEngine, next_order_seq
+from order_journal import EngineJournal
+
+
+def book_state(engine):
+    state = {}
+    for symbol, book in engine.books.items():
+        with book.lock:
+            rows = [(o.id, o.price_ticks, o.remaining_quantity, o.seq) for o in book.resting_orders()]
+        if rows:
+            state[symbol] = rows
+    return state
+
+
+def trade_flow(engine, make_order, prefix=""):
+    engine.place_order(make_order(prefix + "s1", "sell", 10.0, 5))
+    engine.place_order(make_order(prefix + "s2", "sell", 10.5, 5))
+    engine.place_order(make_order(prefix + "b1", "buy", 10.0, 3)) # Partial fill of s1
+    engine.place_order(make_order(prefix + "v1", "buy", 20.0, 2, symbol="VCB"))
+    engine.cancel_order(prefix + "s2")
+
+
+def test_recover_rebuilds_the_live_books(engine, make_order, tmp_path):
+    journal = EngineJournal(str(tmp_path), segment_size=4096)
+    engine.attach_journal(journal)
+    trade_flow(engine, make_order)
+    expected = book_state(engine)
+    journal.close()
+
+    engine.reset()
+    engine.journal = None
+    stats = EngineJournal(str(tmp_path)).recover(engine)
+
+    assert book_state(engine) == expected
+    assert stats["snapshot_seq"] == 0
+    assert stats["replayed_events"] == stats["last_seq"] == 6 # 4 NEW + 1 FILL + 1 CANCEL
+    assert next_order_seq() > max(seq for rows in expected.values() for *_, seq in rows)
+
+
+def test_recover_replays_only_the_tail_after_a_snapshot(engine, make_order, tmp_path):
+    journal = EngineJournal(str(tmp_path), segment_size=4096)
+    engine.attach_journal(journal)
+    trade_flow(engine, make_order, prefix="a")
+    snap_seq = journal.write_snapshot(engine)
+    trade_flow(engine, make_order, prefix="b")
+    expected = book_state(engine)
+    journal.close()
+
+    engine.reset()
+    engine.journal = None
+    stats = EngineJournal(str(tmp_path)).recover(engine)
+
+    assert book_state(engine) == expected
+    assert stats["snapshot_seq"] == snap_seq
+    assert stats["replayed_events"] == stats["last_seq"] - snap_seq
+
+
+def test_reset_forgets_everything(engine, make_order, tmp_path):
+    journal = EngineJournal(str(tmp_path))
+    engine.attach_journal(journal)
+    trade_flow(engine, make_order)
+    journal.write_snapshot(engine)
+    journal.reset()
+    journal.close()
+
+    fresh = MatchingEngine()
+    fresh.reset()
+    fresh.journal = None
+    assert EngineJournal(str(tmp_path)).recover(fresh)["last_seq"] == 0
+    assert book_state(fresh) == {}
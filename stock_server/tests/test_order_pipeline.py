@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import pytest
+
+from order_pipeline import Job, Pipeline, PipelineBusy, Stage
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_jobs_pass_every_stage_and_ack_early():
+    seen = []
+    gate = threading.Event()
+
+    def persist(job):
+        seen.append(("persist", job.n))
+
+    def settle(job):
+        gate.wait(5) # Later stages keep running after the ack
+        seen.append(("settle", job.n))
+
+    async def main():
+        pipeline = Pipeline("t", [Stage("persist", persist, ack=True), Stage("settle", settle)])
+        await pipeline.start()
+        futures = []
+        for n in range(5):
+            job = Job()
+            job.n = n
+            futures.append(await pipeline.submit(job))
+        accepted = await asyncio.gather(*futures)
+        assert [j.n for j in accepted] == list(range(5))
+        assert not any(stage == "settle" for stage, _ in seen)
+        gate.set()
+        await pipeline.stop(drain=True)
+
+    run(main())
+    assert [n for stage, n in seen if stage == "settle"] == list(range(5)) # One worker = FIFO
+
+
+def test_full_first_stage_raises_busy():
+    gate = threading.Event()
+
+    async def main():
+        pipeline = Pipeline("t", [Stage("slow", lambda job: gate.wait(5), maxsize=1)])
+        await pipeline.start()
+        await pipeline.submit(Job()) # Taken by the worker
+        await pipeline.submit(Job()) # Fills the queue
+        await asyncio.sleep(0.05)
+        with pytest.raises(PipelineBusy):
+            await pipeline.submit(Job(), timeout=0.05)
+        assert pipeline.stats()["rejected_busy"] == 1
+        gate.set()
+        await pipeline.stop(drain=True)
+
+    run(main())
+
+
+def test_errors_before_and_after_the_ack():
+    after = []
+
+    def validate(job):
+        if job.n == 1:
+            raise ValueError("rejected")
+
+    def match(job):
+        if job.n == 2:
+            raise RuntimeError("engine down")
+        after.append(job.n)
+
+    async def main():
+        pipeline = Pipeline("t", [Stage("validate", validate, ack=True), Stage("match", match)])
+        await pipeline.start()
+        jobs = []
+        for n in range(3):
+            job = Job()
+            job.n = n
+            jobs.append(await pipeline.submit(job))
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        await pipeline.stop(drain=True)
+        return results, pipeline.stats()
+
+    results, stats = run(main())
+    assert isinstance(results[1], ValueError) # Failed before the ack: the caller sees it
+    assert results[2].stopped # Failed after the ack: logged and stopped
+    assert after == [0]
+    assert [s["errors"] for s in stats["stages"]] == [1, 1]
+
+
+def test_stopped_job_skips_later_stages_and_stop_refuses_new_jobs():
+    later = []
+
+    def first(job):
+        job.stopped = job.n == 0
+
+    async def main():
+        pipeline = Pipeline("t", [Stage("first", first), Stage("second", lambda job: later.append(job.n))])
+        await pipeline.start()
+        for n in range(2):
+            job = Job()
+            job.n = n
+            await pipeline.submit(job)
+        await pipeline.stop(drain=True)
+        with pytest.raises(PipelineBusy):
+            await pipeline.submit(Job())
+
+    run(main())
+    assert later == [1]
@@ -0,0 +1,111 @@
+import order_state
+from order_state import PENDING_SET, active_symbols, book_depth, book_key
+
+
+def new_order(client, order_id, side, price, quantity, symbol="HPG", user_id="u1", engine=None):
+    record = {"order_id": order_id, "user_id": user_id, "symbol": symbol, "side": side, "price": price,
+              "quantity": quantity, "filled": 0, "status": "pending"}
+    if engine:
+        record["engine"] = engine
+    pipe = client.pipeline()
+    pipe.hset(f"order:{order_id}", mapping=record)
+    order_state.add_pending(pipe, order_id, symbol, side, price, quantity)
+    pipe.execute()
+
+
+def test_fills_move_partial_then_matched(redis_client):
+    r = redis_client
+    new_order(r, "b1", "buy", 10.0, 5)
+    new_order(r, "b2", "buy", 10.0, 2)
+
+    assert order_state.fill_order(r, "b1", "HPG", 3) == ["partial", "3", "5"]
+    assert book_depth(r, "HPG")["bids"] == [{"price": 10.0, "quantity": 4}]
+
+    assert order_state.fill_order(r, "b1", "HPG", 2) == ["matched", "5", "5"]
+    assert not r.sismember(PENDING_SET, "b1")
+    assert r.zscore(book_key("HPG", "buy", "orders"), "b1") is None
+    assert book_depth(r, "HPG")["bids"] == [{"price": 10.0, "quantity": 2}] # b2 keeps the level
+
+
+def test_cancel_checks_owner_and_cleans_indexes(redis_client):
+    r = redis_client
+    new_order(r, "s1", "sell", 11.0, 4, user_id="alice")
+
+    assert order_state.cancel_order(r, "s1", "HPG", "mallory")[0] == "forbidden"
+    assert order_state.cancel_order(r, "s1", "HPG", "alice") == ["ok", "pending", "4", "0"]
+    assert r.hget("order:s1", "status") == "cancelled"
+    assert not r.sismember(PENDING_SET, "s1")
+    assert book_depth(r, "HPG") == {"bids": [], "asks": []}
+    assert order_state.cancel_order(r, "s1", "HPG", "alice")[:2] == ["closed", "cancelled"]
+    assert order_state.cancel_order(r, "nope", "HPG")[0] == "missing"
+
+
+def test_fill_after_cancel_keeps_cancelled_and_level(redis_client):
+    r = redis_client
+    new_order(r, "b1", "buy", 10.0, 5)
+    new_order(r, "b2", "buy", 10.0, 3)
+    order_state.fill_order(r, "b1", "HPG", 1)
+    order_state.cancel_order(r, "b1", "HPG")
+
+    # The fill settles after the cancel: recorded, but the level is not taken off twice
+    assert order_state.fill_order(r, "b1", "HPG", 1) == ["cancelled", "2", "5"]
+    assert book_depth(r, "HPG")["bids"] == [{"price": 10.0, "quantity": 3}]
+
+
+def test_expire_closes_without_owner(redis_client):
+    r = redis_client
+    new_order(r, "b1", "buy", 10.0, 5)
+    assert order_state.expire_order(r, "b1", "HPG")[0] == "ok"
+    assert r.hget("order:b1", "status") == "expired"
+
+
+def test_claim_and_queued_cancel_race_atomically(redis_client):
+    r = redis_client
+    new_order(r, "q1", "buy", 10.0, 1, engine="queued")
+    new_order(r, "q2", "buy", 10.0, 1, engine="queued")
+
+    # q1: the consumer wins, a queued-only cancel must go through the engine
+    assert order_state.claim_order(r, "q1") == "queued"
+    assert order_state.claim_order(r, "q1") == "matching" # Redelivery: skipped
+    assert order_state.cancel_order(r, "q1", "HPG", queued_only=True)[0] == "engine"
+
+    # q2: the cancel wins, the consumer must skip it
+    assert order_state.cancel_order(r, "q2", "HPG", queued_only=True)[0] == "ok"
+    assert order_state.claim_order(r, "q2") == "closed"
+    assert order_state.claim_order(r, "unknown") == ""
+
+
+def test_reject_closes_the_order(redis_client):
+    r = redis_client
+    new_order(r, "b1", "buy", 10.0, 5, engine="matching")
+    assert order_state.reject_order(r, "b1", "HPG")[0] == "ok"
+    assert r.hget("order:b1", "status") == "rejected"
+    assert not r.sismember(PENDING_SET, "b1")
+
+
+def test_active_symbols_follow_the_levels(redis_client):
+    r = redis_client
+    new_order(r, "b1", "buy", 10.0, 5)
+    new_order(r, "s1", "sell", 11.0, 5)
+    new_order(r, "v1", "buy", 20.0, 1, symbol="VCB")
+    assert active_symbols(r) == {"HPG", "VCB"}
+
+    order_state.fill_order(r, "b1", "HPG", 5)
+    assert active_symbols(r) == {"HPG", "VCB"} # Asks left
+    order_state.cancel_order(r, "s1", "HPG")
+    order_state.expire_order(r, "v1", "VCB")
+    assert active_symbols(r) == set()
+
+    new_order(r, "f1", "buy", 1.0, 1, symbol="FPT")
+    r.delete(order_state.ACTIVE_SYMBOLS)
+    assert order_state.sync_active_symbols(r) == 1
+    assert active_symbols(r) == {"FPT"}
+
+
+def test_book_depth_orders_levels_best_first(redis_client):
+    r = redis_client
+    for i, (side, price) in enumerate([("buy", 9.9), ("buy", 10.1), ("buy", 10.0), ("sell", 10.3), ("sell", 10.2)]):
+        new_order(r, f"o{i}", side, price, i + 1)
+    depth = book_depth(r, "HPG", limit=2)
+    assert [l["price"] for l in depth["bids"]] == [10.1, 10.0]
+    assert [l["price"] for l in depth["asks"]] == [10.2, 10.3]
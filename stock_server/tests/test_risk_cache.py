@@ -0,0 +1,57 @@
+import pytest
+
+from risk_cache import AccountLedger, RiskCheckError
+
+ACCOUNTS = {"alice": (1000.0, {"HPG": 10}), "bob": (500.0, {})}
+
+
+def load_account(user_id):
+    return ACCOUNTS.get(user_id, (None, {}))
+
+
+@pytest.fixture
+def ledgers(redis_client):
+    # Two API workers sharing one Redis ledger
+    return AccountLedger(load_account, redis_client), AccountLedger(load_account, redis_client)
+
+
+def test_reservations_are_shared_between_workers(ledgers):
+    first, second = ledgers
+    first.reserve_buy("o1", "bob", "HPG", 4, 404.0)
+    with pytest.raises(RiskCheckError):
+        second.reserve_buy("o2", "bob", "HPG", 1, 101.0)
+
+    second.reserve_sell("s1", "alice", "HPG", 6)
+    with pytest.raises(RiskCheckError):
+        first.reserve_sell("s2", "alice", "HPG", 5)
+
+    with pytest.raises(RiskCheckError) as err:
+        first.reserve_buy("x", "nobody", "HPG", 1, 1.0)
+    assert err.value.status_code == 404
+
+
+def test_trades_and_release_settle_the_holds(ledgers):
+    ledger, _ = ledgers
+    ledger.reserve_buy("o1", "bob", "HPG", 4, 404.0)
+    ledger.reserve_sell("s1", "alice", "HPG", 6)
+    ledger.apply_trades([{"buy_order_id": "o1", "sell_order_id": "s1", "quantity": 3, "symbol": "HPG",
+                          "price": 100.0, "buyer_id": "bob", "seller_id": "alice"}], 0.001)
+
+    bob, alice = ledger.account("bob"), ledger.account("alice")
+    assert bob["shares"] == {"HPG": 3.0} and bob["reserved_cash"] == pytest.approx(101.0)
+    assert alice["cash"] == pytest.approx(1299.7) and alice["locked"] == {"HPG": 3.0}
+
+    assert ledger.release("o1") == pytest.approx(101.0) # Unfilled part of the hold
+    assert ledger.release("o1") is None # Idempotent
+    assert ledger.release("s1", 1) == 0.0
+    assert ledger.account("alice")["locked"] == {"HPG": 2.0}
+    assert ledger.held_symbols() == {"HPG": 2} # Accounts holding it
+
+
+def test_pending_cash_is_drained_once(ledgers):
+    ledger, other = ledgers
+    ledger.reserve_buy("o1", "bob", "HPG", 1, 100.0)
+    assert other.drain_pending() == {"bob": -100.0}
+    assert ledger.drain_pending() == {}
+    ledger.restore_pending({"bob": -100.0})
+    assert other.drain_pending() == {"bob": -100.0}